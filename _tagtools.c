@@ -0,0 +1,367 @@
+/*
+ * Optional C accelerator for tagtools.py
+ *
+ * Build it with:
+ *
+ *     python setup.py build_ext --inplace
+ *
+ * tagtools.py uses it when it can be imported, unless the
+ * TAGTOOLS_NO_SPEEDUPS environment variable is set. It must behave exactly
+ * like the pure Python code it replaces:
+ *
+ *  - tags() is the split/normalize/dedup loop of Tokenizer.str2tags, with
+ *    a fast path that builds Tag objects without running Tag.__init__.
+ *  - flickr_tokens() is _flickr_tokens() and the _FlickrScanner state
+ *    machine, for a whole string.
+ */
+
+#define PY_SSIZE_T_CLEAN
+#include <Python.h>
+
+static PyObject *tag_type = NULL;
+static PyObject *machine_match = NULL;
+static PyObject *empty_tuple = NULL;
+static PyObject *s_raw, *s_clean, *s_is_machinetag, *s_namespace,
+                *s_predicate, *s_value, *s_strip, *s_lower, *s_groups;
+
+
+static PyObject *
+configure(PyObject *self, PyObject *args)
+{
+    PyObject *tagclass, *regex, *match;
+
+    if (!PyArg_ParseTuple(args, "OO:configure", &tagclass, &regex))
+        return NULL;
+    if (!PyType_Check(tagclass)) {
+        PyErr_SetString(PyExc_TypeError, "tagclass must be a class");
+        return NULL;
+    }
+    match = PyObject_GetAttrString(regex, "match");
+    if (match == NULL)
+        return NULL;
+    Py_XSETREF(machine_match, match);
+    Py_INCREF(tagclass);
+    Py_XSETREF(tag_type, tagclass);
+    Py_RETURN_NONE;
+}
+
+
+/* Tag(strtag), without calling Tag.__init__ */
+static PyObject *
+new_tag(PyObject *strtag)
+{
+    PyObject *tag = NULL, *raw = NULL, *clean = NULL, *mmatch = NULL,
+             *groups = NULL, *value = NULL;
+    PyObject *namespace = Py_None, *predicate = Py_None;
+    PyObject *is_machinetag = Py_False;
+    Py_ssize_t size;
+
+    raw = PyObject_CallMethodNoArgs(strtag, s_strip);
+    if (raw == NULL)
+        goto error;
+    clean = PyObject_CallMethodNoArgs(raw, s_lower);
+    if (clean == NULL)
+        goto error;
+    if (!PyUnicode_Check(raw)) {
+        PyErr_SetString(PyExc_TypeError, "tags must be strings");
+        goto error;
+    }
+    size = PyUnicode_GET_LENGTH(raw);
+    if (PyUnicode_FindChar(raw, ':', 0, size, 1) >= 0 &&
+            PyUnicode_FindChar(raw, '=', 0, size, 1) >= 0) {
+        mmatch = PyObject_CallOneArg(machine_match, raw);
+        if (mmatch == NULL)
+            goto error;
+        if (mmatch != Py_None) {
+            groups = PyObject_CallMethodNoArgs(mmatch, s_groups);
+            if (groups == NULL)
+                goto error;
+            if (!PyTuple_Check(groups) || PyTuple_GET_SIZE(groups) != 3) {
+                PyErr_SetString(PyExc_ValueError,
+                                "the machine tag regex needs 3 groups");
+                goto error;
+            }
+            namespace = PyTuple_GET_ITEM(groups, 0);
+            predicate = PyTuple_GET_ITEM(groups, 1);
+            value = PyObject_CallMethodNoArgs(PyTuple_GET_ITEM(groups, 2),
+                                              s_lower);
+            if (value == NULL)
+                goto error;
+            is_machinetag = Py_True;
+        }
+    }
+
+    tag = PyBaseObject_Type.tp_new((PyTypeObject *)tag_type, empty_tuple,
+                                   NULL);
+    if (tag == NULL)
+        goto error;
+    /* same attribute order as Tag.__init__ */
+    if (PyObject_SetAttr(tag, s_raw, raw) < 0 ||
+            PyObject_SetAttr(tag, s_is_machinetag, is_machinetag) < 0 ||
+            PyObject_SetAttr(tag, s_namespace, namespace) < 0 ||
+            PyObject_SetAttr(tag, s_predicate, predicate) < 0 ||
+            PyObject_SetAttr(tag, s_value,
+                             value ? value : Py_None) < 0 ||
+            PyObject_SetAttr(tag, s_clean, clean) < 0)
+        goto error;
+    goto done;
+
+error:
+    Py_CLEAR(tag);
+done:
+    Py_XDECREF(raw);
+    Py_XDECREF(clean);
+    Py_XDECREF(mmatch);
+    Py_XDECREF(groups);
+    Py_XDECREF(value);
+    return tag;
+}
+
+
+static PyObject *
+tags(PyObject *self, PyObject *args)
+{
+    PyObject *strtags, *tagclass, *iter, *strtag, *tag, *clean;
+    PyObject *result = NULL, *keys = NULL;
+    int fast, known;
+
+    if (!PyArg_ParseTuple(args, "OO:tags", &strtags, &tagclass))
+        return NULL;
+    fast = tagclass == tag_type;
+    iter = PyObject_GetIter(strtags);
+    if (iter == NULL)
+        return NULL;
+    result = PyList_New(0);
+    keys = PySet_New(NULL);
+    if (result == NULL || keys == NULL)
+        goto error;
+
+    while ((strtag = PyIter_Next(iter)) != NULL) {
+        if (fast)
+            tag = new_tag(strtag);
+        else
+            tag = PyObject_CallOneArg(tagclass, strtag);
+        Py_DECREF(strtag);
+        if (tag == NULL)
+            goto error;
+        clean = PyObject_GetAttr(tag, s_clean);
+        if (clean == NULL) {
+            Py_DECREF(tag);
+            goto error;
+        }
+        /* ignore empty tags and tags with the normalized form of a
+           previous tag */
+        known = PyObject_IsTrue(clean);
+        if (known > 0)
+            known = PySet_Contains(keys, clean);
+        else if (known == 0)
+            known = 1;
+        if (known == 0 &&
+                (PyList_Append(result, tag) < 0 ||
+                 PySet_Add(keys, clean) < 0))
+            known = -1;
+        Py_DECREF(clean);
+        Py_DECREF(tag);
+        if (known < 0)
+            goto error;
+    }
+    if (PyErr_Occurred())
+        goto error;
+    Py_DECREF(iter);
+    Py_DECREF(keys);
+    return result;
+
+error:
+    Py_DECREF(iter);
+    Py_XDECREF(keys);
+    Py_XDECREF(result);
+    return NULL;
+}
+
+
+static int
+char_arg(PyObject *arg, Py_UCS4 *out, const char *name)
+{
+    if (arg == Py_None) {
+        *out = (Py_UCS4)-1;
+        return 0;
+    }
+    if (!PyUnicode_Check(arg) || PyUnicode_GET_LENGTH(arg) != 1) {
+        PyErr_Format(PyExc_ValueError, "%s must be a character", name);
+        return -1;
+    }
+    *out = PyUnicode_READ_CHAR(arg, 0);
+    return 0;
+}
+
+
+static int
+emit(PyObject *result, Py_UCS4 *buffer, Py_ssize_t size, int strip)
+{
+    PyObject *tok, *stripped;
+    int status;
+
+    tok = PyUnicode_FromKindAndData(PyUnicode_4BYTE_KIND, buffer, size);
+    if (tok == NULL)
+        return -1;
+    if (strip) {
+        stripped = PyObject_CallMethodNoArgs(tok, s_strip);
+        Py_DECREF(tok);
+        if (stripped == NULL)
+            return -1;
+        tok = stripped;
+        if (PyUnicode_GET_LENGTH(tok) == 0) {
+            Py_DECREF(tok);
+            return 0;
+        }
+    }
+    status = PyList_Append(result, tok);
+    Py_DECREF(tok);
+    return status;
+}
+
+
+static PyObject *
+flickr_tokens(PyObject *self, PyObject *args)
+{
+    PyObject *tagstr, *separator_arg, *quote_arg, *escape_arg;
+    PyObject *result = NULL;
+    Py_UCS4 separator, quote, escape, c, *buffer = NULL;
+    Py_ssize_t size, i, j, pos = 0, lastquote = -1;
+    int kind, quoted = 0;
+    Py_UCS4 prev = (Py_UCS4)-1;
+    const void *data;
+
+    if (!PyArg_ParseTuple(args, "UOOO:flickr_tokens", &tagstr,
+                          &separator_arg, &quote_arg, &escape_arg))
+        return NULL;
+    if (char_arg(separator_arg, &separator, "separator") < 0 ||
+            separator == (Py_UCS4)-1 ||
+            char_arg(quote_arg, &quote, "quote") < 0 ||
+            char_arg(escape_arg, &escape, "escape") < 0) {
+        if (!PyErr_Occurred())
+            PyErr_SetString(PyExc_ValueError, "separator can't be None");
+        return NULL;
+    }
+    size = PyUnicode_GET_LENGTH(tagstr);
+    kind = PyUnicode_KIND(tagstr);
+    data = PyUnicode_DATA(tagstr);
+
+    /* the last quote that is not escaped */
+    for (i = 0; i < size; i++) {
+        c = PyUnicode_READ(kind, data, i);
+        if (c == escape)
+            i++;
+        else if (c == quote)
+            lastquote = i;
+    }
+
+    result = PyList_New(0);
+    buffer = PyMem_New(Py_UCS4, size + 1);
+    if (result == NULL || buffer == NULL) {
+        PyErr_NoMemory();
+        goto error;
+    }
+    i = 0;
+    while (i < size) {
+        c = PyUnicode_READ(kind, data, i);
+        if (c == escape) {
+            if (i + 1 < size) {
+                buffer[pos++] = PyUnicode_READ(kind, data, i + 1);
+                i += 2;
+            } else {
+                buffer[pos++] = c;
+                i++;
+            }
+        } else if (c == quote) {
+            for (j = i; j < size && PyUnicode_READ(kind, data, j) == quote;
+                    j++)
+                ;
+            if ((j - i) % 2)
+                quoted = !quoted;
+            i = j;
+        } else if (c == separator) {
+            for (j = i; j < size &&
+                    PyUnicode_READ(kind, data, j) == separator; j++)
+                ;
+            if (!quoted || (prev == quote && i > lastquote)) {
+                if (pos) {
+                    /* only the first separator closes the tag, the rest
+                       are ignored */
+                    quoted = 0;
+                    if (emit(result, buffer, pos, 0) < 0)
+                        goto error;
+                    pos = 0;
+                } else if (quoted) {
+                    /* no tag to close, the rest are still quoted */
+                    for (i++; i < j; i++)
+                        buffer[pos++] = separator;
+                }
+            } else {
+                for (; i < j; i++)
+                    buffer[pos++] = separator;
+            }
+            i = j;
+        } else {
+            for (; i < size; i++) {
+                c = PyUnicode_READ(kind, data, i);
+                if (c == separator || c == quote || c == escape)
+                    break;
+                buffer[pos++] = c;
+            }
+            /* the first character of the run, it's not a quote */
+            c = (Py_UCS4)-2;
+        }
+        prev = c;
+    }
+    if (emit(result, buffer, pos, 1) < 0)
+        goto error;
+    PyMem_Free(buffer);
+    return result;
+
+error:
+    PyMem_Free(buffer);
+    Py_XDECREF(result);
+    return NULL;
+}
+
+
+static PyMethodDef methods[] = {
+    {"configure", configure, METH_VARARGS,
+     "configure(tagclass, regex): the Tag class and machine tag regex of "
+     "the fast path."},
+    {"tags", tags, METH_VARARGS,
+     "tags(strtags, tagclass): parsed and deduplicated tags."},
+    {"flickr_tokens", flickr_tokens, METH_VARARGS,
+     "flickr_tokens(tagstr, separator, quote, escape): the raw tokens of a "
+     "stripped flickr-like tag string."},
+    {NULL, NULL, 0, NULL}
+};
+
+
+static struct PyModuleDef module = {
+    PyModuleDef_HEAD_INIT, "_tagtools", "C accelerator for tagtools.", -1,
+    methods
+};
+
+
+PyMODINIT_FUNC
+PyInit__tagtools(void)
+{
+#define INTERN(var, name) \
+    if ((var = PyUnicode_InternFromString(name)) == NULL) return NULL
+    INTERN(s_raw, "raw");
+    INTERN(s_clean, "clean");
+    INTERN(s_is_machinetag, "is_machinetag");
+    INTERN(s_namespace, "namespace");
+    INTERN(s_predicate, "predicate");
+    INTERN(s_value, "value");
+    INTERN(s_strip, "strip");
+    INTERN(s_lower, "lower");
+    INTERN(s_groups, "groups");
+#undef INTERN
+    empty_tuple = PyTuple_New(0);
+    if (empty_tuple == NULL)
+        return NULL;
+    return PyModule_Create(&module);
+}
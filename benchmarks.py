@@ -0,0 +1,863 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Benchmarks for tagtools.py
+
+Run all the benchmarks with::
+
+    python benchmarks.py
+
+or only some of them with::
+
+    python benchmarks.py flickr_scaling
+
+The regression suite runs str2tags and tags2str of every tokenizer on a
+synthetic corpus, saves the results as JSON and compares them with a
+baseline::
+
+    python benchmarks.py suite --size 20000 --machine-share 0.3
+
+The results and the baseline are stored in ``.benchmarks/`` next to this
+file (``results.json`` and ``baseline.json``, ignored by git). The first
+run, or a run with ``--update-baseline``, stores the baseline.
+
+Run ``python benchmarks.py --help`` for all the options.
+"""
+
+import argparse
+import asyncio
+import io
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+
+from tagtools import FlickrTokenizer, DeliciousTokenizer, CommaTokenizer, \
+                     TagWithSeparatorException, Tag, CompactTag, LazyTag, \
+                     TagCache, Normalizer, LOWERCASE, CASEFOLD, NFKC, \
+                     STRIP_ACCENTS, COLLAPSE_SPACES, TagVocabulary, \
+                     TagIndex, MachineTagStore, Offloader, Profiler, \
+                     Dialect, TagCompleter, TagClusterer, TagStats, \
+                     fingerprint
+
+
+BENCHMARKS = []
+
+# where the regression suite stores its results and baseline
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           '.benchmarks')
+
+
+def benchmark(func):
+    "Registers a benchmark function."
+    BENCHMARKS.append(func)
+    return func
+
+
+def timeit(func, *args):
+    "Returns the best wall time of a few runs of func(*args), in seconds."
+    best = None
+    for i in range(3):
+        start = time.perf_counter()
+        func(*args)
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def quoted_flickr_str(size):
+    "A flickr tag string of about `size` chars, full of quoted tags."
+    chunk = 'Tag1 "tag number %d" ta"g"3 '
+    parts, length, i = [], 0, 0
+    while length < size:
+        part = chunk % i
+        parts.append(part)
+        length += len(part)
+        i += 1
+    return ''.join(parts)[:size]
+
+
+@benchmark
+def flickr_scaling():
+    "FlickrTokenizer.str2tags must scale linearly up to 1MB inputs."
+    print('%10s %12s %14s' % ('bytes', 'seconds', 'usec/kbyte'))
+    size = 1024
+    while size <= 1024 * 1024:
+        tagstr = quoted_flickr_str(size)
+        elapsed = timeit(FlickrTokenizer.str2tags, tagstr)
+        print('%10d %12.6f %14.2f' % (size, elapsed,
+                                      elapsed * 1e6 / (size / 1024.0)))
+        size *= 4
+
+
+def tagstr_corpus(tokenizer, count):
+    "`count` short tag strings in the format used by `tokenizer`."
+    space = {False: '_'}.get(tokenizer.TAGS_WITH_SPACES, ' ')
+    return [tokenizer.tags2str(['tag%d' % (i % 97),
+                                'Tag%s%d' % (space, i % 13),
+                                'geo:lat=%d' % i, 'TAG%d' % (i % 97)])
+            for i in range(count)]
+
+
+def throughput(func, count):
+    "Prints the number of tag strings per second parsed by func."
+    elapsed = timeit(func)
+    print('  %-24s %12.0f strings/sec' % (func.__name__, count / elapsed))
+
+
+@benchmark
+def str2tags_many():
+    "Tokenizer.str2tags_many against a loop over Tokenizer.str2tags."
+    count = 100000
+    for tokenizer in (FlickrTokenizer, DeliciousTokenizer, CommaTokenizer):
+        corpus = tagstr_corpus(tokenizer, count)
+
+        def str2tags_loop():
+            return [tokenizer.str2tags(tagstr) for tagstr in corpus]
+
+        def str2tags_many():
+            return list(tokenizer.str2tags_many(corpus))
+
+        print(tokenizer.__name__)
+        throughput(str2tags_loop, count)
+        throughput(str2tags_many, count)
+
+
+@benchmark
+def str2tags_parallel():
+    "Tokenizer.str2tags_many scaling with the number of worker processes."
+    count = 200000
+    corpus = tagstr_corpus(FlickrTokenizer, count)
+    cpus = os.cpu_count() or 1
+    print('  %d CPUs available' % cpus)
+    workers = 1
+    while True:
+        def parse():
+            for tags in FlickrTokenizer.str2tags_many(
+                    corpus, workers=workers, chunksize=5000):
+                pass
+        parse.__name__ = 'workers=%d' % workers
+        throughput(parse, count)
+        if workers >= cpus:
+            break
+        workers = min(workers * 2, cpus)
+
+
+@benchmark
+def tag_memory():
+    "Bytes per tag of Tag against CompactTag, measured with tracemalloc."
+    count = 100000
+    rawtags = [('tag%d' % i, 'geo:lat=%d' % i) for i in range(count)]
+    for tagclass in (Tag, CompactTag):
+        for name, index in (('plain', 0), ('machine', 1)):
+            raws = [raw[index] for raw in rawtags]
+            tracemalloc.start()
+            before = tracemalloc.get_traced_memory()[0]
+            tags = [tagclass(raw) for raw in raws]
+            after = tracemalloc.get_traced_memory()[0]
+            tracemalloc.stop()
+            print('  %-12s %-8s %8.1f bytes/tag' % (
+                tagclass.__name__, name, (after - before) / float(count)))
+            del tags
+
+
+@benchmark
+def lazy_tag():
+    "str2tags with eager Tag against LazyTag, only reading .clean."
+    count = 100000
+    corpus = [CommaTokenizer.tags2str(['geo:lat=%d' % i, 'geo:lon=%d' % i,
+                                       'upload:by=u%d' % (i % 7),
+                                       'tag%d' % (i % 97)])
+              for i in range(count)]
+    for tagclass in (Tag, LazyTag):
+        tokenizer = type('Tokenizer', (CommaTokenizer,),
+                         {'TAGCLASS': tagclass})
+
+        def parse():
+            for tags in tokenizer.str2tags_many(corpus):
+                for tag in tags:
+                    tag.clean
+        parse.__name__ = tagclass.__name__
+        throughput(parse, count)
+
+
+@benchmark
+def tag_cache():
+    "str2tags with and without a TagCache on repetitive input."
+    count = 100000
+    corpus = tagstr_corpus(FlickrTokenizer, 2000) * (count // 2000)
+    cached = type('Tokenizer', (FlickrTokenizer,),
+                  {'CACHE': TagCache(maxsize=4096)})
+    for tokenizer in (FlickrTokenizer, cached):
+        def parse():
+            for tagstr in corpus:
+                tokenizer.str2tags(tagstr)
+        parse.__name__ = tokenizer.CACHE and 'cached' or 'uncached'
+        throughput(parse, count)
+
+
+@benchmark
+def convert_file():
+    "Flickr to comma conversion of a newline delimited file."
+    count = 200000
+    fd, path = tempfile.mkstemp()
+    try:
+        os.write(fd, '\n'.join(tagstr_corpus(FlickrTokenizer, count))
+                 .encode('utf-8'))
+        os.close(fd)
+
+        def convert():
+            FlickrTokenizer.convert_file(path, io.StringIO(), CommaTokenizer)
+        throughput(convert, count)
+    finally:
+        os.remove(path)
+
+
+@benchmark
+def normalizer():
+    "Normalizer stages on ASCII and non ASCII tags, with and without memo."
+    count = 100000
+    words = {
+        'ascii': ['Tag  Number %d' % (i % 1000) for i in range(count)],
+        'unicode': ['Tâg  Ñúmber %d' % (i % 1000) for i in range(count)],
+    }
+    stages = [('lowercase', [LOWERCASE]), ('casefold', [CASEFOLD]),
+              ('nfkc', [NFKC]), ('strip_accents', [STRIP_ACCENTS]),
+              ('collapse_spaces', [COLLAPSE_SPACES]),
+              ('all', [NFKC, CASEFOLD, STRIP_ACCENTS, COLLAPSE_SPACES])]
+    for kind in ('ascii', 'unicode'):
+        print(kind)
+        for name, pipeline in stages:
+            for maxsize in (0, 4096):
+                normalize = Normalizer(pipeline, maxsize=maxsize)
+
+                def run():
+                    for word in words[kind]:
+                        normalize(word)
+                run.__name__ = '%s%s' % (name, maxsize and ' memo' or '')
+                elapsed = timeit(run)
+                print('  %-24s %12.0f tags/sec' % (run.__name__,
+                                                    count / elapsed))
+
+
+@benchmark
+def str2tags_column():
+    "CommaTokenizer.str2tags_column against a str2tags loop (NumPy)."
+    try:
+        import numpy
+    except ImportError:
+        print('  skipped, NumPy is not installed')
+        return
+    count = 200000
+    column = numpy.array(tagstr_corpus(CommaTokenizer, count), dtype=object)
+
+    def str2tags_loop():
+        return [CommaTokenizer.str2tags(tagstr) for tagstr in column]
+
+    def str2tags_column():
+        return CommaTokenizer.str2tags_column(column)
+
+    throughput(str2tags_loop, count)
+    throughput(str2tags_column, count)
+
+
+@benchmark
+def vocabulary():
+    "Tokenizer.str2ids against str2tags, and TagVocabulary load time."
+    count = 100000
+    corpus = tagstr_corpus(CommaTokenizer, count)
+    vocab = TagVocabulary()
+
+    def str2tags_loop():
+        return [CommaTokenizer.str2tags(tagstr) for tagstr in corpus]
+
+    def str2ids_loop():
+        return [CommaTokenizer.str2ids(tagstr, vocab) for tagstr in corpus]
+
+    throughput(str2tags_loop, count)
+    throughput(str2ids_loop, count)
+
+    vocab = TagVocabulary()
+    for i in range(count * 10):
+        vocab.add('tag %d' % i, 'Tag %d' % i)
+    fileobj = io.BytesIO()
+    vocab.save(fileobj)
+    elapsed = timeit(lambda: TagVocabulary.load(io.BytesIO(
+        fileobj.getvalue())))
+    print('  load %d tags (%d bytes) in %.3f seconds' % (
+        len(vocab), len(fileobj.getvalue()), elapsed))
+
+
+@benchmark
+def tag_index():
+    "TagIndex with 10M postings: build time and query latency."
+    items, per_item, vocabulary = 1000000, 10, 50000
+    rnd = random.Random(0)
+
+    def pairs():
+        for item_id in range(items):
+            # skewed tag popularity, plus a machine tag per item
+            tags = ['tag%d' % int(vocabulary * rnd.random() ** 3)
+                    for i in range(per_item - 1)]
+            tags.append('geo:lat=%d' % (item_id % 180))
+            yield item_id, CommaTokenizer.tags2str(tags)
+
+    index = TagIndex(CommaTokenizer)
+    start = time.perf_counter()
+    index.add_many(pairs())
+    elapsed = time.perf_counter() - start
+    postings = sum([len(docids) for docids in index.postings.values()])
+    print('  indexed %d items, %d postings in %.1f seconds' % (
+        items, postings, elapsed))
+
+    queries = [
+        ('and', lambda: index.search(include=['tag0', 'tag1'])),
+        ('and not', lambda: index.search(include=['tag0'],
+                                         exclude=['tag1'])),
+        ('or', lambda: index.search(either=['tag100', 'tag200'])),
+        ('prefix', lambda: index.search(include=['tag4999*'])),
+        ('machine tag', lambda: index.search(include=['geo:lat=*'],
+                                             exclude=['tag0'])),
+        ('cooccurring', lambda: index.cooccurring('tag1000')),
+        ('update', lambda: index.add(0, 'tag1, tag2, geo:lat=1')),
+    ]
+    for name, query in queries:
+        print('  %-24s %12.6f seconds' % (name, timeit(query)))
+
+
+@benchmark
+def machinetag_store():
+    "MachineTagStore queries against a linear scan of 1M machine tags."
+    count = 1000000
+    rnd = random.Random(0)
+    tags = [Tag('%s:%s=%.3f' % (rnd.choice(['geo', 'exif', 'upload']),
+                                rnd.choice(['lat', 'lon', 'by', 'iso']),
+                                rnd.uniform(-90, 90)))
+            for i in range(count)]
+    store = MachineTagStore()
+    start = time.perf_counter()
+    for item, tag in enumerate(tags):
+        store.add(tag, item)
+    print('  stored %d tags in %.1f seconds' % (
+        count, time.perf_counter() - start))
+
+    def scan():
+        return [tag for tag in tags if tag.predicate == 'lat' and
+                10 <= float(tag.value) <= 11]
+
+    queries = [
+        ('scan *:lat= 10..11', scan),
+        ('between geo:lat 10..11',
+         lambda: store.between('geo', 'lat', 10, 11)),
+        ('query geo:lat=', lambda: store.query('geo:lat=')),
+        ('query *:lat=1.000', lambda: store.query('*:lat=1.000')),
+    ]
+    for name, query in queries:
+        print('  %-24s %12.6f seconds' % (name, timeit(query)))
+
+
+@benchmark
+def incremental_diff():
+    "Tokenizer.diff on a one character edit of a 1000 tag string."
+    tags = ['tag number %d' % i for i in range(1000)]
+    old = CommaTokenizer.tags2str(tags)
+    tags[500] = 'tag number 500x'
+    new = CommaTokenizer.tags2str(tags)
+    parsed = CommaTokenizer.parse(old)
+
+    def full():
+        return CommaTokenizer.diff(old, new)
+
+    def incremental():
+        return CommaTokenizer.diff(parsed, new)
+
+    for func in (full, incremental):
+        print('  %-24s %12.6f seconds' % (func.__name__, timeit(func)))
+
+
+def tags2str_reference(tokenizer, tags):
+    "The original Tokenizer.tags2str, used as a reference."
+    results = []
+    for tag in tags:
+        if tokenizer.SEPARATOR in tag:
+            raise TagWithSeparatorException(
+                "Tag can't include the separator: '%s'" % tag)
+        results.append(tag)
+    return tokenizer.JOINER.join(results)
+
+
+def flickr_tags2str_reference(tags):
+    "The original FlickrTokenizer.tags2str, used as a reference."
+    return ' '.join([{True: '"%s"', False: '%s'}[' ' in tag] % tag
+                     for tag in tags])
+
+
+@benchmark
+def tags2str():
+    "tags2str and tags2str_many against the original implementation."
+    count = 50000
+    for tokenizer in (FlickrTokenizer, DeliciousTokenizer, CommaTokenizer):
+        if tokenizer is FlickrTokenizer:
+            reference = flickr_tags2str_reference
+        else:
+            reference = lambda tags: tags2str_reference(tokenizer, tags)
+        space = {False: '_'}.get(tokenizer.TAGS_WITH_SPACES, ' ')
+        for size in (4, 50):
+            taglists = [['tag%s%d' % (space, (i + j) % 1000)
+                         for j in range(size)] for i in range(count)]
+
+            def original():
+                return [reference(tags) for tags in taglists]
+
+            def tags2str_loop():
+                return [tokenizer.tags2str(tags) for tags in taglists]
+
+            def tags2str_many():
+                return list(tokenizer.tags2str_many(taglists))
+
+            print('%s, %d tags' % (tokenizer.__name__, size))
+            throughput(original, count)
+            throughput(tags2str_loop, count)
+            throughput(tags2str_many, count)
+
+
+# process pools need tokenizers that can be pickled
+class ThreadsCommaTokenizer(CommaTokenizer):
+    pass
+
+
+class ProcessesCommaTokenizer(CommaTokenizer):
+    pass
+
+
+@benchmark
+def offloader():
+    "Worst event loop stall while parsing big payloads, inline or offloaded."
+    payloads = [CommaTokenizer.tags2str(['tag %d' % i for i in range(20000)])
+                for j in range(20)]
+    ThreadsCommaTokenizer.OFFLOADER = Offloader(threshold=4096)
+    ProcessesCommaTokenizer.OFFLOADER = Offloader(
+        threshold=4096, executor=ProcessPoolExecutor(1))
+
+    async def run(tokenizer):
+        stalls = []
+
+        async def ticker():
+            while True:
+                start = time.perf_counter()
+                await asyncio.sleep(0.001)
+                stalls.append(time.perf_counter() - start - 0.001)
+        task = asyncio.ensure_future(ticker())
+        await asyncio.sleep(0.01)
+        start = time.perf_counter()
+        async for tags in tokenizer.astr2tags_many(payloads):
+            pass
+        elapsed = time.perf_counter() - start
+        task.cancel()
+        return elapsed, max(stalls)
+
+    for name, tokenizer in (('inline', CommaTokenizer),
+                            ('threads', ThreadsCommaTokenizer),
+                            ('processes', ProcessesCommaTokenizer)):
+        elapsed, stall = asyncio.run(run(tokenizer))
+        print('  %-12s total %.3f seconds, worst stall %.4f seconds' % (
+            name, elapsed, stall))
+        if tokenizer.OFFLOADER:
+            print('  %r' % tokenizer.OFFLOADER.metrics())
+            tokenizer.OFFLOADER.executor.shutdown()
+
+
+@benchmark
+def profiler():
+    "Cost of str2tags with no profiler, and with sampled profiling."
+    tagstrs = tagstr_corpus(FlickrTokenizer, 100000)
+
+    def run(tokenizer):
+        for tagstr in tagstrs:
+            tokenizer.str2tags(tagstr)
+
+    base = timeit(run, FlickrTokenizer)
+    print('  %-12s %.3f seconds' % ('disabled', base))
+    for sample in (100, 10, 1):
+        instance = Profiler(sample=sample)
+        with instance.enable(FlickrTokenizer):
+            elapsed = timeit(run, FlickrTokenizer)
+        print('  sample=%-5d %.3f seconds (%+.1f%%)' % (
+            sample, elapsed, (elapsed / base - 1) * 100))
+    timers = instance.timers
+    print('  stages: %s' % ', '.join([
+        '%s %.0f%%' % (name, timers[name] / timers['total'] * 100)
+        for name in Profiler.TIMERS if name != 'total']))
+
+
+@benchmark
+def dialect():
+    "Compiled dialects against the hand-written tokenizers."
+    for builtin, spec in ((FlickrTokenizer, Dialect(' ', quote='"')),
+                          (DeliciousTokenizer, Dialect(' ')),
+                          (CommaTokenizer, Dialect(',', joiner=', '))):
+        compiled = spec.compile('Compiled' + builtin.__name__)
+        tagstrs = tagstr_corpus(builtin, 50000)
+        print(builtin.__name__)
+        for name, tokenizer in (('hand_written', builtin),
+                                ('compiled', compiled)):
+            def run(tokenizer=tokenizer):
+                return list(tokenizer.str2tags_many(tagstrs))
+            run.__name__ = name
+            throughput(run, len(tagstrs))
+    escaped = Dialect(',', joiner=', ', quote="'", escape='\\').compile()
+    tagstrs = [escaped.tags2str(["it's", 'a, b', 'tag%d' % i])
+               for i in range(50000)]
+
+    def quotes_and_escapes():
+        return list(escaped.str2tags_many(tagstrs))
+    print('Dialect with quotes and escapes')
+    throughput(quotes_and_escapes, len(tagstrs))
+
+
+@benchmark
+def speedups():
+    "str2tags with the C accelerator against the pure Python code."
+    import tagtools
+    if tagtools._speedups is None:
+        print('  the C accelerator is not built, run:')
+        print('  python setup.py build_ext --inplace')
+        return
+    backends = (('python', None), ('c', tagtools._speedups))
+    for tokenizer in (FlickrTokenizer, DeliciousTokenizer, CommaTokenizer):
+        print(tokenizer.__name__)
+        corpora = (('short', tagstr_corpus(tokenizer, 50000)),
+                   ('quoted', [quoted_flickr_str(200)] * 500))
+        for corpus, tagstrs in corpora:
+            if corpus == 'quoted' and tokenizer is not FlickrTokenizer:
+                continue
+            rates = []
+            for backend, module in backends:
+                tagtools._speedups = module
+
+                def run():
+                    for tagstr in tagstrs:
+                        tokenizer.str2tags(tagstr)
+                rates.append(len(tagstrs) / timeit(run))
+            tagtools._speedups = backends[1][1]
+            print('  %-8s python %8.0f  c %8.0f strings/sec  (x%.2f)' % (
+                corpus, rates[0], rates[1], rates[1] / rates[0]))
+
+
+@benchmark
+def completer():
+    "TagCompleter against filtering the tag counts on every keystroke."
+    rnd = random.Random(0)
+    words = ['%s%d' % (rnd.choice(['py', 'photo', 'travel', 'geo:lat=']),
+                       rnd.randint(0, 200000)) for i in range(500000)]
+    instance = TagCompleter(CommaTokenizer)
+    start = time.perf_counter()
+    for i in range(0, len(words), 10):
+        instance.add(', '.join(words[i:i + 10]))
+    print('  %-28s %.3f seconds, %d tags' % (
+        'build', time.perf_counter() - start, len(instance)))
+    start = time.perf_counter()
+    instance.complete('p')
+    print('  %-28s %.3f seconds' % (
+        'first query (sorts)', time.perf_counter() - start))
+    fileobj = io.BytesIO()
+    instance.save(fileobj)
+    fileobj.seek(0)
+    start = time.perf_counter()
+    TagCompleter.load(fileobj, CommaTokenizer)
+    print('  %-28s %.3f seconds, %d bytes' % (
+        'load snapshot', time.perf_counter() - start,
+        len(fileobj.getvalue())))
+
+    counts = Counter(word.lower() for word in words)
+
+    def brute_force(prefix):
+        return sorted([(-count, clean) for clean, count in counts.items()
+                       if clean.startswith(prefix)])[:10]
+
+    keystrokes = ['p', 'ph', 'pho', 'photo1', 'geo:', 'travel12', 'x']
+    for name, func in (('brute_force', brute_force),
+                       ('complete', instance.complete)):
+        start = time.perf_counter()
+        for prefix in keystrokes:
+            func(prefix)
+        print('  %-28s %.3f ms per keystroke' % (
+            name, (time.perf_counter() - start) / len(keystrokes) * 1000))
+
+
+@benchmark
+def clusterer():
+    "TagClusterer on a vocabulary of a million tags with near-duplicates."
+    rnd = random.Random(0)
+    letters = 'abcdefghijklmnopqrstuvwxyz'
+    counts = Counter()
+    while len(counts) < 1000000:
+        word = ''.join([rnd.choice(letters)
+                        for i in range(rnd.randint(4, 14))])
+        counts[word] += rnd.randint(1, 100)
+        if rnd.random() < 0.2:
+            # a variant: split in two words, or a typo
+            pos = rnd.randint(1, len(word) - 1)
+            if rnd.random() < 0.5:
+                word = word[:pos] + rnd.choice(' -') + word[pos:]
+            else:
+                word = word[:pos] + word[pos + 1:]
+            counts[word] += 1
+    start = time.perf_counter()
+    mapping = TagClusterer().cluster(counts)
+    print('  %d tags, %d mapped to a canonical tag in %.1f seconds' % (
+        len(counts), len(mapping), time.perf_counter() - start))
+
+
+@benchmark
+def tag_stats():
+    "TagStats against exact Counters, on a long tail of tags."
+    rnd = random.Random(0)
+    tagstrs = [', '.join(['tag%d' % int(rnd.paretovariate(0.6))
+                          for j in range(8)] + ['geo:lat=%d' % j])
+               for j in range(200000)]
+
+    def exact():
+        counts, namespaces = Counter(), Counter()
+        for tagstr in tagstrs:
+            for tag in CommaTokenizer.str2tags(tagstr):
+                counts[tag.clean] += 1
+                if tag.is_machinetag:
+                    namespaces[tag.namespace] += 1
+        return counts
+
+    def sketches():
+        stats = TagStats(CommaTokenizer, capacity=1000)
+        stats.add_many(tagstrs)
+        return stats
+
+    for name, func in (('exact', exact), ('sketches', sketches)):
+        # tracing slows down every allocation, time an untraced run
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        tracemalloc.start()
+        result = func()
+        size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        print('  %-12s %.2f seconds, %8.1f MiB retained' % (
+            name, elapsed, size / 1048576.0))
+        if name == 'exact':
+            counts = result
+        else:
+            stats = result
+    print('  distinct: %d exact, %d estimated' % (len(counts),
+                                                  stats.distinct()))
+    best = set([tag for tag, count in counts.most_common(100)])
+    print('  top 100: %d%% found' % len(
+        best & set([tag for tag, count in stats.top(100)])))
+
+
+
+@benchmark
+def fingerprints():
+    "Tokenizer.str2fingerprint against str2tags and list comparisons."
+    count = 100000
+    for tokenizer in TOKENIZERS:
+        print('  %s' % tokenizer.__name__)
+        corpus = tagstr_corpus(tokenizer, count)
+
+        def compare_tags():
+            return [[tag.clean for tag in tokenizer.str2tags(tagstr)] ==
+                    [tag.clean for tag in tokenizer.str2tags(tagstr)]
+                    for tagstr in corpus]
+
+        def fingerprint_tags():
+            return [fingerprint(tokenizer.str2tags(tagstr))
+                    for tagstr in corpus]
+
+        def str2fingerprint():
+            return [tokenizer.str2fingerprint(tagstr) for tagstr in corpus]
+
+        throughput(compare_tags, count)
+        throughput(fingerprint_tags, count)
+        throughput(str2fingerprint, count)
+
+
+TOKENIZERS = (FlickrTokenizer, DeliciousTokenizer, CommaTokenizer)
+
+
+def suite_corpus(tokenizer, options):
+    """ Synthetic tag lists for the regression suite.
+
+    Every tag is a duplicate (with another case) of a previous tag of the
+    list with probability `dup_ratio`, a machine tag with probability
+    `machine_share`, and has a space (quoted by flickr) with probability
+    `quote_density`.
+    """
+    rnd = random.Random(options.seed)
+    space = {False: '_'}.get(tokenizer.TAGS_WITH_SPACES, ' ')
+    taglists = []
+    for i in range(options.size):
+        tags = []
+        for j in range(options.tags):
+            if tags and rnd.random() < options.dup_ratio:
+                tags.append(rnd.choice(tags).upper())
+            elif rnd.random() < options.machine_share:
+                tags.append('%s:%s=%d' % (rnd.choice(['geo', 'exif']),
+                                          rnd.choice(['lat', 'lon', 'iso']),
+                                          rnd.randint(0, 1000)))
+            elif rnd.random() < options.quote_density:
+                tags.append('Tag%s%d' % (space, rnd.randint(0, 10000)))
+            else:
+                tags.append('tag%d' % rnd.randint(0, 10000))
+        taglists.append(tags)
+    return taglists
+
+
+def measure(func, inputs):
+    "Runs func on every input, returns the stats of the calls."
+    clock, latencies = time.perf_counter, []
+    append = latencies.append
+    for value in inputs:
+        start = clock()
+        func(value)
+        append(clock() - start)
+    latencies.sort()
+    total = sum(latencies)
+    tracemalloc.start()
+    for value in inputs:
+        func(value)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {
+        'ops_per_sec': len(inputs) / total,
+        'p50_us': latencies[len(latencies) // 2] * 1e6,
+        'p99_us': latencies[int(len(latencies) * 0.99)] * 1e6,
+        'peak_kib': peak / 1024.0,
+    }
+
+
+def run_suite(options):
+    "Runs the regression suite, returns the results."
+    results = {}
+    for tokenizer in TOKENIZERS:
+        taglists = suite_corpus(tokenizer, options)
+        tagstrs = [tokenizer.tags2str(tags) for tags in taglists]
+        for name, func, inputs in (('str2tags', tokenizer.str2tags, tagstrs),
+                                   ('tags2str', tokenizer.tags2str,
+                                    taglists)):
+            # warm up, then keep the best of the runs
+            func(inputs[0])
+            best = None
+            for i in range(options.repeat):
+                stats = measure(func, inputs)
+                if best is None or stats['ops_per_sec'] > \
+                        best['ops_per_sec']:
+                    best = stats
+            results['%s.%s' % (tokenizer.__name__, name)] = best
+    return {
+        'meta': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'size': options.size, 'tags': options.tags,
+            'dup_ratio': options.dup_ratio,
+            'quote_density': options.quote_density,
+            'machine_share': options.machine_share,
+            'seed': options.seed,
+        },
+        'results': results,
+    }
+
+
+def compare(results, baseline, threshold):
+    """ Prints the results next to the baseline, returns the names of the
+    benchmarks that regressed more than `threshold` (a fraction) in
+    ops/sec or peak memory.
+    """
+    regressions = []
+    print('%-32s %12s %9s %9s %10s %8s' % (
+        'benchmark', 'ops/sec', 'p50 us', 'p99 us', 'peak KiB', 'change'))
+    for name, stats in sorted(results['results'].items()):
+        old = baseline and baseline['results'].get(name)
+        change = ''
+        if old:
+            ratio = stats['ops_per_sec'] / old['ops_per_sec'] - 1
+            change = '%+.1f%%' % (ratio * 100)
+            if ratio < -threshold or \
+                    stats['peak_kib'] > old['peak_kib'] * (1 + threshold):
+                regressions.append(name)
+                change += ' !'
+        print('%-32s %12.0f %9.2f %9.2f %10.1f %8s' % (
+            name, stats['ops_per_sec'], stats['p50_us'], stats['p99_us'],
+            stats['peak_kib'], change))
+    return regressions
+
+
+def suite(options):
+    "Runs the regression suite, returns the process exit status."
+    results = run_suite(options)
+    baseline = None
+    if os.path.exists(options.baseline) and not options.update_baseline:
+        baseline = json.load(open(options.baseline))
+        if baseline['meta'] != dict(results['meta'],
+                                    python=baseline['meta']['python'],
+                                    platform=baseline['meta']['platform']):
+            print('warning: the baseline was run with other parameters')
+    regressions = compare(results, baseline, options.threshold)
+    for path in (options.output, options.baseline):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+    json.dump(results, open(options.output, 'w'), indent=2, sort_keys=True)
+    print('results saved to %s' % options.output)
+    if baseline is None:
+        json.dump(results, open(options.baseline, 'w'), indent=2,
+                  sort_keys=True)
+        print('baseline saved to %s' % options.baseline)
+    if regressions:
+        print('regressions (threshold %.0f%%): %s' % (
+            options.threshold * 100, ', '.join(regressions)))
+        return 1
+    return 0
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='tagtools benchmarks')
+    parser.add_argument('names', nargs='*', help=(
+        'benchmarks to run, or "suite" for the regression suite: %s' %
+        ', '.join([func.__name__ for func in BENCHMARKS])))
+    group = parser.add_argument_group('regression suite')
+    group.add_argument('--size', type=int, default=20000,
+                       help='tag strings per tokenizer')
+    group.add_argument('--tags', type=int, default=8,
+                       help='tags per tag string')
+    group.add_argument('--dup-ratio', type=float, default=0.2)
+    group.add_argument('--quote-density', type=float, default=0.1)
+    group.add_argument('--machine-share', type=float, default=0.1)
+    group.add_argument('--seed', type=int, default=0)
+    group.add_argument('--repeat', type=int, default=3)
+    group.add_argument('--output',
+                       default=os.path.join(RESULTS_DIR, 'results.json'))
+    group.add_argument('--baseline',
+                       default=os.path.join(RESULTS_DIR, 'baseline.json'))
+    group.add_argument('--update-baseline', action='store_true',
+                       help='overwrite the baseline with this run')
+    group.add_argument('--threshold', type=float, default=0.1,
+                       help='allowed regression, as a fraction')
+    options = parser.parse_args(argv)
+    names = options.names
+    if 'suite' in names:
+        return suite(options)
+    for func in BENCHMARKS:
+        if names and func.__name__ not in names:
+            continue
+        print('== %s: %s' % (func.__name__, func.__doc__))
+        func()
+        print('')
+    return 0
+
+
+if __name__ == '__main__':  # pragma: no cover
+    sys.exit(main(sys.argv[1:]))
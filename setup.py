@@ -1,7 +1,10 @@
 #!/usr/bin/env python
 
 import os
-from distutils.core import setup
+try:
+    from setuptools import setup, Extension
+except ImportError:
+    from distutils.core import setup, Extension
 
 version = '0.8d'
 
@@ -10,13 +13,13 @@ classifiers = [
     "Intended Audience :: Developers",
     "License :: OSI Approved :: Apache Software License",
     "Programming Language :: Python",
-    "Programming Language :: Python :: 2.4",
-    "Programming Language :: Python :: 2.5",
-    "Programming Language :: Python :: 2.6",
-    "Programming Language :: Python :: 2.7",
     "Programming Language :: Python :: 3",
-    "Programming Language :: Python :: 3.0",
-    "Programming Language :: Python :: 3.1",
+    "Programming Language :: Python :: 3 :: Only",
+    "Programming Language :: Python :: 3.7",
+    "Programming Language :: Python :: 3.8",
+    "Programming Language :: Python :: 3.9",
+    "Programming Language :: Python :: 3.10",
+    "Programming Language :: Python :: 3.11",
     "Operating System :: OS Independent",
     "Topic :: Software Development :: Libraries",
 ]
@@ -34,6 +37,11 @@ setup(
     author_email='tabo@tabo.pe',
     license='Apache License 2.0',
     py_modules=['tagtools'],
+    python_requires='>=3.7',
+    # Tokenizer.str2tags_column needs NumPy
+    extras_require={'numpy': ['numpy']},
+    # optional C accelerator, tagtools.py works without it
+    ext_modules=[Extension('_tagtools', ['_tagtools.c'], optional=True)],
     description='Python helpers to work with tags.',
     classifiers=classifiers,
     long_description=long_desc,
@@ -1,7 +1,34 @@
+import hashlib
+import math
+import mmap
+import os
 import re
+import struct
+import sys
+import threading
+import time
+import unicodedata
+import zlib
+from array import array
+from bisect import bisect_left, bisect_right, insort
+from collections import Counter, OrderedDict, deque
+from contextlib import contextmanager
+from functools import lru_cache
+from heapq import heappop, heappush, heapreplace
+from itertools import accumulate, chain, islice
+from weakref import WeakKeyDictionary
 
 __version__ = '0.8d'
 
+# optional C accelerator, see _tagtools.c
+if os.environ.get('TAGTOOLS_NO_SPEEDUPS'):
+    _speedups = None
+else:
+    try:
+        import _tagtools as _speedups
+    except ImportError:
+        _speedups = None
+
 RE_MACHINE_TAG = re.compile(r"""
                             ^                   # begin
                             ([a-z][a-z0-9_]*)   # namespace
@@ -11,6 +38,249 @@ RE_MACHINE_TAG = re.compile(r"""
                             (.+)                # value
                             $                   # the end """, re.VERBOSE)
 
+# flickr style machine tag queries: ns:pred=value, any part can be * or empty
+RE_MACHINE_TAG_QUERY = re.compile(r"""
+                            ^                           # begin
+                            ([a-z][a-z0-9_]*|\*)?       # namespace
+                            \:                          # separator
+                            ([a-z][a-z0-9_]*|\*)?       # predicate
+                            (?:\=(.*))?                 # value
+                            $                           # the end """,
+                            re.VERBOSE)
+
+# runs of plain characters, spaces or double quotes in a flickr tag string
+RE_FLICKR_RUN = re.compile(r'[^" ]+| +|"+')
+
+
+class _FlickrScanner(object):
+    """ Resumable state machine behind the flickr tokenizer.
+
+    Walks the input once, a run of same-class characters at a time, so it
+    takes linear time even with lots of quotes. A space that follows a
+    quote inside a quoted tag closes the tag only if there are no more
+    quotes in the rest of the input, just like flickr does.
+
+    Other dialects can use other separator and quote characters, and an
+    escape character that makes the next character literal. Pass their
+    precompiled :func:`_scanner_run` regex as `run`, it is compiled here
+    otherwise.
+    """
+
+    def __init__(self, separator=' ', quote='"', escape=None, run=None):
+        self.separator, self.quote, self.escape = separator, quote, escape
+        if run is not None:
+            self.run = run
+        elif (separator, quote, escape) == (' ', '"', None):
+            self.run = RE_FLICKR_RUN
+        else:
+            self.run = _scanner_run(separator, quote, escape)
+        self.parts, self.prev, self.quoted = [], '', False
+
+    def feed(self, text, lastquote):
+        """ Yields the raw tokens closed in `text`. The generator must be
+        exhausted before feeding more text.
+
+        :param lastquote: Position of the last quote of the whole input,
+                          relative to the start of `text`.
+        """
+        separator, quote, escape = self.separator, self.quote, self.escape
+        parts, prev, quoted = self.parts, self.prev, self.quoted
+        for match in self.run.finditer(text):
+            run = match.group()
+            char = run[0]
+            if char == quote:
+                if len(run) % 2:
+                    quoted = not quoted
+            elif char == separator and \
+                    (not quoted or \
+                    (prev == quote and match.start() > lastquote)):
+                if parts:
+                    # only the first space closes the tag, the rest are
+                    # ignored
+                    quoted = False
+                    yield ''.join(parts)
+                    parts = []
+                elif quoted and len(run) > 1:
+                    # no tag to close, the remaining spaces are still quoted
+                    parts.append(run[1:])
+            elif char == escape and len(run) > 1:
+                parts.append(run[1])
+            else:
+                parts.append(run)
+            prev = char
+        self.parts, self.prev, self.quoted = parts, prev, quoted
+
+    def close(self):
+        "Returns the last (stripped) token, once all the input was fed."
+        tok = ''.join(self.parts).strip()
+        self.parts = []
+        return tok
+
+    def lastquote(self, text):
+        "Returns the position of the last (unescaped) quote in `text`."
+        if self.escape is None:
+            return text.rfind(self.quote) if self.quote else -1
+        last, quote = -1, self.quote
+        for match in self.run.finditer(text):
+            if match.group()[0] == quote:
+                last = match.end() - 1
+        return last
+
+
+def _scanner_run(separator, quote, escape):
+    "Compiles the regex with the runs of a quoted or escaped dialect."
+    special = separator + (quote or '') + (escape or '')
+    runs = ['[^%s]+' % re.escape(special), '%s+' % re.escape(separator)]
+    if quote:
+        runs.append('%s+' % re.escape(quote))
+    if escape:
+        runs.insert(0, '%s.?' % re.escape(escape))
+    return re.compile('|'.join(runs), re.DOTALL)
+
+
+def _flickr_tokens(tagstr, scanner=None):
+    "Yields the raw tokens found in a stripped flickr tag string."
+    if scanner is None:
+        scanner = _FlickrScanner()
+    for tok in scanner.feed(tagstr, scanner.lastquote(tagstr)):
+        yield tok
+    tok = scanner.close()
+    if tok:
+        yield tok
+
+
+def _read_chunks(stream, chunksize):
+    "Yields the chunks of text in a file-like object or iterable."
+    if not hasattr(stream, 'read'):
+        for chunk in stream:
+            yield chunk
+        return
+    while True:
+        chunk = stream.read(chunksize)
+        if not chunk:
+            break
+        yield chunk
+
+
+def _mmap_lines(path, encoding):
+    """ Yields the lines of a file as strings, reading it through mmap.
+
+    Lines are sliced from the mapped file one at a time. ASCII lines use
+    the fast ascii decoder and empty lines are not decoded at all.
+    """
+    fileobj = open(path, 'rb')
+    try:
+        if not os.fstat(fileobj.fileno()).st_size:
+            return
+        mapped = mmap.mmap(fileobj.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            find, pos, size = mapped.find, 0, len(mapped)
+            while pos < size:
+                end = find(b'\n', pos)
+                if end < 0:
+                    end = size
+                line = mapped[pos:end]
+                pos = end + 1
+                if line.endswith(b'\r'):
+                    line = line[:-1]
+                if not line:
+                    yield ''
+                elif line.isascii():
+                    yield line.decode('ascii')
+                else:
+                    yield line.decode(encoding)
+        finally:
+            mapped.close()
+    finally:
+        fileobj.close()
+
+
+class NormalizerStage(object):
+    """ A step of a :class:`Normalizer` pipeline.
+
+    :param func: Function that takes a string and returns it normalized.
+    :param ascii: Faster function that does the same for ASCII strings,
+                  or `None` if the stage doesn't change ASCII strings.
+    """
+
+    def __init__(self, func, ascii=None):
+        self.func = func
+        self.ascii = ascii
+
+
+def _strip_accents(tag):
+    return ''.join([char for char in unicodedata.normalize('NFD', tag)
+                    if not unicodedata.combining(char)])
+
+
+def _collapse_spaces(tag):
+    return ' '.join(tag.split())
+
+
+LOWERCASE = NormalizerStage(str.lower, str.lower)
+CASEFOLD = NormalizerStage(str.casefold, str.lower)
+NFKC = NormalizerStage(lambda tag: unicodedata.normalize('NFKC', tag))
+STRIP_ACCENTS = NormalizerStage(_strip_accents)
+COLLAPSE_SPACES = NormalizerStage(_collapse_spaces, _collapse_spaces)
+
+
+def synonym_stage(mapping):
+    """ Returns a :class:`NormalizerStage` that replaces tags with their
+    canonical form, like the mappings of :meth:`TagClusterer.cluster`.
+
+    Add it as the last stage of a :class:`Normalizer`, since the keys of
+    the mapping are normalized tags::
+
+        mapping = TagClusterer().cluster(counts, aliases={'nyc': 'newyork'})
+
+        class SynonymTag(Tag):
+            normalize = Normalizer([LOWERCASE, synonym_stage(mapping)])
+
+    The mapping is read on every call, but the results of the Normalizer
+    are memoized: create a new one if the mapping changes.
+    """
+    get = mapping.get
+
+    def canonical(tag):
+        return get(tag, tag)
+    return NormalizerStage(canonical, canonical)
+
+
+class Normalizer(object):
+    """ A pipeline of :class:`NormalizerStage` objects.
+
+    Can be used as the `normalize` method of a Tag class::
+
+        class MyTag(Tag):
+            normalize = Normalizer([NFKC, CASEFOLD, STRIP_ACCENTS,
+                                    COLLAPSE_SPACES])
+
+    ASCII strings skip the Unicode only stages. Results are memoized.
+
+    :param stages: The stages, applied in order.
+    :param maxsize: Number of memoized results, 0 disables memoization.
+    """
+
+    def __init__(self, stages, maxsize=4096):
+        self.stages = tuple(stages)
+        self._funcs = tuple([stage.func for stage in self.stages])
+        self._asciifuncs = tuple([stage.ascii for stage in self.stages
+                                  if stage.ascii is not None])
+        if maxsize:
+            self._normalize = lru_cache(maxsize)(self._normalize)
+
+    def __call__(self, tag):
+        return self._normalize(tag)
+
+    def _normalize(self, tag):
+        if tag.isascii():
+            funcs = self._asciifuncs
+        else:
+            funcs = self._funcs
+        for func in funcs:
+            tag = func(tag)
+        return tag
+
 
 class Tag:
     "Tag objects"
@@ -23,7 +293,9 @@ class Tag:
 
     def parse(self):
         self.clean = self.normalize(self.raw)
+        self._parse_machinetag()
 
+    def _parse_machinetag(self):
         if ':' in self.raw and '=' in self.raw:
             mmatch = RE_MACHINE_TAG.match(self.raw)
             if mmatch:
@@ -31,6 +303,26 @@ class Tag:
                 self.namespace, self.predicate, value = mmatch.groups()
                 self.value = self.normalize(value)
 
+    def _astuple(self):
+        "Returns a compact tuple with the parsed parts of the tag."
+        if self.is_machinetag:
+            return (self.clean, self.raw, self.namespace, self.predicate,
+                    self.value)
+        return (self.clean, self.raw)
+
+    @classmethod
+    def _fromtuple(cls, parts):
+        "Builds a tag from the output of :meth:`_astuple`, without parsing."
+        tag = cls.__new__(cls)
+        tag.clean, tag.raw = parts[0], parts[1]
+        if len(parts) == 5:
+            tag.is_machinetag = True
+            tag.namespace, tag.predicate, tag.value = parts[2:]
+        else:
+            tag.is_machinetag = False
+            tag.namespace, tag.predicate, tag.value = None, None, None
+        return tag
+
     @staticmethod
     def normalize(tag):
         """ Normalizes a single tag.
@@ -43,13 +335,610 @@ class Tag:
         return tag.lower()
 
 
+if _speedups is not None:
+    _speedups.configure(Tag, RE_MACHINE_TAG)
+
+
+class LazyTag(Tag):
+    """ Tag objects that parse machine tags on demand.
+
+    The machine tag parts (`is_machinetag`, `namespace`, `predicate` and
+    `value`) are parsed the first time one of them is read, and then
+    cached. Tags that are only deduplicated or compared by their `clean`
+    value never run the machine tag regex.
+    """
+    _MACHINETAG_ATTRS = ('is_machinetag', 'namespace', 'predicate', 'value')
+
+    def __init__(self, raw_tag):
+        self.raw = raw_tag.strip()
+        self.parse()
+
+    def parse(self):
+        self.clean = self.normalize(self.raw)
+
+    def __getattr__(self, name):
+        # only called when the attribute hasn't been set yet
+        if name not in self._MACHINETAG_ATTRS:
+            raise AttributeError(name)
+        self.is_machinetag = False
+        self.namespace, self.predicate, self.value = None, None, None
+        self._parse_machinetag()
+        return getattr(self, name)
+
+
+class CompactTag(object):
+    """ Tag objects with a smaller memory footprint.
+
+    Has the same API as :class:`Tag`, but uses slots instead of a
+    `__dict__`, and the machine tag parts are only stored for machine tags.
+    Set it as the TAGCLASS of a tokenizer to use it.
+    """
+    __slots__ = ('raw', 'clean', '_machine')
+
+    def __init__(self, raw_tag):
+        self.raw = raw_tag.strip()
+        self._machine = None
+        self.parse()
+
+    def parse(self):
+        self.clean = self.normalize(self.raw)
+
+        if ':' in self.raw and '=' in self.raw:
+            mmatch = RE_MACHINE_TAG.match(self.raw)
+            if mmatch:
+                namespace, predicate, value = mmatch.groups()
+                self._machine = (namespace, predicate, self.normalize(value))
+
+    @property
+    def is_machinetag(self):
+        return self._machine is not None
+
+    @property
+    def namespace(self):
+        if self._machine:
+            return self._machine[0]
+
+    @property
+    def predicate(self):
+        if self._machine:
+            return self._machine[1]
+
+    @property
+    def value(self):
+        if self._machine:
+            return self._machine[2]
+
+    def _astuple(self):
+        if self._machine:
+            return (self.clean, self.raw) + self._machine
+        return (self.clean, self.raw)
+
+    @classmethod
+    def _fromtuple(cls, parts):
+        tag = cls.__new__(cls)
+        tag.clean, tag.raw = parts[0], parts[1]
+        tag._machine = tuple(parts[2:]) or None
+        return tag
+
+    normalize = staticmethod(Tag.normalize)
+
+
+class LRUCache(object):
+    """ A thread safe mapping that keeps only the most recently used items.
+
+    :param maxsize: Maximum number of items. When full, the least recently
+                    used item is evicted.
+
+    Lookups are counted in the `hits` and `misses` attributes.
+    """
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.hits = self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        "Returns the value of `key` (marking it as recently used) or default."
+        self._lock.acquire()
+        try:
+            try:
+                value = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+        finally:
+            self._lock.release()
+
+    def set(self, key, value):
+        "Stores `value` under `key`, evicting the oldest item if full."
+        self._lock.acquire()
+        try:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            if len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        "Removes all the items and resets the counters."
+        self._lock.acquire()
+        try:
+            self._data.clear()
+            self.hits = self.misses = 0
+        finally:
+            self._lock.release()
+
+
+class TagCache(object):
+    """ Cache for parsed tag strings and tags.
+
+    Set an instance as the CACHE property of a tokenizer to enable it::
+
+        class CachedCommaTokenizer(CommaTokenizer):
+            CACHE = TagCache(maxsize=10000)
+
+    Parsed tag strings are kept in the `strings` :class:`LRUCache`, keyed
+    by tokenizer and tag string. On a miss, tags are taken from the `tags`
+    :class:`LRUCache`, keyed by the TAGCLASS of the tokenizer and the raw
+    token, so a Tag subclass with its own `normalize` gets its own entries.
+
+    :param maxsize: Maximum number of tag strings in the cache.
+    :param tagsize: Maximum number of tags in the cache.
+    """
+
+    def __init__(self, maxsize=1024, tagsize=8192):
+        self.strings = LRUCache(maxsize)
+        self.tags = LRUCache(tagsize)
+
+    def str2tags(self, tokenizer, tagstr):
+        """ Cached version of :meth:`Tokenizer.str2tags`.
+
+        :returns: A tuple of Tag objects. The tags are shared by all the
+                  callers that parsed the same string, don't modify them.
+        """
+        key = (tokenizer, tagstr)
+        tags = self.strings.get(key)
+        if tags is None:
+            tags, keys = [], set()
+            if tagstr:
+                tagclass, process = tokenizer.TAGCLASS, tokenizer._process_tag
+                for strtag in tokenizer._split(tagstr):
+                    process(tags, keys, strtag, self._tag(tagclass, strtag))
+            tags = tuple(tags)
+            self.strings.set(key, tags)
+        return tags
+
+    def _tag(self, tagclass, strtag):
+        strtag = strtag.strip()
+        key = (tagclass, strtag)
+        tag = self.tags.get(key)
+        if tag is None:
+            tag = tagclass(strtag)
+            self.tags.set(key, tag)
+        return tag
+
+    def clear(self):
+        "Empties both caches."
+        self.strings.clear()
+        self.tags.clear()
+
+
+class TagVocabulary(object):
+    """ Interning table that maps normalized tags to dense integer ids.
+
+    Ids are assigned in order, starting from 0, the first time a clean
+    value is added. The raw form seen that first time is kept too.
+
+    Use it with :meth:`Tokenizer.str2ids` to get arrays of ids instead of
+    lists of Tag objects.
+    """
+    MAGIC = b'TAGVOC1\n'
+
+    def __init__(self):
+        self.ids = {}
+        self.cleans = []
+        self.raws = []
+
+    def __len__(self):
+        return len(self.cleans)
+
+    def __contains__(self, clean):
+        return clean in self.ids
+
+    def add(self, clean, raw):
+        "Returns the id of `clean`, adding it if it's a new tag."
+        tagid = self.ids.get(clean)
+        if tagid is None:
+            tagid = self.ids[clean] = len(self.cleans)
+            self.cleans.append(clean)
+            self.raws.append(raw)
+        return tagid
+
+    def get(self, clean, default=None):
+        "Returns the id of `clean`, or `default` if it's not in the table."
+        return self.ids.get(clean, default)
+
+    def save(self, fileobj):
+        """ Writes the vocabulary to a file-like object opened in binary
+        mode, in a compact format that loads fast with :meth:`load`.
+        """
+        fileobj.write(self.MAGIC)
+        fileobj.write(struct.pack('<I', len(self.cleans)))
+        _write_strings(fileobj, self.cleans)
+        _write_strings(fileobj, self.raws)
+
+    @classmethod
+    def load(cls, fileobj):
+        "Reads a vocabulary written with :meth:`save`."
+        if fileobj.read(len(cls.MAGIC)) != cls.MAGIC:
+            raise ValueError('Not a tag vocabulary file')
+        count, = struct.unpack('<I', fileobj.read(4))
+        vocabulary = cls()
+        vocabulary.cleans = _read_strings(fileobj, count)
+        vocabulary.raws = _read_strings(fileobj, count)
+        vocabulary.ids = dict(zip(vocabulary.cleans,
+                                  range(len(vocabulary.cleans))))
+        return vocabulary
+
+
+def _write_strings(fileobj, strings):
+    """ Writes a list of strings as an array of little-endian uint32
+    lengths and a UTF-8 blob.
+    """
+    blob = ''.join(strings).encode('utf-8')
+    fileobj.write(struct.pack('<%dI' % len(strings), *map(len, strings)))
+    fileobj.write(struct.pack('<I', len(blob)))
+    fileobj.write(blob)
+
+
+def _read_strings(fileobj, count):
+    "Reads `count` strings written with :func:`_write_strings`."
+    lengths = struct.unpack('<%dI' % count, fileobj.read(count * 4))
+    size, = struct.unpack('<I', fileobj.read(4))
+    text = fileobj.read(size).decode('utf-8')
+    ends = list(accumulate(lengths))
+    return [text[start:end] for start, end in zip([0] + ends, ends)]
+
+
+def fingerprint(tags, bits=64):
+    """ Order independent hash of a set of tags.
+
+    Only the normalized form of the tags is hashed, so two tag strings
+    have the same fingerprint when :meth:`Tokenizer.str2tags` finds the
+    same tags in them, in any order and with any tokenizer. The hash is
+    stable across processes and Python versions, it can be stored.
+
+    :param tags: The output of :meth:`Tokenizer.str2tags`.
+    :param bits: Size of the fingerprint, 64 or 128.
+
+    :returns: An integer, 0 for no tags.
+    """
+    return _fingerprint(set([tag.clean for tag in tags]), bits)
+
+
+def _fingerprint(cleans, bits):
+    "Fingerprint of a set of normalized tags."
+    if bits not in (64, 128):
+        raise ValueError('bits must be 64 or 128')
+    # the sum of the hashes of the tags, so the order doesn't matter
+    blake2b, frombytes = hashlib.blake2b, int.from_bytes
+    total = sum([frombytes(blake2b(clean.encode('utf-8', 'surrogatepass'),
+                                   digest_size=16).digest(), 'little')
+                 for clean in cleans if clean])
+    return total & ((1 << bits) - 1)
+
+
+class ParsedTags(object):
+    """ The result of :meth:`Tokenizer.parse`.
+
+    Besides the deduplicated `tags`, it keeps every raw token of `tagstr`
+    as a Tag object in `tokens`, and its position in `spans`, so
+    :meth:`Tokenizer.diff` can reuse them when the string is edited.
+    `spans` is `None` when the tokens can't be reused (flickr tags with
+    quotes).
+    """
+
+    def __init__(self, tokenizer, tagstr, tokens, spans):
+        self.tokenizer = tokenizer
+        self.tagstr = tagstr
+        self.tokens = tokens
+        self.spans = spans
+        tags, keys, process = [], set(), tokenizer._process_tag
+        for tag in tokens:
+            process(tags, keys, tag.raw, tag)
+        self.tags = tags
+
+
+class TagDiff(object):
+    """ The result of :meth:`Tokenizer.diff`.
+
+    `added`, `removed` and `unchanged` are dicts that map the clean value
+    of the tags to Tag objects (from the new string, except for
+    `removed`), in the order they appear in the tag strings. `parsed` is
+    the :class:`ParsedTags` of the new string, to be used as `old` in the
+    next diff.
+    """
+
+    def __init__(self, old, new):
+        oldtags = OrderedDict([(tag.clean, tag) for tag in old.tags])
+        newtags = OrderedDict([(tag.clean, tag) for tag in new.tags])
+        self.added = OrderedDict([(clean, tag)
+                                  for clean, tag in newtags.items()
+                                  if clean not in oldtags])
+        self.removed = OrderedDict([(clean, tag)
+                                    for clean, tag in oldtags.items()
+                                    if clean not in newtags])
+        self.unchanged = OrderedDict([(clean, tag)
+                                      for clean, tag in newtags.items()
+                                      if clean in oldtags])
+        self.parsed = new
+
+
+def _common_prefix(first, second):
+    "Length of the common prefix of two strings, compared in C."
+    low, high = 0, min(len(first), len(second))
+    while low < high:
+        mid = (low + high + 1) // 2
+        if first.startswith(second[low:mid], low):
+            low = mid
+        else:
+            high = mid - 1
+    return low
+
+
+def _common_suffix(first, second, limit):
+    "Length of the common suffix of two strings, up to `limit`."
+    low, high = 0, limit
+    flen, slen = len(first), len(second)
+    while low < high:
+        mid = (low + high + 1) // 2
+        if first.startswith(second[slen - mid:slen - low], flen - mid):
+            low = mid
+        else:
+            high = mid - 1
+    return low
+
+
+class Offloader(object):
+    """ Runs big parsing jobs out of the asyncio event loop.
+
+    Set an instance as the OFFLOADER property of a tokenizer to use it in
+    :meth:`Tokenizer.astr2tags`::
+
+        class AsyncCommaTokenizer(CommaTokenizer):
+            OFFLOADER = Offloader(threshold=2048)
+
+    :param threshold: Tag strings shorter than this are parsed inline,
+                      longer ones in the executor.
+    :param executor: A `concurrent.futures` executor. By default, a thread
+                     pool with `workers` threads is created. With a process
+                     pool, the tokenizer and its Tag class must be picklable.
+    :param workers: Number of threads of the default executor. Parsing
+                    holds the GIL, so more threads only add contention
+                    with the event loop. Use a process pool to parse in
+                    parallel.
+    :param max_pending: Maximum number of jobs in the executor. Callers
+                        wait (asynchronously) for a free slot, which is
+                        counted as queued time.
+
+    The `inline`, `offloaded`, `queued_time` and `parse_time` attributes
+    count the calls and the seconds spent waiting for the executor and
+    parsing. Use them to tune the threshold.
+    """
+
+    def __init__(self, threshold=4096, executor=None, workers=1,
+                 max_pending=16):
+        self.threshold = threshold
+        if executor is None:
+            # imported here, only needed when offloading
+            from concurrent.futures import ThreadPoolExecutor
+            executor = ThreadPoolExecutor(workers)
+        self.executor = executor
+        self.max_pending = max_pending
+        # asyncio primitives are bound to a loop, one per running loop
+        self._semaphores = WeakKeyDictionary()
+        self.reset()
+
+    def reset(self):
+        "Resets the metrics."
+        self.inline = self.offloaded = 0
+        self.queued_time = self.parse_time = 0.0
+
+    def metrics(self):
+        "Returns the metrics as a dict."
+        return {'inline': self.inline, 'offloaded': self.offloaded,
+                'queued_time': self.queued_time,
+                'parse_time': self.parse_time}
+
+    def call(self, func, arg):
+        "Runs func(arg) inline."
+        start = time.perf_counter()
+        try:
+            return func(arg)
+        finally:
+            self.inline += 1
+            self.parse_time += time.perf_counter() - start
+
+    async def offload(self, func, arg):
+        "Runs func(arg) in the executor, waiting for a free slot if needed."
+        # imported here, only needed by the async API
+        import asyncio
+
+        loop = asyncio.get_running_loop()
+        semaphore = self._semaphores.get(loop)
+        if semaphore is None:
+            semaphore = self._semaphores[loop] = asyncio.Semaphore(
+                self.max_pending)
+        start = time.perf_counter()
+        async with semaphore:
+            elapsed, result = await loop.run_in_executor(
+                self.executor, _timed_call, func, arg)
+        self.offloaded += 1
+        self.parse_time += elapsed
+        self.queued_time += time.perf_counter() - start - elapsed
+        return result
+
+
+def _timed_call(func, arg):
+    "Returns the time it took to run func(arg), and its result."
+    start = time.perf_counter()
+    result = func(arg)
+    return time.perf_counter() - start, result
+
+
+class Profiler(object):
+    """ Counters and timers for the stages of :meth:`Tokenizer.str2tags`.
+
+    Set an instance as the PROFILER property of a tokenizer to enable it::
+
+        class ProfiledCommaTokenizer(CommaTokenizer):
+            PROFILER = Profiler(sample=100)
+
+    or enable it around a block of calls with :meth:`enable`. Tokenizers
+    without a profiler only pay for a `None` check.
+
+    One call out of every `sample` calls is profiled: its tag string is
+    split, the tags are built and deduplicated as separate timed stages,
+    and the normalization and machine tag matching of the tags are timed
+    again on their own (they are part of the `tag` stage). With a CACHE,
+    only the `total` time of the sampled calls is measured. The other
+    calls run exactly like without a profiler, but the stages of the
+    sampled calls are always timed in pure Python, even when the C
+    accelerator is built.
+
+    :param sample: Profile one call out of every `sample` calls.
+    :param callback: A function called with the :meth:`metrics` dict by
+                     :meth:`export`.
+
+    The `counters` dict has the number of `calls` and, for the sampled
+    calls, `sampled`, `bytes` (UTF-8), `tokens`, `duplicates` and `empty`
+    (dropped tokens) and `machinetags`. The `timers` dict has the seconds
+    spent in the `split`, `tag`, `normalize`, `machinetag`, `dedup` and
+    `total` stages of the sampled calls.
+    """
+    COUNTERS = ('calls', 'sampled', 'bytes', 'tokens', 'duplicates',
+                'empty', 'machinetags')
+    TIMERS = ('split', 'tag', 'normalize', 'machinetag', 'dedup', 'total')
+
+    def __init__(self, sample=1, callback=None):
+        self.sample = sample
+        self.callback = callback
+        self.reset()
+
+    def reset(self):
+        "Resets the counters and timers."
+        self.counters = dict.fromkeys(self.COUNTERS, 0)
+        self.timers = dict.fromkeys(self.TIMERS, 0.0)
+        self._countdown = 1
+
+    def metrics(self):
+        "Returns the counters and timers as a flat dict."
+        metrics = dict(self.counters)
+        for name, value in self.timers.items():
+            metrics['%s_time' % name] = value
+        return metrics
+
+    def export(self):
+        "Calls the callback with the metrics, if there is a callback."
+        if self.callback is not None:
+            self.callback(self.metrics())
+
+    @contextmanager
+    def enable(self, tokenizer):
+        """ Context manager that sets the profiler as the PROFILER of a
+        tokenizer class, and exports the metrics on exit::
+
+            with Profiler(sample=10, callback=print).enable(CommaTokenizer):
+                ...
+
+        Calls from other threads made while the block runs are profiled
+        too.
+        """
+        had_own = 'PROFILER' in vars(tokenizer)
+        previous = tokenizer.PROFILER
+        tokenizer.PROFILER = self
+        try:
+            yield self
+        finally:
+            if had_own:
+                tokenizer.PROFILER = previous
+            else:
+                del tokenizer.PROFILER
+            self.export()
+
+    def str2tags(self, tokenizer, tagstr):
+        "Profiled version of :meth:`Tokenizer.str2tags`."
+        self.counters['calls'] += 1
+        self._countdown -= 1
+        if self._countdown > 0 or not tagstr:
+            return tokenizer._str2tags(tagstr)
+        self._countdown = self.sample
+        self.counters['sampled'] += 1
+        self.counters['bytes'] += len(tagstr.encode('utf-8', 'replace'))
+        if tokenizer.CACHE is not None:
+            start = time.perf_counter()
+            tags = tokenizer.CACHE.str2tags(tokenizer, tagstr)
+            self.timers['total'] += time.perf_counter() - start
+            return tags
+        return self._profile(tokenizer, tagstr)
+
+    def _profile(self, tokenizer, tagstr):
+        clock, tagclass = time.perf_counter, tokenizer.TAGCLASS
+        start = clock()
+        strtags = list(tokenizer._split(tagstr))
+        split = clock()
+        newtags = [tagclass(strtag) for strtag in strtags]
+        built = clock()
+        tags, keys = [], set()
+        for tag in newtags:
+            tokenizer._process_tag(tags, keys, None, tag)
+        end = clock()
+        # timed again apart, the tag stage already includes them
+        normalize = tagclass.normalize
+        for tag in newtags:
+            normalize(tag.raw)
+        normalized = clock()
+        machinetags = 0
+        for tag in newtags:
+            raw = tag.raw
+            if ':' in raw and '=' in raw and RE_MACHINE_TAG.match(raw):
+                machinetags += 1
+        matched = clock()
+
+        empty = sum(1 for tag in newtags if not tag.clean)
+        counters, timers = self.counters, self.timers
+        counters['tokens'] += len(newtags)
+        counters['empty'] += empty
+        counters['duplicates'] += len(newtags) - len(tags) - empty
+        counters['machinetags'] += machinetags
+        timers['split'] += split - start
+        timers['tag'] += built - split
+        timers['dedup'] += end - built
+        timers['total'] += end - start
+        timers['normalize'] += normalized - end
+        timers['machinetag'] += matched - normalized
+        return tags
+
+
 class Tokenizer(object):
     SEPARATOR = JOINER = TAGS_WITH_SPACES = None
     TAGCLASS = Tag
+    CACHE = None
+    OFFLOADER = None
+    PROFILER = None
 
     @classmethod
-    def _process_tag(cls, tags, keys, strtag):
-        tag = cls.TAGCLASS(strtag)
+    def _process_tag(cls, tags, keys, strtag, tag=None):
+        if tag is None:
+            tag = cls.TAGCLASS(strtag)
         cleantag = tag.clean
         if cleantag and cleantag not in keys:
             # Ignore if the normalized tag is empty or if there is
@@ -65,110 +954,1901 @@ class Tokenizer(object):
         :param tagstr: A string with tags as entered by a user on a form.
 
         :returns: A list of Tag objects. If you subclass Tag, set your subclass
-                  in the TAGCLASS property.
+                  in the TAGCLASS property. If a :class:`TagCache` is set in
+                  the CACHE property, a tuple of (shared) Tag objects.
         """
+        if cls.PROFILER is not None:
+            return cls.PROFILER.str2tags(cls, tagstr)
+        return cls._str2tags(tagstr)
+
+    @classmethod
+    def _str2tags(cls, tagstr):
+        "str2tags without the profiler."
+        if cls.CACHE is not None:
+            return cls.CACHE.str2tags(cls, tagstr)
         if not tagstr:
             return []
-        tags, keys = [], set()
-        for strtag in tagstr.split(cls.SEPARATOR):
-            cls._process_tag(tags, keys, strtag)
-        return tags
+        return cls._tags(cls._split(tagstr))
 
     @classmethod
-    def tags2str(cls, tags):
-        """ Takes a list of tags and returns a string that can be edited.
+    def _accelerated(cls):
+        """ Returns True if the C accelerator can build the tags, it doesn't
+        know about overridden `_process_tag` methods.
+        """
+        return _speedups is not None and \
+            cls._process_tag.__func__ is Tokenizer._process_tag.__func__
 
-        :param tags: A list of tags that are correct for the Tokenizer being
-                     used. For instance, when using :class:`CommaTokenizer`,
-                     tags can't have commas on them.
+    @classmethod
+    def _tags(cls, strtags):
+        "Returns the deduplicated Tag objects of an iterable of raw tags."
+        if cls._accelerated():
+            return _speedups.tags(strtags, cls.TAGCLASS)
+        tags, keys, process = [], set(), cls._process_tag
+        for strtag in strtags:
+            process(tags, keys, strtag)
+        return tags
 
-        :returns: A string that, if serialized, would return the same tags.
+    @classmethod
+    def str2tags_many(cls, tagstrs, workers=1, chunksize=1000):
+        """ Parses many tag strings, lazily.
 
-        :raise TagWithSeparatorException:
+        Works like calling :meth:`str2tags` on every string, but the
+        per-call setup is done only once for the whole batch, which makes
+        a difference when reindexing millions of tag strings.
 
-          * if a tag has a space when using :class:`DeliciousTokenizer`, or
-          * a tag has a comma when using :class:`CommaTokenizer`
+        :param tagstrs: An iterable of tag strings.
+        :param workers: Number of processes used to parse the strings. The
+                        default, 1, parses everything in this process.
+                        `None` uses as many processes as CPUs.
+        :param chunksize: Number of strings sent to a worker process at a
+                          time. Batches that fit in a single chunk are
+                          always parsed in this process.
+
+        :returns: A generator that yields a list of Tag objects for every
+                  string in `tagstrs`, in the same order.
         """
-        results = []
-        for tag in tags:
-            if cls.SEPARATOR in tag:
-                raise TagWithSeparatorException(
-                    "Tag can't include the separator: '%s'" % tag)
-            results.append(tag)
-        return cls.JOINER.join(results)
+        if workers == 1:
+            return cls._str2tags_many(tagstrs)
+        return cls._str2tags_parallel(tagstrs, workers, chunksize)
 
+    @classmethod
+    def _str2tags_many(cls, tagstrs):
+        if cls.PROFILER is not None or cls.CACHE is not None:
+            str2tags = cls.str2tags
+            for tagstr in tagstrs:
+                yield str2tags(tagstr)
+            return
+        split, process = cls._split, cls._process_tag
+        if cls._accelerated():
+            tags, tagclass = _speedups.tags, cls.TAGCLASS
+            for tagstr in tagstrs:
+                yield tags(split(tagstr), tagclass) if tagstr else []
+            return
+        keys = set()
+        for tagstr in tagstrs:
+            tags = []
+            if tagstr:
+                for strtag in split(tagstr):
+                    process(tags, keys, strtag)
+                keys.clear()
+            yield tags
 
+    @classmethod
+    def _str2tags_parallel(cls, tagstrs, workers, chunksize):
+        tagstrs = iter(tagstrs)
+        chunk = list(islice(tagstrs, chunksize))
+        if len(chunk) < chunksize:
+            for tags in cls._str2tags_many(chunk):
+                yield tags
+            return
 
-class DeliciousTokenizer(Tokenizer):
-    """ Tokenizer for Delicious-like tags.
+        # imported here, the module must keep working without it
+        from concurrent.futures import ProcessPoolExecutor
+        fromtuple = cls.TAGCLASS._fromtuple
+        # don't read more of the input than the workers can keep up with
+        maxpending = 2 * (workers or os.cpu_count() or 1)
+        pending = deque()
+        pool = ProcessPoolExecutor(workers)
+        try:
+            while chunk or pending:
+                if chunk and len(pending) < maxpending:
+                    pending.append(pool.submit(_str2tuples, cls, chunk))
+                    chunk = list(islice(tagstrs, chunksize))
+                    continue
+                for tuples in pending.popleft().result():
+                    yield [fromtuple(parts) for parts in tuples]
+        finally:
+            for future in pending:
+                future.cancel()
+            pool.shutdown()
 
-    Delicious tags are separated by spaces, and don't allow spaces in a tag.
+    @classmethod
+    async def astr2tags(cls, tagstr):
+        """ Coroutine version of :meth:`str2tags`.
 
-    Tags are normalized as lowercase by default to avoid tag duplication.
-    """
-    SEPARATOR = JOINER = ' '
-    TAGS_WITH_SPACES = False
+        If an :class:`Offloader` is set in the OFFLOADER property, tag
+        strings longer than its threshold are parsed in its executor, so
+        they don't block the event loop. Otherwise everything is parsed
+        inline.
+        """
+        offloader = cls.OFFLOADER
+        if offloader is None:
+            return cls.str2tags(tagstr)
+        if not tagstr or len(tagstr) < offloader.threshold:
+            return offloader.call(cls.str2tags, tagstr)
+        return await offloader.offload(cls.str2tags, tagstr)
 
+    @classmethod
+    async def astr2tags_many(cls, tagstrs):
+        """ Async version of :meth:`str2tags_many`.
 
-class CommaTokenizer(Tokenizer):
-    """ Tokenizer for comma-separated tags.
+        :param tagstrs: An iterable or async iterable of tag strings.
 
-    Comma separated tags don't allow commas in a tag.
+        :returns: An async generator that yields a list of Tag objects for
+                  every string in `tagstrs`, in the same order. Up to
+                  `max_pending` strings of the OFFLOADER are parsed
+                  concurrently.
+        """
+        # imported here, only needed by the async API
+        import asyncio
 
-    Tags are normalized as lowercase by default to avoid tag duplication.
-    """
-    SEPARATOR = ','
-    JOINER = ', '
-    TAGS_WITH_SPACES = True
+        offloader = cls.OFFLOADER
+        window = offloader and offloader.max_pending or 1
+        pending = deque()
+        try:
+            if hasattr(tagstrs, '__aiter__'):
+                async for tagstr in tagstrs:
+                    pending.append(
+                        asyncio.ensure_future(cls.astr2tags(tagstr)))
+                    if len(pending) >= window:
+                        yield await pending.popleft()
+            else:
+                for tagstr in tagstrs:
+                    pending.append(
+                        asyncio.ensure_future(cls.astr2tags(tagstr)))
+                    if len(pending) >= window:
+                        yield await pending.popleft()
+            while pending:
+                yield await pending.popleft()
+        finally:
+            for future in pending:
+                future.cancel()
 
+    @classmethod
+    def str2tags_stream(cls, stream, chunksize=65536):
+        """ Parses the tags in a text stream, lazily.
 
-class FlickrTokenizer(Tokenizer):
-    """ Tokenizer for Flickr-like tags.
+        Works like calling :meth:`str2tags` on the whole content of the
+        stream, but reads it in chunks and yields every tag as soon as it
+        is found. Memory is bounded by the chunk size, the longest tag and
+        the number of unique tags.
 
-    Flickr tags are separated by spaces. If a tag has spaces, it must be
-    enclosed with double quotes.
+        :param stream: A file-like object opened in text mode, or an
+                       iterable of strings.
+        :param chunksize: Number of characters read at a time from a
+                          file-like object.
 
-    Tags are normalized as lowercase by default to avoid tag duplication.
-    """
-    SEPARATOR = ' '
+        :returns: A generator of Tag objects.
+        """
+        tags, keys = [], set()
+        process = cls._process_tag
+        for strtag in cls._split_stream(_read_chunks(stream, chunksize)):
+            process(tags, keys, strtag)
+            if tags:
+                yield tags.pop()
 
     @classmethod
-    def str2tags(cls, tagstr):
-        "Parser for the incredibly weird flickr tags (see tests)."
-        if not tagstr:
-            return []
-        if '"' not in tagstr:
-            return super(FlickrTokenizer, cls).str2tags(tagstr)
-        lstr = list(tagstr.strip())
-        tags, keys, tok, prev, quoted = [], set(), '', '', False
-
-        while lstr:
-            char = lstr[0]
-            if char == '"':
-                quoted = not quoted
-            elif char == ' ' and \
-                    (not quoted or \
-                    (quoted and prev == '"' and '"' not in lstr)):
-                if tok:
-                    quoted = False
-                    cls._process_tag(tags, keys, tok)
-                    tok = ''
+    def str2tags_file(cls, path, encoding='utf-8', workers=1,
+                      chunksize=1000):
+        """ Parses a file with a tag string per line, lazily.
+
+        The file is memory mapped and decoded one line at a time, so it is
+        never copied into memory as a whole.
+
+        :param path: Path of the file.
+        :param encoding: Encoding of the non ASCII lines of the file.
+        :param workers: See :meth:`str2tags_many`.
+        :param chunksize: See :meth:`str2tags_many`.
+
+        :returns: A generator that yields a list of Tag objects for every
+                  line in the file.
+        """
+        return cls.str2tags_many(_mmap_lines(path, encoding), workers,
+                                 chunksize)
+
+    @classmethod
+    def convert_file(cls, path, output, tokenizer, encoding='utf-8'):
+        """ Converts a file with a tag string per line to another format.
+
+        :param path: Path of the file, parsed with :meth:`str2tags_file`.
+        :param output: A file-like object opened for writing in text mode.
+                       Every line of the input is written to it, serialized
+                       with the :meth:`tags2str` method of `tokenizer`.
+        :param tokenizer: The Tokenizer subclass of the output format.
+        :param encoding: Encoding of the non ASCII lines of the file.
+
+        :returns: The number of lines written.
+
+        :raise TagWithSeparatorException: if a tag can't be serialized
+                                          with `tokenizer`.
+        """
+        tags2str, write, lines = tokenizer.tags2str, output.write, 0
+        for tags in cls.str2tags_file(path, encoding):
+            write(tags2str(tags))
+            write('\n')
+            lines += 1
+        return lines
+
+    @classmethod
+    def parse(cls, tagstr):
+        """ Like :meth:`str2tags`, but keeps the position of every token.
+
+        :returns: A :class:`ParsedTags` object.
+        """
+        if not tagstr:
+            return ParsedTags(cls, '', [], [])
+        tagclass = cls.TAGCLASS
+        spans = cls._split_spans(tagstr, 0, len(tagstr))
+        if spans is None:
+            tokens = [tagclass(strtag) for strtag in cls._split(tagstr)]
+        else:
+            tokens = [tagclass(tagstr[start:end]) for start, end in spans]
+        return ParsedTags(cls, tagstr, tokens, spans)
+
+    @classmethod
+    def diff(cls, old, new):
+        """ Compares the tags of two tag strings.
+
+        When `old` is a :class:`ParsedTags`, only the region of `new` that
+        changed is tokenized again, the rest of the tokens are reused.
+
+        :param old: The previous tag string, or its :class:`ParsedTags`
+                    (from :meth:`parse` or from the `parsed` attribute of
+                    a previous :class:`TagDiff`).
+        :param new: The new tag string.
+
+        :returns: A :class:`TagDiff` object.
+        """
+        if not isinstance(old, ParsedTags):
+            old = cls.parse(old)
+        return TagDiff(old, cls._reparse(old, new or ''))
+
+    @classmethod
+    def _reparse(cls, old, tagstr):
+        oldstr, spans = old.tagstr, old.spans
+        if old.tokenizer is not cls or spans is None or not oldstr or \
+                not tagstr:
+            return cls.parse(tagstr)
+        oldlen, newlen = len(oldstr), len(tagstr)
+        prefix = _common_prefix(oldstr, tagstr)
+        suffix = _common_suffix(oldstr, tagstr,
+                                min(oldlen, newlen) - prefix)
+
+        # reuse the tokens followed by a separator in the common prefix,
+        # and the ones preceded by a separator in the common suffix
+        head, tail = 0, len(spans)
+        while head < tail and spans[head][1] < prefix:
+            head += 1
+        while tail > head and spans[tail - 1][0] > oldlen - suffix:
+            tail -= 1
+        size, delta = len(cls.SEPARATOR), newlen - oldlen
+        start, end = 0, newlen
+        if head:
+            start = spans[head - 1][1] + size
+        if tail < len(spans):
+            end = spans[tail][0] - size + delta
+        middle = cls._split_spans(tagstr, start, end)
+        if middle is None:
+            return cls.parse(tagstr)
+        tagclass = cls.TAGCLASS
+        tokens = old.tokens[:head] + \
+            [tagclass(tagstr[first:last]) for first, last in middle] + \
+            old.tokens[tail:]
+        spans = spans[:head] + middle + \
+            [(first + delta, last + delta) for first, last in spans[tail:]]
+        return ParsedTags(cls, tagstr, tokens, spans)
+
+    @classmethod
+    def str2ids(cls, tagstr, vocabulary):
+        """ Takes a raw string with tags and returns their ids.
+
+        Tags are normalized with the `normalize` method of TAGCLASS and
+        deduplicated like :meth:`str2tags` does, but no Tag objects are
+        built.
+
+        :param tagstr: A string with tags as entered by a user on a form.
+        :param vocabulary: A :class:`TagVocabulary`. New tags are added
+                           to it.
+
+        :returns: An `array('I')` with the ids of the tags.
+        """
+        ids = array('I')
+        if not tagstr:
+            return ids
+        normalize, add, seen = cls.TAGCLASS.normalize, vocabulary.add, set()
+        for strtag in cls._split(tagstr):
+            raw = strtag.strip()
+            clean = normalize(raw)
+            if clean:
+                tagid = add(clean, raw)
+                if tagid not in seen:
+                    ids.append(tagid)
+                    seen.add(tagid)
+        return ids
+
+    @classmethod
+    def str2fingerprint(cls, tagstr, bits=64):
+        """ Takes a raw string with tags and returns the :func:`fingerprint`
+        of its tags.
+
+        Tags are normalized with the `normalize` method of TAGCLASS and
+        deduplicated like :meth:`str2tags` does, but no Tag objects are
+        built.
+
+        :param tagstr: A string with tags as entered by a user on a form.
+        :param bits: Size of the fingerprint, 64 or 128.
+
+        :returns: An integer, 0 for no tags.
+        """
+        if not tagstr:
+            return _fingerprint((), bits)
+        normalize = cls.TAGCLASS.normalize
+        return _fingerprint(set([normalize(strtag.strip())
+                                 for strtag in cls._split(tagstr)]), bits)
+
+    @classmethod
+    def str2tags_column(cls, column):
+        """ Parses a whole column of tag strings with NumPy.
+
+        Tags are stripped, normalized and deduplicated with vectorized
+        operations, instead of building a Tag object for every tag.
+        Requires NumPy, and only works with the separator based tokenizers
+        (:class:`CommaTokenizer` and :class:`DeliciousTokenizer`).
+
+        :param column: A sequence (list, NumPy array...) of tag strings.
+                       Empty strings and `None` have no tags.
+
+        :returns: A tuple of three NumPy arrays `(offsets, clean, raw)`, in
+                  CSR format: the tags of the string in `column[i]` are in
+                  `clean[offsets[i]:offsets[i + 1]]` and
+                  `raw[offsets[i]:offsets[i + 1]]`.
+
+        :raise TypeError: if the tokenizer doesn't split its tag strings on
+                          the separator, like :class:`FlickrTokenizer` and
+                          the dialects with quotes, escapes or prefixes.
+        """
+        if cls._split.__func__ is not Tokenizer._split.__func__:
+            raise TypeError("%s tags can't be parsed with vectorized "
+                            "operations" % cls.__name__)
+        # imported here, NumPy is an optional dependency
+        import numpy
+
+        separator = cls.SEPARATOR
+        parts = [tagstr and tagstr.split(separator) or [] for tagstr in column]
+        counts = numpy.fromiter(map(len, parts), dtype=numpy.int64,
+                                count=len(parts))
+        raw = numpy.char.strip(numpy.array(list(chain.from_iterable(parts)),
+                                           dtype=str))
+        normalize = cls.TAGCLASS.normalize
+        if normalize is Tag.normalize:
+            clean = numpy.char.lower(raw)
+        else:
+            clean = numpy.frompyfunc(normalize, 1, 1)(raw).astype(str)
+
+        # keep the first tag of every (row, clean) group, lexsort is stable
+        rows = numpy.repeat(numpy.arange(len(parts)), counts)
+        order = numpy.lexsort((clean, rows))
+        srows, sclean = rows[order], clean[order]
+        first = numpy.ones(len(order), dtype=bool)
+        first[1:] = (srows[1:] != srows[:-1]) | (sclean[1:] != sclean[:-1])
+        keep = numpy.zeros(len(order), dtype=bool)
+        keep[order[first]] = True
+        keep &= clean != ''
+
+        offsets = numpy.zeros(len(parts) + 1, dtype=numpy.int64)
+        numpy.cumsum(numpy.bincount(rows[keep], minlength=len(parts)),
+                     out=offsets[1:])
+        return offsets, clean[keep], raw[keep]
+
+    @classmethod
+    def _split(cls, tagstr):
+        "Returns an iterable with the raw tags found in a non empty string."
+        return tagstr.split(cls.SEPARATOR)
+
+    @classmethod
+    def _split_spans(cls, tagstr, start, end):
+        """ Returns the `(start, end)` positions of the raw tags found in
+        `tagstr[start:end]`, or `None` if they can't be found without
+        parsing the whole string.
+        """
+        size, spans = len(cls.SEPARATOR), []
+        for strtag in tagstr[start:end].split(cls.SEPARATOR):
+            spans.append((start, start + len(strtag)))
+            start += len(strtag) + size
+        return spans
+
+    @classmethod
+    def _split_stream(cls, chunks):
+        "Yields the raw tags found in an iterable of strings."
+        separator, rest = cls.SEPARATOR, ''
+        for chunk in chunks:
+            strtags = (rest + chunk).split(separator)
+            # the last one may continue in the next chunk
+            rest = strtags.pop()
+            for strtag in strtags:
+                yield strtag
+        yield rest
+
+    @classmethod
+    def tags2str(cls, tags):
+        """ Takes a list of tags and returns a string that can be edited.
+
+        :param tags: A list of tags that are correct for the Tokenizer being
+                     used. For instance, when using :class:`CommaTokenizer`,
+                     tags can't have commas on them. Tags can be strings or
+                     Tag objects (their raw value is used).
+
+        :returns: A string that, if serialized, would return the same tags.
+
+        :raise TagWithSeparatorException:
+
+          * if a tag has a space when using :class:`DeliciousTokenizer`, or
+          * a tag has a comma when using :class:`CommaTokenizer`
+        """
+        separator, joiner = cls.SEPARATOR, cls.JOINER
+        if tags.__class__ is not list:
+            tags = list(tags)
+        try:
+            result = joiner.join(tags)
+        except TypeError:
+            tags = _tagstrs(tags)
+            result = joiner.join(tags)
+        # validate all the tags with a single scan of the result: only the
+        # joiners may have separators. Look for the culprit only on errors.
+        if len(separator) != 1 or result.count(separator) != \
+                joiner.count(separator) * (len(tags) - 1):
+            for tag in tags:
+                if separator in tag:
+                    raise TagWithSeparatorException(
+                        "Tag can't include the separator: '%s'" % tag)
+        return result
+
+    @classmethod
+    def tags2str_many(cls, taglists):
+        """ Serializes many lists of tags, lazily.
+
+        :param taglists: An iterable of lists of tags, see :meth:`tags2str`.
+
+        :returns: A generator of strings.
+        """
+        tags2str = cls.tags2str
+        for tags in taglists:
+            yield tags2str(tags)
+
+
+def _tagstrs(tags):
+    "Returns a list with the tags as strings, using the raw value of Tags."
+    if tags.__class__ is not list:
+        tags = list(tags)
+    try:
+        return [tag if isinstance(tag, str) else tag.raw for tag in tags]
+    except AttributeError:
+        for tag in tags:
+            if not isinstance(tag, str) and not hasattr(tag, 'raw'):
+                raise TypeError('Tags must be strings or Tag objects, not '
+                                '%s' % type(tag).__name__)
+        raise
+
+
+def _str2tuples(tokenizer, tagstrs):
+    "Parses a chunk of tag strings in a worker process."
+    return [[tag._astuple() for tag in tags]
+            for tags in tokenizer._str2tags_many(tagstrs)]
+
+
+class DeliciousTokenizer(Tokenizer):
+    """ Tokenizer for Delicious-like tags.
+
+    Delicious tags are separated by spaces, and don't allow spaces in a tag.
+
+    Tags are normalized as lowercase by default to avoid tag duplication.
+    """
+    SEPARATOR = JOINER = ' '
+    TAGS_WITH_SPACES = False
+
+
+class CommaTokenizer(Tokenizer):
+    """ Tokenizer for comma-separated tags.
+
+    Comma separated tags don't allow commas in a tag.
+
+    Tags are normalized as lowercase by default to avoid tag duplication.
+    """
+    SEPARATOR = ','
+    JOINER = ', '
+    TAGS_WITH_SPACES = True
+
+
+class FlickrTokenizer(Tokenizer):
+    """ Tokenizer for Flickr-like tags.
+
+    Flickr tags are separated by spaces. If a tag has spaces, it must be
+    enclosed with double quotes.
+
+    Tags are normalized as lowercase by default to avoid tag duplication.
+    """
+    SEPARATOR = JOINER = ' '
+    QUOTE = '"'
+    ESCAPE = None
+    # the compiled regex of the scanner, set by Dialect.compile
+    RUN = None
+
+    @classmethod
+    def _scanner(cls):
+        return _FlickrScanner(cls.SEPARATOR, cls.QUOTE, cls.ESCAPE, cls.RUN)
+
+    @classmethod
+    def _plain(cls, tagstr):
+        "Returns True if there are no quotes or escapes in `tagstr`."
+        return (cls.QUOTE is None or cls.QUOTE not in tagstr) and \
+            (cls.ESCAPE is None or cls.ESCAPE not in tagstr)
+
+    @classmethod
+    def _split(cls, tagstr):
+        "Parser for the incredibly weird flickr tags (see tests)."
+        if cls._plain(tagstr):
+            return tagstr.split(cls.SEPARATOR)
+        if _speedups is not None:
+            return _speedups.flickr_tokens(tagstr.strip(), cls.SEPARATOR,
+                                           cls.QUOTE, cls.ESCAPE)
+        return _flickr_tokens(tagstr.strip(), cls._scanner())
+
+    @classmethod
+    def _split_spans(cls, tagstr, start, end):
+        # quotes can change the meaning of any space in the string
+        if cls._plain(tagstr):
+            return super(FlickrTokenizer, cls)._split_spans(tagstr, start,
+                                                            end)
+
+    @classmethod
+    def _split_stream(cls, chunks):
+        scanner, held, carry = cls._scanner(), [], ''
+        separator, quote, escape = cls.SEPARATOR, cls.QUOTE, cls.ESCAPE
+        leading = True
+        for chunk in chunks:
+            if leading:
+                # str2tags strips the whole string, skip the leading
+                # whitespace even if it spans several chunks
+                chunk = chunk.lstrip()
+                if not chunk:
+                    continue
+                leading = False
+            if carry:
+                chunk, carry = carry + chunk, ''
+            if escape is not None:
+                # the trailing whitespace of the stream is stripped, so it
+                # can't be escaped, wait until we know if it's trailing
+                stripped = chunk.rstrip()
+                chunk, carry = stripped, chunk[len(stripped):]
+                if chunk.endswith(escape) and \
+                        (len(chunk) - len(chunk.rstrip(escape))) % 2:
+                    # the escaped character is in the next chunk
+                    chunk, carry = chunk[:-1], escape + carry
+            if held and (quote is None or quote not in chunk):
+                held.append(chunk)
+                continue
+            text = ''.join(held) + chunk
+            held = []
+            lastquote = scanner.lastquote(text)
+            if lastquote >= 0:
+                # there is a quote after every space up to here
+                for tok in scanner.feed(text[:lastquote + 1],
+                                        lastquote + 1):
+                    yield tok
+                text = text[lastquote + 1:]
+            if scanner.quoted and scanner.prev == quote and \
+                    text.startswith(separator):
+                # the meaning of this space depends on whether there are
+                # more quotes in the stream, wait until we know
+                held.append(text)
             else:
-                tok += char
-            prev = char
-            del lstr[0]
-        tok = tok.strip()
+                for tok in scanner.feed(text, -1):
+                    yield tok
+        for tok in scanner.feed(''.join(held) + carry.rstrip(), -1):
+            yield tok
+        tok = scanner.close()
         if tok:
-            cls._process_tag(tags, keys, tok)
-        return tags
+            yield tok
 
     @classmethod
     def tags2str(cls, tags):
         'Returns a string of tags. If a tag has spaces, enclose it with "s'
-        return ' '.join([
-            # no X if Y else Z in python<=2.4
-            {True: '"%s"', False: '%s'}[' ' in tag] % tag
-            for tag in tags])
+        separator, quote, escape = cls.SEPARATOR, cls.QUOTE, cls.ESCAPE
+        tags = _tagstrs(tags)
+        if escape is not None:
+            tags = [_escape_tag(tag, escape, quote or separator)
+                    for tag in tags]
+            if quote is None:
+                return cls.JOINER.join(tags)
+        return cls.JOINER.join([quote + tag + quote if separator in tag
+                                else tag for tag in tags])
+
+
+def _escape_tag(tag, escape, special):
+    "Escapes the escape and `special` characters of a tag."
+    if escape in tag:
+        tag = tag.replace(escape, escape + escape)
+    if special in tag:
+        tag = tag.replace(special, escape + special)
+    return tag
+
+
+class _DialectMixin(object):
+    "Tag prefixes and the no spaces rule of the compiled dialects."
+    PREFIX = ''
+
+    @classmethod
+    def _unprefix(cls, strtags):
+        prefix, size = cls.PREFIX, len(cls.PREFIX)
+        # tags can't have spaces, so spaces separate tags too
+        nospaces = cls.TAGS_WITH_SPACES is False and cls.SEPARATOR != ' '
+        for strtag in strtags:
+            strtag = strtag.strip()
+            if nospaces and ' ' in strtag:
+                parts = strtag.split(' ')
+            else:
+                parts = (strtag,)
+            for strtag in parts:
+                if prefix and strtag.startswith(prefix):
+                    strtag = strtag[size:]
+                yield strtag
+
+    @classmethod
+    def _split(cls, tagstr):
+        return cls._unprefix(super(_DialectMixin, cls)._split(tagstr))
+
+    @classmethod
+    def _split_spans(cls, tagstr, start, end):
+        # the prefixes are not part of the raw tags
+        return None
+
+    @classmethod
+    def _split_stream(cls, chunks):
+        return cls._unprefix(super(_DialectMixin, cls)._split_stream(chunks))
+
+    @classmethod
+    def tags2str(cls, tags):
+        tags = _tagstrs(tags)
+        if cls.TAGS_WITH_SPACES is False:
+            for tag in tags:
+                if ' ' in tag:
+                    raise TagWithSeparatorException(
+                        "Tag can't include spaces: '%s'" % tag)
+        if cls.PREFIX:
+            tags = [cls.PREFIX + tag for tag in tags]
+        return super(_DialectMixin, cls).tags2str(tags)
+
+
+class Dialect(object):
+    """ Declarative description of a tag string format.
+
+    :meth:`compile` turns it into a :class:`Tokenizer` subclass, so a new
+    format doesn't need hand-written parsing code::
+
+        SemicolonTokenizer = Dialect(';', joiner='; ').compile(
+            'SemicolonTokenizer')
+        HashtagTokenizer = Dialect(' ', prefix='#', spaces=False).compile(
+            'HashtagTokenizer')
+
+    Plain dialects split with `str.split`, like :class:`CommaTokenizer` and
+    :class:`DeliciousTokenizer`. Dialects with quotes or escapes use the
+    linear state machine of :class:`FlickrTokenizer`, with a regex compiled
+    for their characters, so the built-in tokenizers are the dialects
+    ``Dialect(' ', spaces=False)``, ``Dialect(',', joiner=', ')`` and
+    ``Dialect(' ', quote='"')``.
+
+    :param separator: The string between tags. Must be a single character
+                      if there is a quote or escape character.
+    :param joiner: The string between tags in :meth:`Tokenizer.tags2str`.
+                   Defaults to the separator.
+    :param quote: A character to enclose tags with separators. Quotes
+                  follow the flickr rules.
+    :param escape: A character that makes the next one literal, like a
+                   backslash.
+    :param prefix: A string before every tag, like ``#``, removed when
+                   parsing. Tags without it are accepted too.
+    :param spaces: `False` if tags can't have spaces. By default, tags can
+                   have spaces unless the separator is a space and there
+                   are no quotes or escapes. If they can't, spaces also
+                   separate tags when parsing.
+
+    :raise ValueError: if the characters of the dialect clash.
+    """
+
+    def __init__(self, separator, joiner=None, quote=None, escape=None,
+                 prefix='', spaces=None):
+        if not separator:
+            raise ValueError("The separator can't be empty")
+        if quote is not None or escape is not None:
+            if len(separator) != 1:
+                raise ValueError(
+                    "The separator of a quoted dialect must be a character")
+            chars = [char for char in (separator, quote, escape) if char]
+            if any(len(char) != 1 for char in chars) or \
+                    len(set(chars)) != len(chars):
+                raise ValueError(
+                    "The quote and escape must be different characters")
+        if joiner is None:
+            joiner = separator
+        elif separator not in joiner:
+            raise ValueError("The joiner must include the separator")
+        if spaces is None:
+            spaces = separator != ' ' or quote is not None or \
+                escape is not None
+        elif spaces and separator == ' ' and quote is None and \
+                escape is None:
+            raise ValueError(
+                "Tags can't have spaces if they are separated by spaces")
+        self.separator, self.joiner = separator, joiner
+        self.quote, self.escape, self.prefix = quote, escape, prefix
+        self.spaces = spaces
+
+    def __repr__(self):
+        return 'Dialect(%r, joiner=%r, quote=%r, escape=%r, prefix=%r, ' \
+            'spaces=%r)' % (self.separator, self.joiner, self.quote,
+                            self.escape, self.prefix, self.spaces)
+
+    def compile(self, name='DialectTokenizer', tagclass=Tag):
+        """ Builds a tokenizer for the dialect.
+
+        :param name: The name of the new class. Assign it to a module level
+                     variable with the same name to use the tokenizer in a
+                     process pool (for instance, with
+                     :meth:`Tokenizer.str2tags_many`).
+        :param tagclass: The TAGCLASS of the tokenizer.
+
+        :returns: A :class:`Tokenizer` subclass.
+        """
+        attrs = {'SEPARATOR': self.separator, 'JOINER': self.joiner,
+                 'TAGS_WITH_SPACES': self.spaces, 'TAGCLASS': tagclass,
+                 'DIALECT': self, '__doc__': 'Tokenizer for %r' % self}
+        bases = (Tokenizer,)
+        if self.quote is not None or self.escape is not None:
+            attrs.update(QUOTE=self.quote, ESCAPE=self.escape,
+                         RUN=_scanner_run(self.separator, self.quote,
+                                          self.escape))
+            bases = (FlickrTokenizer,)
+        if self.prefix or (not self.spaces and self.separator != ' '):
+            attrs['PREFIX'] = self.prefix
+            bases = (_DialectMixin,) + bases
+        tokenizer = type(name, bases, attrs)
+        # like namedtuple, so that pickle can find the class
+        try:
+            tokenizer.__module__ = sys._getframe(1).f_globals.get(
+                '__name__', '__main__')
+        except (AttributeError, ValueError):  # pragma: no cover
+            pass
+        return tokenizer
+
+
+class TagIndex(object):
+    """ In-memory inverted index of items by their tags.
+
+    :param tokenizer: The Tokenizer subclass used to parse the tag strings
+                      of the items.
+
+    Items are added with their tag string, and can then be searched by tag,
+    tag prefix or machine tag namespace and predicate::
+
+        index = TagIndex(CommaTokenizer)
+        index.add(1, 'python, geo:lat=12')
+        index.add(2, 'Python, django')
+        index.search(include=['python'], exclude=['django'])  # {1}
+        index.search(include=['geo:lat=*'])                    # {1}
+
+    Item ids can be any hashable value. Internally, every item gets a
+    dense integer id, and the posting lists are sets of those, so boolean
+    queries are plain set operations.
+    """
+
+    def __init__(self, tokenizer):
+        self.tokenizer = tokenizer
+        self.normalize = tokenizer.TAGCLASS.normalize
+        self.postings = {}
+        self.namespaces = {}
+        self.predicates = {}
+        self._docids = {}
+        self._items = []
+        self._doctags = {}
+        self._sortedtags = []
+
+    def __len__(self):
+        return len(self._docids)
+
+    def __contains__(self, item_id):
+        return item_id in self._docids
+
+    def add(self, item_id, tagstr):
+        "Indexes an item, replacing its tags if it was already indexed."
+        self._add(item_id, self.tokenizer.str2tags(tagstr))
+
+    def add_many(self, items):
+        "Indexes an iterable of `(item_id, tagstr)` pairs."
+        items = iter(items)
+        pairs = deque()
+
+        def tagstrs():
+            for pair in items:
+                pairs.append(pair[0])
+                yield pair[1]
+        for tags in self.tokenizer.str2tags_many(tagstrs()):
+            self._add(pairs.popleft(), tags)
+
+    def remove(self, item_id):
+        "Removes an item from the index."
+        docid = self._docids.pop(item_id)
+        self._items[docid] = None
+        self._unindex(docid)
+
+    def tags(self, item_id):
+        "Returns the clean values of the tags of an item."
+        return [clean for clean, machine in
+                self._doctags[self._docids[item_id]]]
+
+    def search(self, include=(), either=(), exclude=()):
+        """ Returns the set of ids of the items that have all the tags in
+        `include`, at least one of the tags in `either` (if any) and none of
+        the tags in `exclude`.
+
+        Tags are normalized before searching. A tag ending with `*` matches
+        by prefix: `geo:*` matches all the machine tags in the `geo`
+        namespace, `geo:lat=*` all the `geo:lat` machine tags and `py*`
+        all the tags that start with `py`.
+        """
+        result = None
+        for term in include:
+            docids = self._postings(term)
+            if result is None:
+                result = set(docids)
+            else:
+                result &= docids
+            if not result:
+                return set()
+        if either:
+            docids = set()
+            for term in either:
+                docids |= self._postings(term)
+            if result is None:
+                result = docids
+            else:
+                result &= docids
+        if result is None:
+            result = set(range(len(self._items)))
+        for term in exclude:
+            result -= self._postings(term)
+        items = self._items
+        return set([items[docid] for docid in result
+                    if items[docid] is not None])
+
+    def prefix(self, prefix):
+        "Returns the clean values of the indexed tags starting with prefix."
+        prefix = self.normalize(prefix)
+        tags, start = self._sortedtags, bisect_left(self._sortedtags, prefix)
+        result = []
+        for clean in islice(tags, start, None):
+            if not clean.startswith(prefix):
+                break
+            result.append(clean)
+        return result
+
+    def cooccurring(self, tag, k=10):
+        """ Returns the `k` tags that appear in more items along with `tag`,
+        as a list of `(clean, count)` tuples, most common first.
+        """
+        clean = self.normalize(tag)
+        counter, doctags = Counter(), self._doctags
+        for docid in self.postings.get(clean, ()):
+            counter.update([other for other, machine in doctags[docid]])
+        del counter[clean]
+        return counter.most_common(k)
+
+    def _postings(self, term):
+        term = term.strip()
+        if not term.endswith('*'):
+            return self.postings.get(self.normalize(term), set())
+        # namespaces and predicates of machine tags are always lowercase
+        term = term[:-1]
+        if term.endswith('=') and term.count(':') == 1:
+            namespace, predicate = term[:-1].lower().split(':')
+            return self.predicates.get((namespace, predicate), set())
+        if term.endswith(':') and term.count(':') == 1:
+            return self.namespaces.get(term[:-1].lower(), set())
+        docids, postings = set(), self.postings
+        for clean in self.prefix(term):
+            docids |= postings[clean]
+        return docids
+
+    def _add(self, item_id, tags):
+        docid = self._docids.get(item_id)
+        if docid is None:
+            docid = self._docids[item_id] = len(self._items)
+            self._items.append(item_id)
+        else:
+            self._unindex(docid)
+        doctags = []
+        for tag in tags:
+            machine = None
+            if tag.is_machinetag:
+                machine = (tag.namespace, tag.predicate)
+                self._post(self.namespaces, tag.namespace, docid)
+                self._post(self.predicates, machine, docid)
+            if self._post(self.postings, tag.clean, docid):
+                insort(self._sortedtags, tag.clean)
+            doctags.append((tag.clean, machine))
+        self._doctags[docid] = tuple(doctags)
+
+    def _unindex(self, docid):
+        for clean, machine in self._doctags.pop(docid):
+            if machine:
+                self._unpost(self.namespaces, machine[0], docid)
+                self._unpost(self.predicates, machine, docid)
+            if self._unpost(self.postings, clean, docid):
+                tags = self._sortedtags
+                del tags[bisect_left(tags, clean)]
+
+    @staticmethod
+    def _post(postings, key, docid):
+        "Adds docid to a posting list, returns True if it's a new list."
+        docids = postings.get(key)
+        if docids is None:
+            postings[key] = set([docid])
+            return True
+        docids.add(docid)
+        return False
+
+    @staticmethod
+    def _unpost(postings, key, docid):
+        "Removes docid from a posting list, returns True if it's now empty."
+        docids = postings.get(key)
+        if docids is None:
+            # already emptied by another tag of the same item
+            return False
+        docids.discard(docid)
+        if not docids:
+            del postings[key]
+            return True
+        return False
+
+
+class MachineTagStore(object):
+    """ Machine tags grouped by namespace and predicate.
+
+    :param tagclass: The Tag class used to normalize the values in queries.
+
+    Tags are added with an optional item (any value, like the id of the
+    tagged object), and queried with flickr style wildcards::
+
+        store = MachineTagStore()
+        for tag in FlickrTokenizer.str2tags('geo:lat=12.5 upload:by=me'):
+            store.add(tag, item=1)
+        store.query('geo:')             # all the geo machine tags
+        store.query('geo:lat=')         # all the geo:lat machine tags
+        store.query('*:by=me')          # by=me in any namespace
+        store.between('geo', 'lat', 10, 20)
+
+    Queries return lists of `(tag, item)` tuples.
+    """
+
+    def __init__(self, tagclass=Tag):
+        self.tagclass = tagclass
+        self._values = {}
+        self._numbers = {}
+        self._predicates = {}
+        self._namespaces = {}
+        self._unsorted = set()
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def add(self, tag, item=None):
+        """ Adds a machine tag. Returns False, and does nothing, if `tag`
+        is not a machine tag.
+        """
+        if not tag.is_machinetag:
+            return False
+        key = (tag.namespace, tag.predicate)
+        values = self._values.get(key)
+        if values is None:
+            values = self._values[key] = {}
+            self._numbers[key] = ([], [])
+            self._predicates.setdefault(tag.namespace, set()).add(
+                tag.predicate)
+            self._namespaces.setdefault(tag.predicate, set()).add(
+                tag.namespace)
+        entries = values.get(tag.value)
+        if entries is None:
+            entries = values[tag.value] = []
+            number = self._number(tag.value)
+            if number is not None:
+                # sorted on the next range scan
+                numbers, numvalues = self._numbers[key]
+                numbers.append(number)
+                numvalues.append(tag.value)
+                self._unsorted.add(key)
+        entries.append((tag, item))
+        self._count += 1
+        return True
+
+    def remove(self, tag, item=None):
+        "Removes a machine tag added with :meth:`add`."
+        key = (tag.namespace, tag.predicate)
+        values = self._values.get(key, {})
+        entries = values.get(tag.value, [])
+        for pos, (other, otheritem) in enumerate(entries):
+            if other.clean == tag.clean and otheritem == item:
+                break
+        else:
+            raise KeyError(tag.raw)
+        del entries[pos]
+        self._count -= 1
+        if entries:
+            return
+        del values[tag.value]
+        numbers, numvalues = self._numbers[key]
+        if tag.value in numvalues:
+            pos = numvalues.index(tag.value)
+            del numbers[pos], numvalues[pos]
+        if values:
+            return
+        del self._values[key], self._numbers[key]
+        self._unsorted.discard(key)
+        for index, first, second in (
+                (self._predicates, tag.namespace, tag.predicate),
+                (self._namespaces, tag.predicate, tag.namespace)):
+            index[first].discard(second)
+            if not index[first]:
+                del index[first]
+
+    def query(self, pattern):
+        """ Returns the machine tags that match a flickr style pattern:
+        `namespace:predicate=value`, where any part can be `*` or empty to
+        match anything (`geo:`, `geo:lat=`, `*:lat=12`).
+
+        :raise ValueError: if the pattern is not a valid query.
+        """
+        match = RE_MACHINE_TAG_QUERY.match(pattern.strip())
+        if not match:
+            raise ValueError('Invalid machine tag query: %s' % pattern)
+        namespace, predicate, value = [
+            part not in ('', '*') and part or None
+            for part in match.groups()]
+        if namespace and predicate:
+            keys = [(namespace, predicate)]
+        elif namespace:
+            keys = [(namespace, other)
+                    for other in self._predicates.get(namespace, ())]
+        elif predicate:
+            keys = [(other, predicate)
+                    for other in self._namespaces.get(predicate, ())]
+        else:
+            keys = list(self._values)
+        if value is not None:
+            value = self.tagclass.normalize(value)
+        result = []
+        for key in sorted(keys):
+            values = self._values.get(key, {})
+            if value is None:
+                for other in sorted(values):
+                    result.extend(values[other])
+            else:
+                result.extend(values.get(value, ()))
+        return result
+
+    def between(self, namespace, predicate, low=None, high=None):
+        """ Returns the `namespace:predicate` machine tags with a numeric
+        value between `low` and `high` (both inclusive, `None` means no
+        limit), sorted by value.
+        """
+        key = (namespace, predicate)
+        numbers, numvalues = self._numbers.get(key, ([], []))
+        if key in self._unsorted:
+            pairs = sorted(zip(numbers, numvalues))
+            numbers[:] = [number for number, value in pairs]
+            numvalues[:] = [value for number, value in pairs]
+            self._unsorted.discard(key)
+        start, end = 0, len(numbers)
+        if low is not None:
+            start = bisect_left(numbers, low)
+        if high is not None:
+            end = bisect_right(numbers, high)
+        values, result = self._values.get(key, {}), []
+        for value in numvalues[start:end]:
+            result.extend(values[value])
+        return result
+
+    @staticmethod
+    def _number(value):
+        try:
+            number = float(value)
+        except ValueError:
+            return None
+        if math.isfinite(number):
+            return number
+
+
+def _prefix_range(keys, prefix):
+    "Returns the `(start, end)` range of the sorted keys with a prefix."
+    start = bisect_left(keys, prefix)
+    if not prefix:
+        return start, len(keys)
+    last = ord(prefix[-1])
+    if last == sys.maxunicode:
+        end = start
+        while end < len(keys) and keys[end].startswith(prefix):
+            end += 1
+        return start, end
+    return start, bisect_left(keys, prefix[:-1] + chr(last + 1), start)
+
+
+class _PrefixCounter(object):
+    """ Counts of strings, with top-k queries by prefix.
+
+    The keys are kept in a sorted list, with a segment tree that has the
+    position of the best leaf (highest count, then first key) of every
+    node, so the best keys of a prefix range are found in O(k log n).
+    Count changes update the tree in place. New keys are kept apart (and
+    sorted when queried) until there are enough of them to rebuild the tree
+    on the next query.
+    """
+
+    def __init__(self):
+        self.counts = {}
+        self._pending = set()
+        self._rebuild()
+
+    def __len__(self):
+        return len(self.counts)
+
+    def add(self, key, delta=1):
+        "Adds `delta` (that can be negative) to the count of `key`."
+        count = self.counts.get(key, 0) + delta
+        if count < 0:
+            raise KeyError(key)
+        if count:
+            self.counts[key] = count
+        else:
+            self.counts.pop(key, None)
+        pos = self._positions.get(key)
+        if pos is not None:
+            self._update(pos, count)
+        elif count == delta or not count:
+            if count:
+                self._pending.add(key)
+            else:
+                self._pending.discard(key)
+            self._sorted = None
+
+    def top(self, prefix, k):
+        "Returns the `k` best `(key, count)` tuples that start with prefix."
+        if len(self._pending) > max(1024, len(self._keys) // 64):
+            self._rebuild()
+        start, end = _prefix_range(self._keys, prefix)
+        keys, values = self._keys, self._values
+        result = [(keys[pos], values[pos])
+                  for pos in self._best(start, end, k)]
+        if self._pending:
+            if self._sorted is None:
+                self._sorted = sorted(self._pending)
+            start, end = _prefix_range(self._sorted, prefix)
+            counts = self.counts
+            result.extend([(key, counts[key])
+                           for key in self._sorted[start:end]])
+            result.sort(key=lambda pair: (-pair[1], pair[0]))
+        return result[:k]
+
+    def _rebuild(self):
+        self._keys = keys = sorted(self.counts)
+        self._positions = dict(zip(keys, range(len(keys))))
+        self._values = [self.counts[key] for key in keys]
+        self._pending, self._sorted = set(), None
+        size = 1
+        while size < len(keys):
+            size *= 2
+        self._size = size
+        tree = self._tree = [-1] * (2 * size)
+        tree[size:size + len(keys)] = range(len(keys))
+        for node in range(size - 1, 0, -1):
+            tree[node] = self._better(tree[2 * node], tree[2 * node + 1])
+
+    def _better(self, first, second):
+        if second < 0 or (first >= 0 and
+                          self._values[first] >= self._values[second]):
+            return first
+        return second
+
+    def _update(self, pos, count):
+        self._values[pos] = count
+        tree, better = self._tree, self._better
+        node = (pos + self._size) // 2
+        while node:
+            tree[node] = better(tree[2 * node], tree[2 * node + 1])
+            node //= 2
+
+    def _best(self, start, end, k):
+        "Yields the positions of the best (non zero) keys in a range."
+        tree, values, heap = self._tree, self._values, []
+
+        def push(node):
+            pos = tree[node]
+            if pos >= 0 and values[pos]:
+                heappush(heap, (-values[pos], pos, node))
+
+        # the canonical nodes of the range, best first from there
+        first, last = start + self._size, end + self._size
+        while first < last:
+            if first & 1:
+                push(first)
+                first += 1
+            if last & 1:
+                last -= 1
+                push(last)
+            first //= 2
+            last //= 2
+        found = 0
+        while heap and found < k:
+            count, pos, node = heappop(heap)
+            if node >= self._size:
+                found += 1
+                yield pos
+            else:
+                push(2 * node)
+                push(2 * node + 1)
+
+    def save(self, fileobj):
+        keys = sorted(self.counts)
+        counts = array('Q', [self.counts[key] for key in keys])
+        if sys.byteorder == 'big':  # pragma: no cover
+            counts.byteswap()
+        fileobj.write(struct.pack('<I', len(keys)))
+        _write_strings(fileobj, keys)
+        fileobj.write(counts.tobytes())
+
+    def load(self, fileobj):
+        count, = struct.unpack('<I', fileobj.read(4))
+        keys = _read_strings(fileobj, count)
+        counts = array('Q')
+        counts.frombytes(fileobj.read(count * counts.itemsize))
+        if sys.byteorder == 'big':  # pragma: no cover
+            counts.byteswap()
+        self.counts = dict(zip(keys, counts))
+        self._rebuild()
+
+
+class TagCompleter(object):
+    """ Frequency weighted autocompletion of tags.
+
+    Feed it with tag strings (or Tag objects) and it suggests the most
+    used tags that start with a prefix::
+
+        completer = TagCompleter(CommaTokenizer)
+        completer.add('Python, Django, geo:lat=12')
+        completer.add('python, pygame')
+        completer.complete('py')            # [('Python', 2), ('pygame', 1)]
+        completer.complete_machinetag('ge') # [('geo:', 1)]
+
+    Tags are counted by their clean value, and suggested with their most
+    common raw spelling. Machine tags are also counted by namespace and by
+    namespace and predicate, to complete them a part at a time.
+
+    :param tokenizer: The tokenizer used to parse tag strings and to
+                      normalize prefixes.
+    """
+    MAGIC = b'TAGCMP1\n'
+
+    def __init__(self, tokenizer):
+        self.tokenizer = tokenizer
+        self._raws = {}
+        self._tags = _PrefixCounter()
+        self._namespaces = _PrefixCounter()
+        self._predicates = _PrefixCounter()
+
+    def __len__(self):
+        return len(self._tags)
+
+    def __contains__(self, clean):
+        return clean in self._tags.counts
+
+    def add(self, tagstr, count=1):
+        "Parses a tag string and adds its tags."
+        self.add_tags(self.tokenizer.str2tags(tagstr), count)
+
+    def remove(self, tagstr, count=1):
+        """ Parses a tag string and removes its tags.
+
+        :raise KeyError: if a tag was not added before.
+        """
+        self.remove_tags(self.tokenizer.str2tags(tagstr), count)
+
+    def add_tags(self, tags, count=1):
+        "Adds Tag objects, `count` times each."
+        for tag in tags:
+            self._add(tag, count)
+
+    def remove_tags(self, tags, count=1):
+        """ Removes Tag objects, `count` times each.
+
+        :raise KeyError: if a tag was not added before.
+        """
+        tags = list(tags)
+        for tag in tags:
+            raws = self._raws.get(tag.clean, {})
+            if raws.get(tag.raw, 0) < count:
+                raise KeyError(tag.raw)
+        for tag in tags:
+            self._add(tag, -count)
+
+    def count(self, clean):
+        "Returns how many times a tag (by clean value) was added."
+        return self._tags.counts.get(clean, 0)
+
+    def raw(self, clean):
+        "Returns the most common raw spelling of a tag, or None."
+        raws = self._raws.get(clean)
+        if raws:
+            return max(raws, key=raws.__getitem__)
+
+    def complete(self, prefix, k=10):
+        """ Returns the `k` most used tags that start with `prefix`.
+
+        :param prefix: The text typed so far. It's normalized like a tag.
+
+        :returns: A list of `(raw, count)` tuples, by descending count.
+        """
+        prefix = self.tokenizer.TAGCLASS.normalize(prefix.lstrip())
+        return [(self.raw(clean), count)
+                for clean, count in self._tags.top(prefix, k)]
+
+    def complete_machinetag(self, prefix, k=10):
+        """ Completes a machine tag a part at a time: the namespace
+        (``ge`` suggests ``geo:``), then the predicate (``geo:l`` suggests
+        ``geo:lat=``), then the value (``geo:lat=1`` suggests full tags).
+
+        :returns: A list of `(text, count)` tuples, by descending count.
+        """
+        prefix = prefix.lstrip()
+        if '=' in prefix:
+            return self.complete(prefix, k)
+        # namespaces and predicates of machine tags are always lowercase
+        prefix = prefix.lower()
+        if ':' in prefix:
+            return self._predicates.top(prefix, k)
+        return self._namespaces.top(prefix, k)
+
+    def _add(self, tag, count):
+        clean, raw = tag.clean, tag.raw
+        raws = self._raws.setdefault(clean, {})
+        total = raws.get(raw, 0) + count
+        if total:
+            raws[raw] = total
+        else:
+            del raws[raw]
+            if not raws:
+                del self._raws[clean]
+        self._tags.add(clean, count)
+        if tag.is_machinetag:
+            self._namespaces.add(tag.namespace + ':', count)
+            self._predicates.add(
+                '%s:%s=' % (tag.namespace, tag.predicate), count)
+
+    def save(self, fileobj):
+        """ Writes the completer to a file-like object opened in binary
+        mode, in a compact format that loads fast with :meth:`load`.
+        """
+        cleans, raws, counts = [], [], array('Q')
+        for clean in sorted(self._raws):
+            for raw, count in self._raws[clean].items():
+                cleans.append(clean)
+                raws.append(raw)
+                counts.append(count)
+        if sys.byteorder == 'big':  # pragma: no cover
+            counts.byteswap()
+        fileobj.write(self.MAGIC)
+        fileobj.write(struct.pack('<I', len(cleans)))
+        _write_strings(fileobj, cleans)
+        _write_strings(fileobj, raws)
+        fileobj.write(counts.tobytes())
+        for counter in (self._namespaces, self._predicates):
+            counter.save(fileobj)
+
+    @classmethod
+    def load(cls, fileobj, tokenizer):
+        "Reads a completer written with :meth:`save`."
+        if fileobj.read(len(cls.MAGIC)) != cls.MAGIC:
+            raise ValueError('Not a tag completer file')
+        completer = cls(tokenizer)
+        size, = struct.unpack('<I', fileobj.read(4))
+        cleans = _read_strings(fileobj, size)
+        raws = _read_strings(fileobj, size)
+        counts = array('Q')
+        counts.frombytes(fileobj.read(size * counts.itemsize))
+        if sys.byteorder == 'big':  # pragma: no cover
+            counts.byteswap()
+        tagcounts = completer._tags.counts
+        for clean, raw, count in zip(cleans, raws, counts):
+            completer._raws.setdefault(clean, {})[raw] = count
+            tagcounts[clean] = tagcounts.get(clean, 0) + count
+        completer._tags._rebuild()
+        for counter in (completer._namespaces, completer._predicates):
+            counter.load(fileobj)
+        return completer
+
+
+class TagClusterer(object):
+    """ Finds near-duplicate tags in a vocabulary, like ``newyork``,
+    ``new york`` and ``new-york``, or ``photography`` and ``photograpy``.
+
+    Tags with the same letters and digits (ignoring spaces, punctuation and
+    symbols) are grouped first. Then the character n-grams of those
+    skeletons are compared: tags whose n-gram sets have a Jaccard
+    similarity of at least `threshold` are grouped too, unless they have
+    different numbers (``tag1`` and ``tag2`` are not duplicates). Machine
+    tags are never grouped.
+
+    Candidate pairs come from a MinHash-LSH index instead of comparing all
+    the pairs: tags are compared only if their MinHash signatures are the
+    same in at least one of `bands` bands of `rows` hashes. The defaults
+    find about 98% of the pairs with a similarity of 0.7, and almost all
+    of the more similar ones. The candidates are checked with their exact
+    similarity, so there are no false positives.
+
+    :param threshold: Minimum Jaccard similarity, between 0 and 1.
+    :param ngram: Size of the character n-grams.
+    :param bands: Number of LSH bands, more find more pairs.
+    :param rows: Hashes per band, more find fewer (less similar) pairs.
+    :param bucket_size: Maximum number of tags compared in an LSH bucket,
+                        to bound the work with very common n-grams.
+    """
+    RE_SKELETON = re.compile(r'[\W_]+')
+    RE_NUMBERS = re.compile(r'\d+')
+
+    def __init__(self, threshold=0.7, ngram=3, bands=10, rows=3,
+                 bucket_size=64):
+        if not 0 < threshold <= 1:
+            raise ValueError('The threshold must be between 0 and 1')
+        self.threshold = threshold
+        self.ngram = ngram
+        self.bands, self.rows = bands, rows
+        self.bucket_size = bucket_size
+
+    def cluster(self, tags, aliases=None):
+        """ Groups the near-duplicate tags of a vocabulary.
+
+        :param tags: The normalized tags, as a dict (or Counter) of tag
+                     counts, or an iterable of tags.
+        :param aliases: An optional dict that maps tags to their canonical
+                        form, for synonyms that don't look alike (``nyc``
+                        to ``new york``).
+
+        :returns: A dict that maps every tag that is not the canonical form
+                  of its group to the canonical one. The canonical form is
+                  an alias target if there is one in the group, or else
+                  the most used tag (then the shortest one).
+        """
+        if not isinstance(tags, dict):
+            tags = Counter(tags)
+        aliases = aliases or {}
+        names = list(tags)
+        ids = dict(zip(names, range(len(names))))
+        for name in chain(aliases, aliases.values()):
+            if name not in ids:
+                ids[name] = len(names)
+                names.append(name)
+        parent = list(range(len(names)))
+
+        def find(node):
+            while parent[node] != node:
+                parent[node] = parent[parent[node]]
+                node = parent[node]
+            return node
+
+        def union(first, second):
+            first, second = find(first), find(second)
+            if first != second:
+                parent[max(first, second)] = min(first, second)
+
+        # same skeleton, then similar skeletons
+        skeletons = {}
+        for node, name in enumerate(names):
+            if ':' in name and '=' in name and RE_MACHINE_TAG.match(name):
+                continue
+            skeleton = self.RE_SKELETON.sub('', name)
+            if skeleton:
+                other = skeletons.setdefault(skeleton, node)
+                if other != node:
+                    union(other, node)
+        for first, second in self._similar(list(skeletons)):
+            union(skeletons[first], skeletons[second])
+        for alias, target in aliases.items():
+            union(ids[alias], ids[target])
+
+        groups = {}
+        for node in range(len(names)):
+            groups.setdefault(find(node), []).append(names[node])
+        targets = set(aliases.values())
+        mapping = {}
+        for members in groups.values():
+            if len(members) < 2:
+                continue
+            canonical = min(members, key=lambda name: (
+                name not in targets, name in aliases, -tags.get(name, 0),
+                len(name), name))
+            for name in members:
+                if name != canonical:
+                    mapping[name] = canonical
+        return mapping
+
+    def _similar(self, skeletons):
+        "Yields the pairs of similar skeletons."
+        size, threshold, rows = self.ngram, self.threshold, self.rows
+        grams = [set([skeleton[pos:pos + size]
+                      for pos in range(max(1, len(skeleton) - size + 1))])
+                 for skeleton in skeletons]
+        # a MinHash signature is the minimum of every hash function over
+        # the n-grams, hashed once per distinct n-gram
+        hashes = {}
+        seeds = [(zlib.crc32(b'm%d' % seed) | 1, zlib.crc32(b'o%d' % seed))
+                 for seed in range(self.bands * rows)]
+        for tokens in grams:
+            for gram in tokens:
+                if gram not in hashes:
+                    value = zlib.crc32(gram.encode('utf-8'))
+                    hashes[gram] = tuple([
+                        (multiplier * value + offset) % 4294967311
+                        for multiplier, offset in seeds])
+        buckets = [{} for band in range(self.bands)]
+        for node, tokens in enumerate(grams):
+            signature = tuple(map(min, zip(*[hashes[gram]
+                                             for gram in tokens])))
+            for band, bucket in enumerate(buckets):
+                key = signature[band * rows:(band + 1) * rows]
+                members = bucket.get(key)
+                if members is None:
+                    bucket[key] = [node]
+                elif len(members) < self.bucket_size:
+                    members.append(node)
+
+        numbers, checked = self.RE_NUMBERS.findall, set()
+        for bucket in buckets:
+            for members in bucket.values():
+                for pos, node in enumerate(members):
+                    for other in members[:pos]:
+                        if (other, node) in checked:
+                            continue
+                        checked.add((other, node))
+                        common = len(grams[node] & grams[other])
+                        total = len(grams[node]) + len(grams[other]) - common
+                        if common >= threshold * total - 1e-9 and \
+                                numbers(skeletons[node]) == \
+                                numbers(skeletons[other]):
+                            yield skeletons[other], skeletons[node]
+
+
+class SpaceSaving(object):
+    """ Approximate top-k counter in bounded memory (the Space-Saving
+    algorithm).
+
+    Counts at most `capacity` keys. A new key replaces the one with the
+    lowest count, and inherits that count as its possible overestimation
+    (`errors`). Every key with more than `total / capacity` occurrences
+    is always kept.
+
+    :param capacity: Maximum number of counted keys.
+    """
+
+    def __init__(self, capacity=1000):
+        self.capacity = capacity
+        self.counts = {}
+        self.errors = {}
+        self.total = 0
+        self._heap = []
+
+    def __len__(self):
+        return len(self.counts)
+
+    def add(self, key, count=1):
+        "Counts `count` occurrences of `key`."
+        counts = self.counts
+        self.total += count
+        if key in counts:
+            # the heap entry is updated lazily, when it's the lowest one
+            counts[key] += count
+        else:
+            self._add(key, count)
+
+    def update(self, keys):
+        "Counts one occurrence of every key of an iterable."
+        counts, add = self.counts, self._add
+        for key in keys:
+            self.total += 1
+            if key in counts:
+                counts[key] += 1
+            else:
+                add(key, 1)
+
+    def _add(self, key, count):
+        counts = self.counts
+        if len(counts) < self.capacity:
+            counts[key] = count
+            self.errors[key] = 0
+            heappush(self._heap, (count, key))
+            return
+        heap = self._heap
+        while counts[heap[0][1]] != heap[0][0]:
+            victim = heap[0][1]
+            heapreplace(heap, (counts[victim], victim))
+        low, victim = heap[0]
+        del counts[victim], self.errors[victim]
+        counts[key] = low + count
+        self.errors[key] = low
+        heapreplace(heap, (low + count, key))
+
+    def top(self, k=10):
+        "Returns the `k` most common `(key, count)` tuples."
+        counts = self.counts
+        return [(key, counts[key]) for key in
+                sorted(counts, key=lambda key: (-counts[key], key))[:k]]
+
+    def merge(self, other):
+        """ Adds the counts of another SpaceSaving. Keys missing in a full
+        counter are estimated with its lowest count.
+        """
+        lows = [counter.counts and len(counter) >= counter.capacity and
+                min(counter.counts.values()) or 0
+                for counter in (self, other)]
+        counts, errors = {}, {}
+        for key in set(self.counts).union(other.counts):
+            counts[key] = self.counts.get(key, lows[0]) + \
+                other.counts.get(key, lows[1])
+            errors[key] = self.errors.get(key, lows[0]) + \
+                other.errors.get(key, lows[1])
+        keep = sorted(counts, key=lambda key: (-counts[key], key))
+        keep = keep[:self.capacity]
+        self.counts = dict([(key, counts[key]) for key in keep])
+        self.errors = dict([(key, errors[key]) for key in keep])
+        self.total += other.total
+        self._heap = [(count, key) for key, count in self.counts.items()]
+        self._heap.sort()
+
+    def save(self, fileobj):
+        keys = sorted(self.counts)
+        counts = array('Q', [self.counts[key] for key in keys])
+        errors = array('Q', [self.errors[key] for key in keys])
+        if sys.byteorder == 'big':  # pragma: no cover
+            counts.byteswap()
+            errors.byteswap()
+        fileobj.write(struct.pack('<IIQ', self.capacity, len(keys),
+                                  self.total))
+        _write_strings(fileobj, keys)
+        fileobj.write(counts.tobytes())
+        fileobj.write(errors.tobytes())
+
+    @classmethod
+    def load(cls, fileobj):
+        capacity, size, total = struct.unpack('<IIQ', fileobj.read(16))
+        counter = cls(capacity)
+        counter.total = total
+        keys = _read_strings(fileobj, size)
+        counts, errors = array('Q'), array('Q')
+        counts.frombytes(fileobj.read(size * counts.itemsize))
+        errors.frombytes(fileobj.read(size * errors.itemsize))
+        if sys.byteorder == 'big':  # pragma: no cover
+            counts.byteswap()
+            errors.byteswap()
+        counter.counts = dict(zip(keys, counts))
+        counter.errors = dict(zip(keys, errors))
+        counter._heap = sorted(zip(counts, keys))
+        return counter
+
+
+class HyperLogLog(object):
+    """ Approximate count of distinct strings in bounded memory.
+
+    Uses ``2 ** precision`` one byte registers, with a standard error of
+    about ``1.04 / sqrt(2 ** precision)`` (0.8% with the default).
+
+    :param precision: Between 4 and 18.
+    """
+
+    def __init__(self, precision=14):
+        if not 4 <= precision <= 18:
+            raise ValueError('The precision must be between 4 and 18')
+        self.precision = precision
+        self.registers = bytearray(1 << precision)
+
+    def add(self, value):
+        "Adds a string."
+        self.update((value,))
+
+    def update(self, values):
+        "Adds an iterable of strings."
+        registers, bits = self.registers, 64 - self.precision
+        mask, blake2b, frombytes = (1 << bits) - 1, hashlib.blake2b, \
+            int.from_bytes
+        for value in values:
+            value = frombytes(blake2b(value.encode('utf-8', 'surrogatepass'),
+                                      digest_size=8).digest(), 'little')
+            index = value >> bits
+            rank = bits - (value & mask).bit_length() + 1
+            if rank > registers[index]:
+                registers[index] = rank
+
+    def count(self):
+        "Returns the estimated number of distinct strings added."
+        size = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / size)
+        estimate = alpha * size * size / sum([
+            number * 2.0 ** -rank
+            for rank, number in Counter(self.registers).items()])
+        zeros = self.registers.count(0)
+        if zeros and estimate <= 2.5 * size:
+            # linear counting is better for small cardinalities
+            estimate = size * math.log(size / zeros)
+        return int(round(estimate))
+
+    def merge(self, other):
+        """ Adds the strings counted by another HyperLogLog.
+
+        :raise ValueError: if the precisions are different.
+        """
+        if other.precision != self.precision:
+            raise ValueError("Can't merge HyperLogLogs with different "
+                             "precisions")
+        self.registers = bytearray(map(max, self.registers, other.registers))
+
+    def save(self, fileobj):
+        fileobj.write(struct.pack('<B', self.precision))
+        fileobj.write(self.registers)
+
+    @classmethod
+    def load(cls, fileobj):
+        precision, = struct.unpack('<B', fileobj.read(1))
+        counter = cls(precision)
+        counter.registers = bytearray(fileobj.read(1 << precision))
+        return counter
+
+
+class TagStats(object):
+    """ Live statistics of a stream of tag strings, in bounded memory.
+
+    Keeps the most used tags (by clean value) in a :class:`SpaceSaving`
+    counter, the number of distinct tags in a :class:`HyperLogLog`, and
+    exact counts of the machine tag namespaces::
+
+        stats = TagStats(CommaTokenizer)
+        stats.add_many(tagstrs)
+        stats.top(10)
+        stats.distinct()
+        stats.duplicate_rate()
+        stats.namespaces.most_common(5)
+
+    Stats of different workers can be combined with :meth:`merge`, and
+    saved with :meth:`save` (or pickled).
+
+    :param tokenizer: The tokenizer used to parse tag strings.
+    :param capacity: Number of tags in the top-k counter.
+    :param precision: Precision of the HyperLogLog.
+
+    The `strings`, `tokens` (non blank raw tags) and `tags` attributes
+    count what was added. Tokens that are not tags were dropped as
+    duplicates of a previous tag of the same string (or were empty once
+    normalized).
+    """
+    MAGIC = b'TAGSTA1\n'
+
+    def __init__(self, tokenizer, capacity=1000, precision=14):
+        self.tokenizer = tokenizer
+        self.strings = self.tokens = self.tags = 0
+        self.popular = SpaceSaving(capacity)
+        self.cardinality = HyperLogLog(precision)
+        self.namespaces = Counter()
+
+    def add(self, tagstr):
+        """ Parses a tag string and counts its tags. The tags are built
+        like :meth:`Tokenizer.str2tags` does, without the CACHE and
+        PROFILER of the tokenizer.
+        """
+        self.strings += 1
+        if not tagstr:
+            return
+        strtags = list(self.tokenizer._split(tagstr))
+        # the tags of str2tags, built from the same split
+        tags = self.tokenizer._tags(strtags)
+        self.tokens += len(strtags) - [
+            strtag.strip() for strtag in strtags].count('')
+        self._count(tags)
+
+    def add_many(self, tagstrs):
+        "Parses and counts many tag strings."
+        for tagstr in tagstrs:
+            self.add(tagstr)
+
+    def add_tags(self, tags):
+        """ Counts the output of :meth:`Tokenizer.str2tags`. Nothing is
+        known about the dropped duplicates of those strings.
+        """
+        tags = list(tags)
+        self.strings += 1
+        self.tokens += len(tags)
+        self._count(tags)
+
+    def _count(self, tags):
+        self.tags += len(tags)
+        cleans = [tag.clean for tag in tags]
+        self.popular.update(cleans)
+        self.cardinality.update(cleans)
+        namespaces = [tag.namespace for tag in tags if tag.is_machinetag]
+        if namespaces:
+            self.namespaces.update(namespaces)
+
+    def top(self, k=10):
+        "Returns the `k` most used `(clean, count)` tags (approximately)."
+        return self.popular.top(k)
+
+    def distinct(self):
+        "Returns the estimated number of distinct tags."
+        return self.cardinality.count()
+
+    def duplicate_rate(self):
+        "Returns the fraction of tokens that were dropped."
+        if not self.tokens:
+            return 0.0
+        return (self.tokens - self.tags) / float(self.tokens)
+
+    def merge(self, other):
+        "Adds the stats of another TagStats, like the one of a worker."
+        self.strings += other.strings
+        self.tokens += other.tokens
+        self.tags += other.tags
+        self.popular.merge(other.popular)
+        self.cardinality.merge(other.cardinality)
+        self.namespaces.update(other.namespaces)
+
+    def save(self, fileobj):
+        """ Writes the stats to a file-like object opened in binary mode,
+        to be read with :meth:`load`.
+        """
+        fileobj.write(self.MAGIC)
+        fileobj.write(struct.pack('<QQQ', self.strings, self.tokens,
+                                  self.tags))
+        self.popular.save(fileobj)
+        self.cardinality.save(fileobj)
+        names = sorted(self.namespaces)
+        counts = array('Q', [self.namespaces[name] for name in names])
+        if sys.byteorder == 'big':  # pragma: no cover
+            counts.byteswap()
+        fileobj.write(struct.pack('<I', len(names)))
+        _write_strings(fileobj, names)
+        fileobj.write(counts.tobytes())
+
+    @classmethod
+    def load(cls, fileobj, tokenizer):
+        "Reads stats written with :meth:`save`."
+        if fileobj.read(len(cls.MAGIC)) != cls.MAGIC:
+            raise ValueError('Not a tag stats file')
+        stats = cls(tokenizer)
+        stats.strings, stats.tokens, stats.tags = struct.unpack(
+            '<QQQ', fileobj.read(24))
+        stats.popular = SpaceSaving.load(fileobj)
+        stats.cardinality = HyperLogLog.load(fileobj)
+        size, = struct.unpack('<I', fileobj.read(4))
+        names = _read_strings(fileobj, size)
+        counts = array('Q')
+        counts.frombytes(fileobj.read(size * counts.itemsize))
+        if sys.byteorder == 'big':  # pragma: no cover
+            counts.byteswap()
+        stats.namespaces = Counter(dict(zip(names, counts)))
+        return stats
 
 
 class TagWithSeparatorException(Exception):
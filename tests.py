@@ -3,8 +3,55 @@
 """Test tagtools.py"""
 
 from tagtools import FlickrTokenizer, DeliciousTokenizer, CommaTokenizer, \
-                     TagWithSeparatorException
+                     TagWithSeparatorException, CompactTag, LazyTag, \
+                     Tag, LRUCache, TagCache, Normalizer, NormalizerStage, \
+                     LOWERCASE, CASEFOLD, NFKC, STRIP_ACCENTS, \
+                     COLLAPSE_SPACES, TagVocabulary, TagIndex, \
+                     MachineTagStore, Offloader, Profiler, Dialect, \
+                     Tokenizer, TagCompleter, TagClusterer, \
+                     synonym_stage, SpaceSaving, HyperLogLog, TagStats, \
+                     fingerprint
+import asyncio
+import io
+import os
+import pickle
+import random
+import sys
+import tempfile
 import unittest
+from collections import Counter
+
+import tagtools
+
+try:
+    import numpy
+except ImportError:  # pragma: no cover
+    numpy = None
+
+
+def flickr_reference_tokens(tagstr):
+    "The original char-by-char flickr parser, used as a reference."
+    lstr = list(tagstr.strip())
+    toks, tok, prev, quoted = [], '', '', False
+    while lstr:
+        char = lstr[0]
+        if char == '"':
+            quoted = not quoted
+        elif char == ' ' and \
+                (not quoted or \
+                (quoted and prev == '"' and '"' not in lstr)):
+            if tok:
+                quoted = False
+                toks.append(tok)
+                tok = ''
+        else:
+            tok += char
+        prev = char
+        del lstr[0]
+    tok = tok.strip()
+    if tok:
+        toks.append(tok)
+    return toks
 
 
 class TagToolTestCase(unittest.TestCase):
@@ -98,6 +145,17 @@ class TestFlickrTokenizer(TagToolTestCase):
            ('tag5:bb=e', 'tag5:bb=e', 'tag5', 'bb', 'e'),
            ('f', 'f'), ('g', 'g'), ('h', 'h')])
 
+    def test_flickr_str2tags_reference(self):
+        rnd = random.Random(42)
+        for i in range(3000):
+            tagstr = ''.join([rnd.choice('  ""aB:=')
+                              for j in range(rnd.randint(0, 30))])
+            expected, keys = [], set()
+            for tok in flickr_reference_tokens(tagstr):
+                self.serializer._process_tag(expected, keys, tok)
+            got = self.serializer.str2tags(tagstr)
+            self.assertEqual([(t.raw, t.clean) for t in expected],
+                             [(t.raw, t.clean) for t in got], tagstr)
 
     def test_flickr_tags2str(self):
         def test(tags, expected):
@@ -122,6 +180,47 @@ class TestFlickrTokenizer(TagToolTestCase):
               'tag1 tag number 2 tag3')
 
 
+class CompactFlickrTokenizer(FlickrTokenizer):
+    TAGCLASS = CompactTag
+
+
+class TestCompactTag(TestFlickrTokenizer):
+
+    def setUp(self):
+        self.serializer = CompactFlickrTokenizer
+
+    def test_compact_tag(self):
+        tag, mtag = self.serializer.str2tags('Tag1 geo:lat=12')
+        self.assertFalse(hasattr(tag, '__dict__'))
+        self.assertEqual(None, tag._machine)
+        self.assertEqual(('geo', 'lat', '12'), mtag._machine)
+        for tag in (tag, mtag):
+            self.assertEqual(tag._astuple(),
+                             CompactTag._fromtuple(tag._astuple())._astuple())
+
+
+class LazyFlickrTokenizer(FlickrTokenizer):
+    TAGCLASS = LazyTag
+
+
+class TestLazyTag(TestFlickrTokenizer):
+
+    def setUp(self):
+        self.serializer = LazyFlickrTokenizer
+
+    def test_lazy_tag(self):
+        tag, mtag = self.serializer.str2tags('Tag1 geo:lat=12 tag1')
+        for parsed in (tag, mtag):
+            self.assertFalse('is_machinetag' in parsed.__dict__)
+        self.assertEqual('12', mtag.value)
+        self.assertEqual(('geo', 'lat', '12'),
+                         (mtag.__dict__['namespace'],
+                          mtag.__dict__['predicate'],
+                          mtag.__dict__['value']))
+        self.assertFalse(tag.is_machinetag)
+        self.assertRaises(AttributeError, getattr, tag, 'missing')
+
+
 class TestDeliciousTokenizer(TagToolTestCase):
 
     def setUp(self):
@@ -186,5 +285,1150 @@ class TestCommaTokenizer(TagToolTestCase):
             CommaTokenizer.tags2str, ['t,1'])
 
 
+class TestStr2TagsMany(unittest.TestCase):
+    TAGSTRS = [None, '', ' ', 'T1', 'TaG taG GAT tag gat', ',T1,,T2,t1',
+               '   Ta"G"1    "tAg     numbEr   2"    taG3    ',
+               'tag1 tag3:bar=baz "tag4:aa=a b" tag1', 'T1']
+
+    def test_str2tags_many(self):
+        for tokenizer in (FlickrTokenizer, DeliciousTokenizer,
+                          CommaTokenizer):
+            got = tokenizer.str2tags_many(iter(self.TAGSTRS))
+            self.assertFalse(isinstance(got, list))
+            expected = [tokenizer.str2tags(tagstr)
+                        for tagstr in self.TAGSTRS]
+            self.assertEqual(
+                [[(t.clean, t.raw, t.value) for t in tags]
+                 for tags in expected],
+                [[(t.clean, t.raw, t.value) for t in tags] for tags in got])
+
+    def test_str2tags_many_parallel(self):
+        tagstrs = self.TAGSTRS * 5
+        for tokenizer in (FlickrTokenizer, DeliciousTokenizer,
+                          CommaTokenizer):
+            expected = [[(t.clean, t.raw, t.is_machinetag, t.namespace,
+                          t.predicate, t.value) for t in tags]
+                        for tags in tokenizer.str2tags_many(tagstrs)]
+            for chunksize in (4, 1000):
+                got = tokenizer.str2tags_many(tagstrs, workers=2,
+                                              chunksize=chunksize)
+                self.assertEqual(expected,
+                    [[(t.clean, t.raw, t.is_machinetag, t.namespace,
+                       t.predicate, t.value) for t in tags] for tags in got])
+
+
+class TestTags2Str(unittest.TestCase):
+
+    def test_tag_objects(self):
+        for tokenizer, tagstr in ((FlickrTokenizer, 'T1 "T 2" t3'),
+                                  (DeliciousTokenizer, 'T1 t2 t3'),
+                                  (CommaTokenizer, 'T1, T 2, t3')):
+            tags = tokenizer.str2tags(tagstr)
+            self.assertEqual(tagstr, tokenizer.tags2str(tags))
+            self.assertEqual(tagstr, tokenizer.tags2str(
+                [tags[0].raw] + tags[1:]))
+
+    def test_not_tags(self):
+        for tokenizer in (FlickrTokenizer, DeliciousTokenizer,
+                          CommaTokenizer, Dialect(',', prefix='#').compile()):
+            for tags in ([None], ['a', 1], iter([Tag('a'), None])):
+                self.assertRaises(TypeError, tokenizer.tags2str, tags)
+
+    def test_tags2str_many(self):
+        got = CommaTokenizer.tags2str_many(iter([[], ['a', 'b c'], ['d']]))
+        self.assertFalse(isinstance(got, list))
+        self.assertEqual(['', 'a, b c', 'd'], list(got))
+        got = DeliciousTokenizer.tags2str_many([['a'], ['b', 'c d']])
+        self.assertEqual('a', next(got))
+        try:
+            next(got)
+        except TagWithSeparatorException:
+            self.assertTrue("'c d'" in str(sys.exc_info()[1]))
+        else:  # pragma: no cover
+            self.fail('TagWithSeparatorException not raised')
+
+
+class TestStr2TagsStream(unittest.TestCase):
+
+    def _chunks(self, rnd, tagstr):
+        chunks = []
+        while tagstr:
+            size = rnd.randint(0, 6)
+            chunks.append(tagstr[:size])
+            tagstr = tagstr[size:]
+        return chunks
+
+    def test_str2tags_stream(self):
+        rnd = random.Random(7)
+        for tokenizer in (FlickrTokenizer, DeliciousTokenizer,
+                          CommaTokenizer):
+            for i in range(2000):
+                tagstr = ''.join([rnd.choice('  ,""aaB:=\n\t')
+                                  for j in range(rnd.randint(0, 30))])
+                expected = [(t.clean, t.raw, t.value)
+                            for t in tokenizer.str2tags(tagstr)]
+                got = tokenizer.str2tags_stream(self._chunks(rnd, tagstr))
+                self.assertFalse(isinstance(got, list))
+                self.assertEqual(expected,
+                                 [(t.clean, t.raw, t.value) for t in got],
+                                 (tokenizer, tagstr))
+        # leading whitespace is stripped, even across chunks
+        for tagstr in ('\t" , , B B ', '\n  \t"  B \tBa:', '\t\n "a b'):
+            for size in (1, 2, 100):
+                chunks = [tagstr[i:i + size]
+                          for i in range(0, len(tagstr), size)]
+                self.assertEqual(
+                    [t.raw for t in FlickrTokenizer.str2tags(tagstr)],
+                    [t.raw for t in FlickrTokenizer.str2tags_stream(chunks)])
+
+    def test_str2tags_stream_file(self):
+        tagstr = 'T1 "t 2" geo:lat=1 \n t1 ab" cd ef ' * 100
+        for tokenizer in (FlickrTokenizer, DeliciousTokenizer,
+                          CommaTokenizer):
+            expected = [(t.clean, t.raw) for t in tokenizer.str2tags(tagstr)]
+            got = tokenizer.str2tags_stream(io.StringIO(tagstr), chunksize=7)
+            self.assertEqual(expected, [(t.clean, t.raw) for t in got])
+
+
+class TestFiles(unittest.TestCase):
+    LINES = ['Tag1, Tag 2, tag1', '', 'geo:lat=1,Ünïcode', ',,',
+             'one "two three"']
+
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp()
+        os.write(fd, '\n'.join(self.LINES).encode('utf-8') + b'\r\n')
+        os.close(fd)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def test_str2tags_file(self):
+        for tokenizer in (FlickrTokenizer, DeliciousTokenizer,
+                          CommaTokenizer):
+            expected = [[(t.clean, t.raw) for t in tokenizer.str2tags(line)]
+                        for line in self.LINES]
+            self.assertEqual(expected,
+                             [[(t.clean, t.raw) for t in tags]
+                              for tags in tokenizer.str2tags_file(self.path)])
+
+    def test_str2tags_empty_file(self):
+        open(self.path, 'w').close()
+        self.assertEqual([], list(CommaTokenizer.str2tags_file(self.path)))
+
+    def test_convert_file(self):
+        output = io.StringIO()
+        self.assertEqual(
+            5, CommaTokenizer.convert_file(self.path, output, FlickrTokenizer))
+        self.assertEqual('Tag1 "Tag 2"\n\ngeo:lat=1 Ünïcode\n\n'
+                         '"one "two three""\n', output.getvalue())
+        self.assertRaises(TagWithSeparatorException,
+                          CommaTokenizer.convert_file, self.path, output,
+                          DeliciousTokenizer)
+
+
+class TestNormalizer(unittest.TestCase):
+
+    def test_stages(self):
+        def test(stage, tag, expected):
+            self.assertEqual(expected, Normalizer([stage])(tag))
+        test(LOWERCASE, 'TaG Ñ', 'tag ñ')
+        test(CASEFOLD, 'TaG', 'tag')
+        test(CASEFOLD, 'Straße', 'strasse')
+        test(NFKC, 'ﬁx', 'fix')
+        test(NFKC, 'A\u030a', '\xc5')
+        test(STRIP_ACCENTS, 'Ñandú', 'Nandu')
+        test(STRIP_ACCENTS, 'nandu', 'nandu')
+        test(COLLAPSE_SPACES, 'a  \t b\u3000c', 'a b c')
+
+    def test_ascii_fast_path(self):
+        calls = []
+
+        def unicode_only(tag):
+            calls.append(tag)
+            return tag
+        normalizer = Normalizer([NormalizerStage(unicode_only), LOWERCASE],
+                                maxsize=0)
+        self.assertEqual('tag', normalizer('TaG'))
+        self.assertEqual('ñ', normalizer('Ñ'))
+        self.assertEqual(['Ñ'], calls)
+
+    def test_tag_normalizer(self):
+        class NormalizedTag(Tag):
+            normalize = Normalizer([NFKC, CASEFOLD, STRIP_ACCENTS,
+                                    COLLAPSE_SPACES])
+
+        class NormalizedComma(CommaTokenizer):
+            TAGCLASS = NormalizedTag
+
+        tags = NormalizedComma.str2tags(
+            'Ñandú  Straße, nandu strasse, geo:lat=ÁB')
+        self.assertEqual([('nandu strasse', 'Ñandú  Straße'),
+                          ('geo:lat=ab', 'geo:lat=ÁB')],
+                         [(tag.clean, tag.raw) for tag in tags])
+        self.assertEqual('ab', tags[1].value)
+
+
+class TestStr2TagsColumn(unittest.TestCase):
+
+    @unittest.skipIf(numpy is None, 'requires numpy')
+    def test_str2tags_column(self):
+        class UpperTag(Tag):
+            @staticmethod
+            def normalize(tag):
+                return tag.upper()
+
+        class UpperComma(CommaTokenizer):
+            TAGCLASS = UpperTag
+
+        column = ['TaG, tag ,T2', None, '', ',,,', 'T2,  A b,t2 ', 'x']
+        for tokenizer in (CommaTokenizer, DeliciousTokenizer, UpperComma):
+            for col in (column, numpy.array(column, dtype=object)):
+                offsets, clean, raw = tokenizer.str2tags_column(col)
+                self.assertEqual(len(column) + 1, len(offsets))
+                for i, tagstr in enumerate(column):
+                    start, end = offsets[i], offsets[i + 1]
+                    self.assertEqual(
+                        [(tag.clean, tag.raw)
+                         for tag in tokenizer.str2tags(tagstr)],
+                        list(zip(clean[start:end].tolist(),
+                                 raw[start:end].tolist())))
+
+    def test_str2tags_column_unsupported(self):
+        for tokenizer in (FlickrTokenizer, Dialect(',', quote='"').compile(),
+                          Dialect(' ', prefix='#').compile()):
+            self.assertRaises(TypeError, tokenizer.str2tags_column, ['a'])
+
+
+class TestTagVocabulary(unittest.TestCase):
+
+    def test_str2ids(self):
+        vocabulary = TagVocabulary()
+        for tokenizer in (FlickrTokenizer, DeliciousTokenizer,
+                          CommaTokenizer):
+            for tagstr in (None, 'TaG,tag, T2', 'T2 "Ñ x" tag', ' ,'):
+                ids = tokenizer.str2ids(tagstr, vocabulary)
+                self.assertEqual('I', ids.typecode)
+                self.assertEqual(
+                    [tag.clean for tag in tokenizer.str2tags(tagstr)],
+                    [vocabulary.cleans[tagid] for tagid in ids])
+        self.assertEqual(0, vocabulary.get('tag,tag,'))
+        self.assertEqual('TaG,tag,', vocabulary.raws[0])
+        self.assertEqual('tag', vocabulary.raws[vocabulary.get('tag')])
+        self.assertEqual(None, vocabulary.get('missing'))
+        self.assertTrue('t2' in vocabulary)
+        self.assertEqual(list(range(len(vocabulary))),
+                         sorted(vocabulary.ids.values()))
+
+    def test_save_load(self):
+        vocabulary = TagVocabulary()
+        CommaTokenizer.str2ids('TaG, Ñandú, ñandú, a\nb, geo:lat=1',
+                               vocabulary)
+        fileobj = io.BytesIO()
+        vocabulary.save(fileobj)
+        fileobj.seek(0)
+        loaded = TagVocabulary.load(fileobj)
+        self.assertEqual(vocabulary.ids, loaded.ids)
+        self.assertEqual(vocabulary.cleans, loaded.cleans)
+        self.assertEqual(vocabulary.raws, loaded.raws)
+        self.assertEqual(0, len(TagVocabulary.load(
+            io.BytesIO(TagVocabulary.MAGIC + b'\0' * 12))))
+        self.assertRaises(ValueError, TagVocabulary.load, io.BytesIO(b'x'))
+
+    def test_file_format(self):
+        vocabulary = TagVocabulary()
+        vocabulary.add('a', 'A')
+        vocabulary.add('ñb', 'Ñb')
+        fileobj = io.BytesIO()
+        vocabulary.save(fileobj)
+        # little-endian uint32 lengths on every platform
+        self.assertEqual(TagVocabulary.MAGIC + b'\2\0\0\0' +
+                         b'\1\0\0\0\2\0\0\0\4\0\0\0a\xc3\xb1b' +
+                         b'\1\0\0\0\2\0\0\0\4\0\0\0A\xc3\x91b',
+                         fileobj.getvalue())
+
+
+class TestFingerprint(unittest.TestCase):
+
+    def test_fingerprint(self):
+        fingerprints = set()
+        for tokenizer, tagstr in ((FlickrTokenizer, 'B "a" b A'),
+                                  (DeliciousTokenizer, ' a  B a '),
+                                  (CommaTokenizer, 'b,A, ,a')):
+            fingerprints.add(tokenizer.str2fingerprint(tagstr))
+            fingerprints.add(fingerprint(tokenizer.str2tags(tagstr)))
+        self.assertEqual(1, len(fingerprints))
+        self.assertNotEqual(CommaTokenizer.str2fingerprint('a'),
+                            CommaTokenizer.str2fingerprint('a, b'))
+        self.assertNotEqual(CommaTokenizer.str2fingerprint('a b'),
+                            DeliciousTokenizer.str2fingerprint('a b'))
+        # stored fingerprints must stay valid
+        self.assertEqual(3097375719851575320,
+                         CommaTokenizer.str2fingerprint('TAG'))
+        self.assertEqual(199785393810938014797824354067751230141,
+                         CommaTokenizer.str2fingerprint('b, a', 128))
+        self.assertEqual(CommaTokenizer.str2fingerprint('b, a'),
+                         CommaTokenizer.str2fingerprint('b, a', 128) &
+                         0xffffffffffffffff)
+        for tagstr in (None, '', ' , ,'):
+            self.assertEqual(0, CommaTokenizer.str2fingerprint(tagstr))
+        self.assertEqual(0, fingerprint([], 128))
+        self.assertRaises(ValueError, CommaTokenizer.str2fingerprint, 'a',
+                          32)
+        self.assertRaises(ValueError, fingerprint, [], 32)
+
+    def test_str2fingerprint(self):
+        class UpperTag(Tag):
+            @staticmethod
+            def normalize(tag):
+                return tag.upper()
+
+        rnd = random.Random(17)
+        tagstrs = [''.join([rnd.choice('  ,;""\'\\aBé:=\t')
+                            for j in range(rnd.randint(0, 30))])
+                   for i in range(500)]
+        for tagclass in (Tag, UpperTag, CompactTag):
+            for tokenizer in (FlickrTokenizer, DeliciousTokenizer,
+                              CommaTokenizer,
+                              Dialect(';', quote="'", escape='\\').compile(),
+                              Dialect(',', prefix='#').compile()):
+                class Tokenized(tokenizer):
+                    TAGCLASS = tagclass
+                for tagstr in tagstrs:
+                    self.assertEqual(
+                        fingerprint(Tokenized.str2tags(tagstr), 128),
+                        Tokenized.str2fingerprint(tagstr, 128))
+
+
+class TestTagCompleter(unittest.TestCase):
+
+    def test_complete(self):
+        completer = TagCompleter(CommaTokenizer)
+        completer.add('Python, Django, geo:lat=12, geo:lon=3')
+        completer.add('python, PyGame, geo:lat=10')
+        completer.add('PYTHON, pygame, Py', count=2)
+        self.assertEqual([('PYTHON', 4), ('pygame', 3), ('Py', 2)],
+                         completer.complete(' PY'))
+        self.assertEqual([('PYTHON', 4)], completer.complete('py', k=1))
+        self.assertEqual([], completer.complete('x'))
+        self.assertEqual(7, len(completer))
+        self.assertTrue('django' in completer)
+        self.assertEqual(4, completer.count('python'))
+        self.assertEqual('Django', completer.raw('django'))
+        self.assertEqual(None, completer.raw('missing'))
+        self.assertEqual([('geo:', 3)], completer.complete_machinetag('g'))
+        self.assertEqual([('geo:lat=', 2), ('geo:lon=', 1)],
+                         completer.complete_machinetag('geo:'))
+        self.assertEqual([('geo:lat=10', 1), ('geo:lat=12', 1)],
+                         completer.complete_machinetag('geo:lat=1'))
+        self.assertEqual([('geo:', 3)], completer.complete_machinetag('Ge'))
+        self.assertEqual([('geo:lat=', 2)],
+                         completer.complete_machinetag(' GEO:La'))
+        self.assertEqual([('geo:lat=10', 1), ('geo:lat=12', 1)],
+                         completer.complete_machinetag('Geo:LAT=1'))
+
+        self.assertRaises(KeyError, completer.remove, 'PYTHON, geo:lat=12',
+                          count=2)
+        self.assertEqual(4, completer.count('python'))
+        completer.remove('PYTHON', count=2)
+        completer.remove('geo:lat=12')
+        self.assertEqual([('pygame', 3), ('Py', 2), ('Python', 2)],
+                         completer.complete('py'))
+        completer.remove('geo:lat=10')
+        self.assertEqual([('geo:lon=', 1)],
+                         completer.complete_machinetag('geo:'))
+        self.assertRaises(KeyError, completer.remove, 'missing')
+        self.assertRaises(KeyError, completer.remove, 'python', 5)
+
+    def test_random(self):
+        rnd = random.Random(17)
+        completer = TagCompleter(DeliciousTokenizer)
+        expected = Counter()
+        added = []
+        for i in range(3000):
+            if added and rnd.random() < 0.3:
+                tag = added.pop(rnd.randrange(len(added)))
+                completer.remove(tag)
+                expected[tag.lower()] -= 1
+            else:
+                tag = ''.join([rnd.choice('abcA') for j in range(
+                    rnd.randint(1, 4))])
+                completer.add(tag)
+                added.append(tag)
+                expected[tag.lower()] += 1
+            if i % 50 == 0:
+                fileobj = io.BytesIO()
+                completer.save(fileobj)
+                fileobj.seek(0)
+                completer = TagCompleter.load(fileobj, DeliciousTokenizer)
+            prefix = ''.join([rnd.choice('abc')
+                              for j in range(rnd.randint(0, 2))])
+            k = rnd.randint(1, 10)
+            best = sorted([(-count, clean)
+                           for clean, count in expected.items()
+                           if count and clean.startswith(prefix)])[:k]
+            self.assertEqual([(clean, -count) for count, clean in best],
+                             [(raw.lower(), count) for raw, count in
+                              completer.complete(prefix, k)])
+
+    def test_save_load(self):
+        completer = TagCompleter(FlickrTokenizer)
+        completer.add('Ñandú ñandú "new york" geo:lat=1')
+        completer.add('ñandú NEW geo:lon=2')
+        fileobj = io.BytesIO()
+        completer.save(fileobj)
+        fileobj.seek(0)
+        loaded = TagCompleter.load(fileobj, FlickrTokenizer)
+        for prefix in ('', 'ñ', 'new', 'geo:'):
+            self.assertEqual(completer.complete(prefix),
+                             loaded.complete(prefix))
+            self.assertEqual(completer.complete_machinetag(prefix),
+                             loaded.complete_machinetag(prefix))
+        self.assertEqual(completer._raws, loaded._raws)
+        self.assertRaises(ValueError, TagCompleter.load, io.BytesIO(b'x'),
+                          FlickrTokenizer)
+
+
+class TestTagClusterer(unittest.TestCase):
+    COUNTS = Counter({'newyork': 5, 'new york': 9, 'new-york': 2, 'nyc': 4,
+                      'photography': 10, 'photograpy': 1, 'tag1': 1,
+                      'tag2': 1, 'geo:lat=1': 1, 'geo:lat=2': 1, 'cat': 1,
+                      'cats': 1, '!!': 1, '??': 1})
+
+    def test_cluster(self):
+        mapping = TagClusterer().cluster(self.COUNTS,
+                                         aliases={'nyc': 'newyork'})
+        self.assertEqual({'new york': 'newyork', 'new-york': 'newyork',
+                          'nyc': 'newyork', 'photograpy': 'photography'},
+                         mapping)
+        self.assertEqual({'new york': 'newyork', 'new-york': 'newyork',
+                          'photography': 'photograpy', 'cats': 'cat'},
+                         TagClusterer(threshold=0.5).cluster(
+                             ['newyork', 'new york', 'new-york', 'cat',
+                              'cats', 'photography', 'photograpy']))
+        self.assertEqual({'big apple': 'new york', 'nyc': 'new york'},
+                         TagClusterer().cluster(
+                             {'nyc': 3}, aliases={'nyc': 'new york',
+                                                  'big apple': 'nyc'}))
+        self.assertRaises(ValueError, TagClusterer, 0)
+
+    def test_all_pairs(self):
+        rnd = random.Random(23)
+        clusterer = TagClusterer(threshold=0.6)
+        skeletons = list(set([''.join([rnd.choice('abcd1') for j in range(
+            rnd.randint(1, 8))]) for i in range(300)]))
+        expected = set()
+        for i, first in enumerate(skeletons):
+            for second in skeletons[i + 1:]:
+                grams = [set([tag[pos:pos + 3] for pos in range(
+                    max(1, len(tag) - 2))]) for tag in (first, second)]
+                common = len(grams[0] & grams[1])
+                if common >= 0.6 * len(grams[0] | grams[1]) - 1e-9 and \
+                        clusterer.RE_NUMBERS.findall(first) == \
+                        clusterer.RE_NUMBERS.findall(second):
+                    expected.add(frozenset([first, second]))
+        found = set([frozenset(pair)
+                     for pair in clusterer._similar(skeletons)])
+        self.assertTrue(expected)
+        self.assertTrue(found <= expected)
+        self.assertTrue(len(found) >= 0.9 * len(expected))
+
+    def test_synonym_stage(self):
+        mapping = TagClusterer().cluster(self.COUNTS,
+                                         aliases={'nyc': 'new york'})
+
+        class SynonymTag(Tag):
+            normalize = Normalizer([LOWERCASE, synonym_stage(mapping)])
+
+        class SynonymTokenizer(CommaTokenizer):
+            TAGCLASS = SynonymTag
+
+        tags = SynonymTokenizer.str2tags(
+            'NYC, New-York, new york, photograpy, Photography')
+        self.assertEqual([('new york', 'NYC'),
+                          ('photography', 'photograpy')],
+                         [(tag.clean, tag.raw) for tag in tags])
+
+
+class TestTagStats(unittest.TestCase):
+
+    def _roundtrip(self, obj, *args):
+        fileobj = io.BytesIO()
+        obj.save(fileobj)
+        fileobj.seek(0)
+        return obj.__class__.load(fileobj, *args)
+
+    def test_space_saving(self):
+        rnd = random.Random(29)
+        stream = ['k%d' % int(rnd.paretovariate(1.2)) for i in range(20000)]
+        exact = Counter(stream)
+        counter = SpaceSaving(50)
+        for key in stream:
+            counter.add(key)
+        self.assertEqual(50, len(counter))
+        self.assertEqual(len(stream), counter.total)
+        for key, count in counter.counts.items():
+            self.assertTrue(count - counter.errors[key] <= exact[key] <=
+                            count)
+        # every key above total / capacity is kept
+        for key, count in exact.items():
+            if count > len(stream) / 50:
+                self.assertTrue(key in counter.counts)
+        self.assertEqual([key for key, count in exact.most_common(5)],
+                         [key for key, count in counter.top(5)])
+
+        small = SpaceSaving(100)
+        for key in 'abracadabra':
+            small.add(key)
+        self.assertEqual([('a', 5), ('b', 2), ('r', 2)], small.top(3))
+        loaded = self._roundtrip(small)
+        self.assertEqual(small.counts, loaded.counts)
+        self.assertEqual(small.errors, loaded.errors)
+        loaded.add('z', 6)
+        self.assertEqual(('z', 6), loaded.top(1)[0])
+
+    def test_space_saving_merge(self):
+        first, second, exact = SpaceSaving(20), SpaceSaving(20), Counter()
+        rnd = random.Random(31)
+        for counter in (first, second):
+            for i in range(5000):
+                key = 'k%d' % int(rnd.paretovariate(1.5))
+                counter.add(key)
+                exact[key] += 1
+        first.merge(second)
+        self.assertEqual(10000, first.total)
+        self.assertTrue(len(first) <= 20)
+        for key, count in first.counts.items():
+            self.assertTrue(count - first.errors[key] <= exact[key] <=
+                            count)
+        self.assertEqual([key for key, count in exact.most_common(3)],
+                         [key for key, count in first.top(3)])
+
+    def test_hyperloglog(self):
+        counters = [HyperLogLog(12), HyperLogLog(12)]
+        for i in range(60000):
+            counters[i % 2].add('tag%d' % (i % 40000))
+        for counter, expected in ((counters[0], 20000),
+                                  (counters[1], 20000)):
+            self.assertTrue(abs(counter.count() - expected) < 0.05 * expected)
+        counters[0].merge(counters[1])
+        self.assertTrue(abs(counters[0].count() - 40000) < 2000)
+        self.assertEqual(counters[0].registers,
+                         self._roundtrip(counters[0]).registers)
+        small = HyperLogLog()
+        for tag in ('a', 'b', 'c', 'a', 'ñ', '\udc80'):
+            small.add(tag)
+        self.assertEqual(5, small.count())
+        self.assertEqual(0, HyperLogLog().count())
+        self.assertRaises(ValueError, counters[0].merge, small)
+        self.assertRaises(ValueError, HyperLogLog, 3)
+
+    def test_tag_stats(self):
+        tagstrs = ['Python, python, geo:lat=1, geo:lon=2, , ',
+                   'django, python, upload:by=me', None, 'Python']
+        stats = TagStats(CommaTokenizer, capacity=10)
+        stats.add_many(tagstrs)
+        self.assertEqual((4, 8, 7), (stats.strings, stats.tokens,
+                                     stats.tags))
+        self.assertEqual(1 / 8.0, stats.duplicate_rate())
+        self.assertEqual([('python', 3), ('django', 1)], stats.top(2))
+        self.assertEqual(5, stats.distinct())
+        self.assertEqual({'geo': 2, 'upload': 1}, stats.namespaces)
+
+        other = TagStats(CommaTokenizer, capacity=10)
+        other.add_tags(FlickrTokenizer.str2tags('geo:lat=3 new'))
+        self.assertEqual(0.0, other.duplicate_rate())
+        self.assertEqual(0.0, TagStats(FlickrTokenizer).duplicate_rate())
+        stats.merge(other)
+        self.assertEqual((5, 10, 9), (stats.strings, stats.tokens,
+                                      stats.tags))
+        self.assertEqual(7, stats.distinct())
+        self.assertEqual({'geo': 3, 'upload': 1}, stats.namespaces)
+
+        loaded = self._roundtrip(stats, CommaTokenizer)
+        self.assertEqual((5, 10, 9), (loaded.strings, loaded.tokens,
+                                      loaded.tags))
+        self.assertEqual(stats.top(), loaded.top())
+        self.assertEqual(stats.distinct(), loaded.distinct())
+        self.assertEqual(stats.namespaces, loaded.namespaces)
+        self.assertRaises(ValueError, TagStats.load, io.BytesIO(b'x'),
+                          CommaTokenizer)
+        self.assertEqual(stats.top(),
+                         pickle.loads(pickle.dumps(stats)).top())
+
+    def test_tag_stats_flickr(self):
+        splits = []
+
+        class CachedFlickr(FlickrTokenizer):
+            CACHE = TagCache()
+            PROFILER = Profiler()
+
+            @classmethod
+            def _split(cls, tagstr):
+                splits.append(tagstr)
+                return super(CachedFlickr, cls)._split(tagstr)
+
+        for tokenizer in (FlickrTokenizer, CachedFlickr):
+            stats = TagStats(tokenizer)
+            stats.add('a  A "b c" "B  c" a')
+            self.assertEqual((5, 3), (stats.tokens, stats.tags))
+        # tokens and tags are counted from a single split
+        self.assertEqual(1, len(splits))
+
+
+class TestTagIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.index = TagIndex(CommaTokenizer)
+        self.index.add_many([
+            (1, 'Python, geo:lat=12, geo:lon=3'),
+            (2, 'python, django, pyramid'),
+            ('three', 'Django, web, upload:by=me'),
+            (4, 'web'),
+        ])
+
+    def test_search(self):
+        search = self.index.search
+        self.assertEqual(set([1, 2, 'three', 4]), search())
+        self.assertEqual(set([1, 2]), search(include=['PYTHON']))
+        self.assertEqual(set([2]), search(include=['python', 'django']))
+        self.assertEqual(set([1]), search(include=['python'],
+                                          exclude=['django']))
+        self.assertEqual(set([2, 4]), search(either=['pyramid', 'web'],
+                                             exclude=['upload:*']))
+        self.assertEqual(set(), search(include=['python', 'web']))
+        self.assertEqual(set(), search(include=['missing', 'web']))
+        self.assertEqual(set([1]), search(include=['geo:lat=*']))
+        self.assertEqual(set([1]), search(include=['geo:*']))
+        self.assertEqual(set([1]), search(include=['GEO:lat=*']))
+        self.assertEqual(set([1]), search(include=['Geo:*']))
+        self.assertEqual(set([1]), search(include=['Geo:lat=12']))
+        self.assertEqual(set(), search(include=['geo:alt=*']))
+        self.assertEqual(set([1, 2]), search(include=['py*']))
+        self.assertEqual(set(['three', 4]), search(exclude=['py*']))
+
+    def test_prefix(self):
+        self.assertEqual(['pyramid', 'python'], self.index.prefix('Py'))
+        self.assertEqual([], self.index.prefix('x'))
+
+    def test_cooccurring(self):
+        self.assertEqual([('python', 1), ('pyramid', 1), ('web', 1),
+                          ('upload:by=me', 1)],
+                         self.index.cooccurring('django'))
+        self.assertEqual([('django', 1)], self.index.cooccurring('web', 1))
+
+    def test_update_remove(self):
+        index = self.index
+        index.add(1, 'Python, web')
+        self.assertEqual(['python', 'web'], index.tags(1))
+        self.assertEqual(set(), index.search(include=['geo:*']))
+        self.assertFalse('geo' in index.namespaces)
+        self.assertEqual(set([1, 'three', 4]), index.search(include=['web']))
+        index.remove('three')
+        self.assertFalse('three' in index)
+        self.assertEqual(3, len(index))
+        self.assertEqual(set([1, 2, 4]), index.search())
+        self.assertEqual([], index.prefix('upload'))
+        self.assertRaises(KeyError, index.remove, 'three')
+        index.add('three', 'new')
+        self.assertEqual(set(['three']), index.search(include=['new']))
+
+
+class TestMachineTagStore(unittest.TestCase):
+
+    def setUp(self):
+        self.store = MachineTagStore()
+        for item, tagstr in enumerate([
+                'geo:lat=12.5 upload:by=me geo:lon=3 notmachine',
+                'geo:lat=-1 x:by=ME geo:lat=nan',
+                'geo:lat=abc geo:lat=12.5']):
+            for tag in FlickrTokenizer.str2tags(tagstr):
+                self.store.add(tag, item)
+
+    def _test(self, result, expected):
+        self.assertEqual(expected, [(tag.raw, item) for tag, item in result])
+
+    def test_query(self):
+        test, query = self._test, self.store.query
+        self.assertEqual(8, len(self.store))
+        test(query('geo:lon='), [('geo:lon=3', 0)])
+        test(query('geo:lat=12.5'), [('geo:lat=12.5', 0),
+                                     ('geo:lat=12.5', 2)])
+        test(query('geo:'), [('geo:lat=-1', 1), ('geo:lat=12.5', 0),
+                             ('geo:lat=12.5', 2), ('geo:lat=abc', 2),
+                             ('geo:lat=nan', 1), ('geo:lon=3', 0)])
+        self.assertEqual(query('geo:'), query('geo:*='))
+        test(query('*:by=ME'), [('upload:by=me', 0), ('x:by=ME', 1)])
+        test(query(':by'), [('upload:by=me', 0), ('x:by=ME', 1)])
+        test(query('*:*=3'), [('geo:lon=3', 0)])
+        self.assertEqual(8, len(query(':')))
+        test(query('missing:'), [])
+        test(query('geo:alt='), [])
+        self.assertRaises(ValueError, query, 'geo')
+
+    def test_between(self):
+        test, between = self._test, self.store.between
+        test(between('geo', 'lat', -5, 20),
+             [('geo:lat=-1', 1), ('geo:lat=12.5', 0), ('geo:lat=12.5', 2)])
+        test(between('geo', 'lat', low=0), [('geo:lat=12.5', 0),
+                                            ('geo:lat=12.5', 2)])
+        test(between('geo', 'lat', high=0), [('geo:lat=-1', 1)])
+        test(between('geo', 'alt'), [])
+
+    def test_remove(self):
+        store, test = self.store, self._test
+        tag = FlickrTokenizer.str2tags('geo:lat=12.5')[0]
+        store.remove(tag, 2)
+        self.assertRaises(KeyError, store.remove, tag, 2)
+        test(store.between('geo', 'lat', 12, 13), [('geo:lat=12.5', 0)])
+        store.remove(tag, 0)
+        test(store.between('geo', 'lat', 12, 13), [])
+        for tag, item in store.query('geo:'):
+            store.remove(tag, item)
+        test(store.query('geo:'), [])
+        self.assertEqual(2, len(store))
+        self.assertFalse(store.add(FlickrTokenizer.str2tags('tag')[0]))
+
+
+class TestDiff(unittest.TestCase):
+
+    def _raws(self, tags):
+        return [(tag.clean, tag.raw) for tag in tags]
+
+    def test_diff(self):
+        diff = CommaTokenizer.diff('a, B, c, d', 'a, b, C, e, f')
+        self.assertEqual(['e', 'f'], list(diff.added))
+        self.assertEqual(['d'], list(diff.removed))
+        self.assertEqual(['a', 'b', 'c'], list(diff.unchanged))
+        self.assertEqual('C', diff.unchanged['c'].raw)
+        self.assertEqual(self._raws(CommaTokenizer.str2tags('a, b, C, e, f')),
+                         self._raws(diff.parsed.tags))
+        diff = FlickrTokenizer.diff(None, '"a b" c')
+        self.assertEqual(['a b', 'c'], list(diff.added))
+        self.assertEqual(None, diff.parsed.spans)
+        diff = FlickrTokenizer.diff(diff.parsed, '')
+        self.assertEqual(['a b', 'c'], list(diff.removed))
+
+    def test_diff_reuses_tokens(self):
+        parsed = CommaTokenizer.parse('one, two, three, four, five')
+        new = CommaTokenizer.diff(parsed, 'one, two, THREE, four, five').parsed
+        self.assertTrue(parsed.tokens[1] is new.tokens[1])
+        self.assertTrue(parsed.tokens[3] is new.tokens[3])
+        self.assertFalse(parsed.tokens[2] is new.tokens[2])
+        self.assertEqual('THREE', new.tags[2].raw)
+
+    def test_diff_random_edits(self):
+        rnd = random.Random(3)
+        for tokenizer in (FlickrTokenizer, DeliciousTokenizer,
+                          CommaTokenizer):
+            parsed = tokenizer.parse('')
+            for i in range(3000):
+                tagstr = parsed.tagstr
+                pos = rnd.randint(0, len(tagstr))
+                cut = rnd.randint(0, 3)
+                text = ''.join([rnd.choice('  ,,aAb"')
+                                for j in range(rnd.randint(0, 3))])
+                if len(tagstr) > 40:
+                    text = ''
+                newstr = tagstr[:pos] + text + tagstr[pos + cut:]
+                diff = tokenizer.diff(parsed, newstr)
+                expected = tokenizer.parse(newstr)
+                self.assertEqual([tag.raw for tag in expected.tokens],
+                                 [tag.raw for tag in diff.parsed.tokens],
+                                 (tokenizer, tagstr, newstr))
+                self.assertEqual(expected.spans, diff.parsed.spans)
+                self.assertEqual(self._raws(tokenizer.str2tags(newstr)),
+                                 self._raws(diff.parsed.tags))
+                oldkeys = set([tag.clean for tag in parsed.tags])
+                newkeys = set([tag.clean for tag in expected.tags])
+                self.assertEqual(newkeys - oldkeys, set(diff.added))
+                self.assertEqual(oldkeys - newkeys, set(diff.removed))
+                self.assertEqual(oldkeys & newkeys, set(diff.unchanged))
+                parsed = diff.parsed
+
+
+class TestAsync(unittest.TestCase):
+    TAGSTRS = ['T1, t2', 'a' * 50 + ', B', None, 'x, ' * 30]
+
+    def _run(self, tokenizer, tagstrs):
+        async def tokenize():
+            single = [await tokenizer.astr2tags(tagstr) for tagstr in tagstrs]
+            many = [tags async for tags in tokenizer.astr2tags_many(tagstrs)]
+
+            async def agen():
+                for tagstr in tagstrs:
+                    yield tagstr
+            amany = [tags async for tags in tokenizer.astr2tags_many(agen())]
+            return single, many, amany
+        return asyncio.run(tokenize())
+
+    def test_astr2tags(self):
+        offloader = Offloader(threshold=20, workers=2, max_pending=2)
+
+        class AsyncComma(CommaTokenizer):
+            OFFLOADER = offloader
+
+        expected = [[(tag.clean, tag.raw) for tag in
+                     CommaTokenizer.str2tags(tagstr)]
+                    for tagstr in self.TAGSTRS]
+        for tokenizer in (CommaTokenizer, AsyncComma):
+            for results in self._run(tokenizer, self.TAGSTRS):
+                self.assertEqual(expected,
+                                 [[(tag.clean, tag.raw) for tag in tags]
+                                  for tags in results])
+        metrics = offloader.metrics()
+        self.assertEqual((6, 6), (metrics['inline'], metrics['offloaded']))
+        self.assertTrue(metrics['parse_time'] > 0)
+        self.assertTrue(metrics['queued_time'] >= 0)
+        offloader.reset()
+        self.assertEqual((0, 0), (offloader.inline, offloader.offloaded))
+        offloader.executor.shutdown()
+
+    def test_several_loops(self):
+        offloader = Offloader(threshold=1, max_pending=1)
+
+        class AsyncComma(CommaTokenizer):
+            OFFLOADER = offloader
+
+        async def tokenize():
+            return await asyncio.gather(*[AsyncComma.astr2tags('a, b')
+                                          for i in range(4)])
+        # the offloader outlives the loops, its semaphore must not
+        for i in range(2):
+            self.assertEqual([['a', 'b']] * 4,
+                             [[tag.raw for tag in tags]
+                              for tags in asyncio.run(tokenize())])
+        self.assertEqual(8, offloader.offloaded)
+        offloader.executor.shutdown()
+
+
+class TestCache(unittest.TestCase):
+
+    def test_lru_cache(self):
+        cache = LRUCache(2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        self.assertEqual(1, cache.get('a'))
+        cache.set('c', 3)
+        self.assertEqual(None, cache.get('b'))
+        self.assertEqual(3, cache.get('c'))
+        self.assertEqual((2, 1, 2), (cache.hits, cache.misses, len(cache)))
+        cache.clear()
+        self.assertEqual((0, 0, 0), (cache.hits, cache.misses, len(cache)))
+
+    def test_tag_cache(self):
+        class UpperTag(Tag):
+            @staticmethod
+            def normalize(tag):
+                return tag.upper()
+
+        cache = TagCache(maxsize=2)
+
+        class CachedComma(CommaTokenizer):
+            CACHE = cache
+
+        class CachedUpperComma(CachedComma):
+            TAGCLASS = UpperTag
+
+        tags = CachedComma.str2tags('TaG, tag ,T2')
+        self.assertTrue(isinstance(tags, tuple))
+        self.assertEqual([('tag', 'TaG'), ('t2', 'T2')],
+                         [(tag.clean, tag.raw) for tag in tags])
+        self.assertTrue(tags is CachedComma.str2tags('TaG, tag ,T2'))
+        self.assertEqual((1, 1), (cache.strings.hits, cache.strings.misses))
+        self.assertEqual([('TAG', 'TaG'), ('T2', 'T2')],
+                         [(tag.clean, tag.raw) for tag in
+                          CachedUpperComma.str2tags('TaG, tag ,T2')])
+        self.assertEqual((), CachedComma.str2tags(None))
+        self.assertEqual(2, len(cache.strings))
+        self.assertEqual(
+            [('t2', 'T2'), ('t3', 'T3')],
+            [(tag.clean, tag.raw) for tags in
+             CachedComma.str2tags_many(['T2,T3']) for tag in tags])
+        self.assertTrue(CachedComma.str2tags('T2')[0] is
+                        CachedComma.str2tags('T3,T2')[1])
+        cache.clear()
+        self.assertEqual((0, 0), (len(cache.strings), len(cache.tags)))
+
+
+class TestProfiler(unittest.TestCase):
+
+    def test_counters(self):
+        profiler = Profiler()
+
+        class ProfiledComma(CommaTokenizer):
+            PROFILER = profiler
+
+        tags = ProfiledComma.str2tags('TaG, tag, ,geo:lat=1,  bé')
+        self.assertEqual([('tag', 'TaG'), ('geo:lat=1', 'geo:lat=1'),
+                          ('bé', 'bé')],
+                         [(tag.clean, tag.raw) for tag in tags])
+        self.assertEqual({'calls': 1, 'sampled': 1, 'bytes': 26,
+                          'tokens': 5, 'duplicates': 1, 'empty': 1,
+                          'machinetags': 1}, profiler.counters)
+        self.assertTrue(all(value >= 0
+                            for value in profiler.timers.values()))
+        self.assertTrue(profiler.timers['total'] > 0)
+        self.assertEqual([], ProfiledComma.str2tags(''))
+        self.assertEqual(2, profiler.metrics()['calls'])
+        self.assertTrue('dedup_time' in profiler.metrics())
+        profiler.reset()
+        self.assertEqual(0, profiler.counters['calls'])
+
+    def test_sample(self):
+        profiler = Profiler(sample=3)
+
+        class ProfiledFlickr(FlickrTokenizer):
+            PROFILER = profiler
+
+        results = list(ProfiledFlickr.str2tags_many(
+            ['a "b c" a'] * 7))
+        self.assertEqual([['a', 'b c']] * 7,
+                         [[tag.raw for tag in tags] for tags in results])
+        self.assertEqual((7, 3, 9), (profiler.counters['calls'],
+                                     profiler.counters['sampled'],
+                                     profiler.counters['tokens']))
+
+    def test_unsampled_calls(self):
+        built = []
+
+        class ProfiledComma(CommaTokenizer):
+            PROFILER = Profiler(sample=4)
+
+            @classmethod
+            def _tags(cls, strtags):
+                built.append(strtags)
+                return super(ProfiledComma, cls)._tags(strtags)
+
+        # the unsampled calls take the same path (and backend) as
+        # without a profiler
+        for i in range(8):
+            self.assertEqual(['a', 'b'], [tag.raw for tag in
+                                          ProfiledComma.str2tags('a, b, A')])
+        self.assertEqual(6, len(built))
+
+    def test_enable(self):
+        exported = []
+        profiler = Profiler(callback=exported.append)
+        with profiler.enable(DeliciousTokenizer) as active:
+            self.assertTrue(active is profiler)
+            self.assertTrue(DeliciousTokenizer.PROFILER is profiler)
+            DeliciousTokenizer.str2tags('a b a')
+        self.assertTrue('PROFILER' not in vars(DeliciousTokenizer))
+        self.assertEqual(None, DeliciousTokenizer.PROFILER)
+        self.assertEqual(1, len(exported))
+        self.assertEqual((1, 1), (exported[0]['calls'],
+                                  exported[0]['duplicates']))
+        DeliciousTokenizer.str2tags('a b')
+        self.assertEqual(1, profiler.counters['calls'])
+
+    def test_cache(self):
+        profiler = Profiler()
+
+        class ProfiledCachedComma(CommaTokenizer):
+            PROFILER = profiler
+            CACHE = TagCache()
+
+        tags = ProfiledCachedComma.str2tags('a, b')
+        self.assertTrue(tags is ProfiledCachedComma.str2tags('a, b'))
+        self.assertEqual((2, 2, 0), (profiler.counters['calls'],
+                                     profiler.counters['sampled'],
+                                     profiler.counters['tokens']))
+
+
+class TestDialect(unittest.TestCase):
+    BUILTINS = ((DeliciousTokenizer, Dialect(' ')),
+                (CommaTokenizer, Dialect(',', joiner=', ')),
+                (FlickrTokenizer, Dialect(' ', quote='"')))
+
+    def _tags(self, tags):
+        return [(tag.clean, tag.raw, tag.value) for tag in tags]
+
+    def _chunks(self, rnd, tagstr):
+        chunks = []
+        while tagstr:
+            size = rnd.randint(0, 6)
+            chunks.append(tagstr[:size])
+            tagstr = tagstr[size:]
+        return chunks
+
+    def test_builtins(self):
+        rnd = random.Random(11)
+        for builtin, dialect in self.BUILTINS:
+            compiled = dialect.compile()
+            self.assertTrue(issubclass(compiled, Tokenizer))
+            self.assertEqual(builtin.TAGS_WITH_SPACES is False,
+                             compiled.TAGS_WITH_SPACES is False)
+            for i in range(1000):
+                tagstr = ''.join([rnd.choice('  ,""aaB:=\n')
+                                  for j in range(rnd.randint(0, 30))])
+                expected = self._tags(builtin.str2tags(tagstr))
+                self.assertEqual(expected,
+                                 self._tags(compiled.str2tags(tagstr)))
+                self.assertEqual(expected, self._tags(
+                    compiled.str2tags_stream(self._chunks(rnd, tagstr))))
+                self.assertEqual(expected,
+                                 self._tags(compiled.parse(tagstr).tags))
+                raws = [tag for tag, clean, value in expected]
+                self.assertEqual(builtin.tags2str(raws),
+                                 compiled.tags2str(raws))
+
+    def test_semicolon(self):
+        tokenizer = Dialect(';', joiner='; ').compile('SemicolonTokenizer')
+        self.assertEqual('SemicolonTokenizer', tokenizer.__name__)
+        self.assertEqual(__name__, tokenizer.__module__)
+        self.assertEqual([('a b', 'A b'), ('c', 'c')],
+                         [(tag.clean, tag.raw) for tag in
+                          tokenizer.str2tags('A b; a b;;c')])
+        self.assertEqual('a b; c', tokenizer.tags2str(['a b', 'c']))
+        self.assertRaises(TagWithSeparatorException, tokenizer.tags2str,
+                          ['a;b'])
+
+    def test_hashtags(self):
+        tokenizer = Dialect(' ', prefix='#').compile()
+        self.assertFalse(tokenizer.TAGS_WITH_SPACES)
+        self.assertEqual(['python', 'c#', 'plain', 'geo:lat=1'],
+                         [tag.raw for tag in tokenizer.str2tags(
+                             '#python  #c# # plain #geo:lat=1 #Python')])
+        self.assertEqual('1', tokenizer.str2tags('#geo:lat=1')[0].value)
+        self.assertEqual('#a #b', tokenizer.tags2str(['a', 'b']))
+        self.assertRaises(TagWithSeparatorException, tokenizer.tags2str,
+                          ['a b'])
+        self.assertEqual(['a', 'b'], [tag.raw for tag in
+                         tokenizer.str2tags_stream(['#a #', 'b'])])
+        self.assertEqual(['b'], [tag.raw for tag in tokenizer.diff(
+                         '#a', '#a #b').added.values()])
+        self.assertRaises(TypeError, tokenizer.str2tags_column, ['#a'])
+
+        tokenizer = Dialect(',', prefix='#', spaces=False).compile()
+        # spaces separate tags too, so they can be serialized back
+        tags = tokenizer.str2tags('#a, #b c')
+        self.assertEqual(['a', 'b', 'c'], [tag.raw for tag in tags])
+        self.assertEqual('#a,#b,#c', tokenizer.tags2str(tags))
+        self.assertEqual(['a', 'b', 'c'], [tag.raw for tag in
+                         tokenizer.str2tags_stream(['#a, #', 'b c'])])
+        self.assertRaises(TagWithSeparatorException, tokenizer.tags2str,
+                          ['b c'])
+
+    def test_single_quotes(self):
+        tokenizer = Dialect(',', joiner=', ', quote="'").compile()
+        self.assertEqual(['a, b', 'c', 'd'], [
+            tag.raw for tag in tokenizer.str2tags("'a, b', c,'d'")])
+        self.assertEqual("'a, b', c", tokenizer.tags2str(['a, b', 'c']))
+
+    def test_escapes(self):
+        tokenizer = Dialect(',', escape='\\').compile()
+        self.assertEqual(['a,b', 'c\\', 'd'], [
+            tag.raw for tag in tokenizer.str2tags('a\\,b,c\\\\,d')])
+        self.assertEqual('a\\,b,c\\\\', tokenizer.tags2str(['a,b', 'c\\']))
+        self.assertEqual(['a\\'], [tag.raw for tag in
+                                   tokenizer.str2tags('a\\')])
+        # an escape before the trailing whitespace is literal
+        for tagstr in ('a\\\t', ' b,a\\ \n ', '\\ '):
+            for size in (1, 2, 100):
+                chunks = [tagstr[i:i + size]
+                          for i in range(0, len(tagstr), size)]
+                self.assertEqual(
+                    [tag.raw for tag in tokenizer.str2tags(tagstr)],
+                    [tag.raw for tag in tokenizer.str2tags_stream(chunks)])
+
+    def test_compiled_once(self):
+        tokenizer = Dialect(';', quote="'", escape='\\').compile()
+        self.assertTrue(tokenizer._scanner().run is tokenizer.RUN)
+        self.assertEqual(["a;b", 'c'], [tag.raw for tag in
+                                        tokenizer.str2tags("'a;b';c")])
+        self.assertEqual(None, Dialect(';').compile().__dict__.get('RUN'))
+
+    def test_roundtrip(self):
+        rnd = random.Random(5)
+        dialects = [Dialect(',', escape='\\'),
+                    Dialect(' ', quote='"', escape='\\'),
+                    Dialect(';', joiner='; ', quote="'", escape='^'),
+                    Dialect(' ', quote="'", escape='\\', prefix='#')]
+        for dialect in dialects:
+            tokenizer = dialect.compile()
+            for i in range(500):
+                tags, keys = [], set()
+                for j in range(rnd.randint(0, 5)):
+                    tag = ''.join([rnd.choice('aB ,;"\'^\\#')
+                                   for k in range(rnd.randint(1, 6))])
+                    tag = tag.strip()
+                    if tag.lower() not in keys and not tag.startswith('#'):
+                        tags.append(tag)
+                        keys.add(tag.lower())
+                tags = [tag for tag in tags if tag]
+                tagstr = tokenizer.tags2str(tags)
+                self.assertEqual(tags, [tag.raw for tag in
+                                        tokenizer.str2tags(tagstr)],
+                                 (dialect, tagstr))
+                self.assertEqual(tags, [tag.raw for tag in
+                                        tokenizer.str2tags_stream(
+                                            self._chunks(rnd, tagstr))],
+                                 (dialect, tagstr))
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, Dialect, '')
+        self.assertRaises(ValueError, Dialect, ', ', quote='"')
+        self.assertRaises(ValueError, Dialect, ',', quote=',')
+        self.assertRaises(ValueError, Dialect, ',', quote='"', escape='"')
+        self.assertRaises(ValueError, Dialect, ',', joiner=' ')
+        self.assertRaises(ValueError, Dialect, ' ', spaces=True)
+
+
+@unittest.skipIf(tagtools._speedups is None, 'the C accelerator is not built')
+class TestSpeedups(unittest.TestCase):
+    """ The C accelerator against the pure Python code. Run the whole suite
+    with TAGTOOLS_NO_SPEEDUPS=1 to test the pure Python code alone.
+    """
+
+    def _parse(self, tokenizer, tagstrs, speedups):
+        saved = tagtools._speedups
+        tagtools._speedups = speedups
+        try:
+            return ([[list(vars(tag).items()) if isinstance(tag, Tag) else
+                      (tag.clean, tag.raw, tag.value)
+                      for tag in tokenizer.str2tags(tagstr)]
+                     for tagstr in tagstrs],
+                    [[tag.raw for tag in tags]
+                     for tags in tokenizer.str2tags_many(tagstrs)])
+        finally:
+            tagtools._speedups = saved
+
+    def test_same_results(self):
+        class UpperTag(Tag):
+            @staticmethod
+            def normalize(tag):
+                return tag.upper()
+
+        rnd = random.Random(13)
+        tagstrs = [''.join([rnd.choice('  ,;""\'\\aBé:=\t')
+                            for j in range(rnd.randint(0, 30))])
+                   for i in range(3000)]
+        tagstrs += ['geo:lat=1 "ns:Pred=A b" a:b=c=D x:=1 a', None]
+        tokenizers = [FlickrTokenizer, DeliciousTokenizer, CommaTokenizer,
+                      Dialect(';', quote="'", escape='\\').compile(),
+                      Dialect(',', escape='\\', prefix='#').compile()]
+        for tagclass in (Tag, UpperTag, CompactTag, LazyTag):
+            for tokenizer in tokenizers:
+                class Tokenized(tokenizer):
+                    TAGCLASS = tagclass
+                self.assertEqual(self._parse(Tokenized, tagstrs, None),
+                                 self._parse(Tokenized, tagstrs,
+                                             tagtools._speedups),
+                                 (tagclass, tokenizer))
+
+    def test_process_tag_override(self):
+        class TwoTags(CommaTokenizer):
+            @classmethod
+            def _process_tag(cls, tags, keys, strtag, tag=None):
+                if len(tags) < 2:
+                    super(TwoTags, cls)._process_tag(tags, keys, strtag, tag)
+
+        tagstrs = ['a,b,c,d', 'e', None]
+        expected = self._parse(TwoTags, tagstrs, None)
+        self.assertEqual([['a', 'b'], ['e'], []], expected[1])
+        self.assertEqual(expected, self._parse(TwoTags, tagstrs,
+                                               tagtools._speedups))
+
+
 if __name__ == "__main__":  # pragma: no cover
     unittest.main()